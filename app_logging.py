@@ -0,0 +1,216 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional
+from tracing import current_trace_id
+
+# 结构化日志：调用方只把记录放入有界队列，格式化为 JSON 和写 stdout 都在后台线程完成，
+# 队列满时丢弃并计数，不会阻塞请求。每条记录带上请求ID和 trace id。
+# LOG_LEVELS 环境变量按模块覆盖级别，例如 "database=DEBUG,webhooks=WARNING"。
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_LEVELS: Dict[str, str] = {
+    "azure": "WARNING",
+    "database": "INFO",
+}
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json 或 text
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"
+LOG_QUEUE_SIZE = 10000
+# 高频的 DEBUG 日志按模块采样，每种消息每 N 条保留一条
+LOG_DEBUG_SAMPLE_EVERY: Dict[str, int] = {
+    "database": 100,
+}
+REQUEST_ID_HEADER = b"x-request-id"
+
+_request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+_VALID_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+# LogRecord 自带的属性，其余属性都是通过 extra 传入的结构化字段
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message"}
+
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+class ContextFilter(logging.Filter):
+    """在调用方线程中读取上下文，记录进入队列之后就取不到了。"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        record.trace_id = current_trace_id()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, sample_every: Dict[str, int]):
+        super().__init__()
+        self.sample_every = sample_every
+        self._counts: Dict[Any, int] = {}
+
+    def _rate(self, name: str) -> int:
+        while name:
+            if name in self.sample_every:
+                return self.sample_every[name]
+            name = name.rpartition(".")[0]
+        return 1
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        every = self._rate(record.name)
+        if every <= 1:
+            return True
+        # 按消息模板计数，而不是格式化后的内容，同一种日志在采样后仍会出现
+        key = (record.name, record.msg)
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        if count % every:
+            return False
+        record.sample_every = every
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: "queue.Queue[logging.LogRecord]"):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 只在调用方线程中合并参数和异常堆栈，JSON 格式化留给后台线程
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogPipeline:
+    def __init__(self):
+        self.handler: Optional[NonBlockingQueueHandler] = None
+        self.listener: Optional[QueueListener] = None
+        self._lock = threading.Lock()
+
+    def configure(self) -> None:
+        with self._lock:
+            if self.handler is not None:
+                return
+            log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+            self.handler = NonBlockingQueueHandler(log_queue)
+            self.handler.addFilter(SamplingFilter(LOG_DEBUG_SAMPLE_EVERY))
+            self.handler.addFilter(ContextFilter())
+
+            output = logging.StreamHandler()
+            if LOG_FORMAT == "json":
+                output.setFormatter(JsonFormatter())
+            else:
+                output.setFormatter(logging.Formatter(TEXT_FORMAT))
+            self.listener = QueueListener(log_queue, output)
+
+            root = logging.getLogger()
+            for existing in list(root.handlers):
+                root.removeHandler(existing)
+            root.addHandler(self.handler)
+            root.setLevel(LOG_LEVEL)
+            for name, level in {**LOG_LEVELS, **_env_levels()}.items():
+                logging.getLogger(name).setLevel(level)
+
+            self.listener.start()
+            atexit.register(self.stop)
+
+    def stop(self) -> None:
+        # 写完队列中剩余的记录
+        with self._lock:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+
+    def stats(self) -> Dict[str, float]:
+        if self.handler is None:
+            return {"queue_depth": 0, "dropped": 0}
+        return {
+            "queue_depth": self.handler.queue.qsize(),
+            "dropped": self.handler.dropped,
+        }
+
+
+def _env_levels() -> Dict[str, str]:
+    levels = {}
+    for item in os.getenv("LOG_LEVELS", "").split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+log_pipeline = LogPipeline()
+
+
+def configure_logging() -> None:
+    log_pipeline.configure()
+
+
+class RequestIdMiddleware:
+    """沿用请求头 X-Request-ID（格式不合法时重新生成），并在响应头返回。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for key, value in scope.get("headers") or []:
+            if key == REQUEST_ID_HEADER:
+                candidate = value.decode("latin-1").strip()
+                if _VALID_REQUEST_ID.match(candidate):
+                    request_id = candidate
+                break
+        request_id = request_id or uuid.uuid4().hex
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message = {
+                    **message,
+                    "headers": list(message.get("headers", []))
+                    + [(REQUEST_ID_HEADER, request_id.encode("latin-1"))],
+                }
+            await send(message)
+
+        token = _request_id.set(request_id)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_id.reset(token)
@@ -1,7 +1,14 @@
+from collections import OrderedDict
 from fastapi import HTTPException, Depends, status
 from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+import hashlib
+import threading
+import time
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
+from schemas import Principal, UserRole
+from tracing import traced
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=True)
 
@@ -9,6 +16,65 @@ SECRET_KEY = "your-secret-key"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30  # Token失效时间为30分钟
 REFRESH_TOKEN_EXPIRE_DAYS = 1
+PASSWORD_RESET_TOKEN_EXPIRE_MINUTES = 60  # 与重置邮件中的说明一致
+PASSWORD_RESET_TOKEN_TYPE = "password_reset"
+TOKEN_CACHE_SIZE = 10000  # 已验证令牌缓存的最大条目数
+# 令牌版本：修改声明格式或需要让旧令牌全部失效时递增
+TOKEN_VERSION = 1
+MIN_TOKEN_VERSION = 1
+
+
+class TokenCache:
+    """已验证令牌的LRU缓存，键为令牌摘要，条目在令牌过期时失效。"""
+
+    def __init__(self, max_size: int = TOKEN_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._revoked: Dict[str, float] = {}  # 令牌摘要 -> 过期时间
+        # 同步依赖在线程池中执行，需要加锁
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token_digest: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            claims = self._entries.get(token_digest)
+            if claims is None:
+                return None
+            if claims.get("exp", 0) <= time.time():
+                del self._entries[token_digest]
+                return None
+            self._entries.move_to_end(token_digest)
+            return claims
+
+    def put(self, token_digest: str, claims: Dict[str, Any]) -> None:
+        with self._lock:
+            self._entries[token_digest] = claims
+            self._entries.move_to_end(token_digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def revoke(self, token_digest: str, expires_at: float) -> None:
+        with self._lock:
+            now = time.time()
+            # 已过期的令牌无论如何都会被拒绝，不需要继续保留在撤销集合中
+            for revoked_digest, revoked_exp in list(self._revoked.items()):
+                if revoked_exp <= now:
+                    del self._revoked[revoked_digest]
+            self._revoked[token_digest] = expires_at
+            self._entries.pop(token_digest, None)
+
+    def is_revoked(self, token_digest: str) -> bool:
+        return token_digest in self._revoked
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache()
 
 
 def create_access_token(data: dict):
@@ -19,6 +85,59 @@ def create_access_token(data: dict):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
+def create_enterprise_token(enterprise_id: int) -> str:
+    return create_access_token(
+        data={
+            "sub": str(enterprise_id),
+            "role": UserRole.ENTERPRISE.value,
+            "eid": int(enterprise_id),
+            "ver": TOKEN_VERSION,
+        }
+    )
+
+
+def create_refugee_token(refugee_id: int) -> str:
+    return create_access_token(
+        data={
+            "sub": str(refugee_id),
+            "role": UserRole.REFUGEE.value,
+            "rid": int(refugee_id),
+            "ver": TOKEN_VERSION,
+        }
+    )
+
+
+# 重置令牌带专用的 typ 声明，没有角色和版本，不能当作访问令牌使用
+def create_password_reset_token(enterprise_id: int) -> str:
+    expire = datetime.utcnow() + timedelta(minutes=PASSWORD_RESET_TOKEN_EXPIRE_MINUTES)
+    return jwt.encode(
+        {"sub": str(enterprise_id), "typ": PASSWORD_RESET_TOKEN_TYPE, "exp": expire},
+        SECRET_KEY,
+        algorithm=ALGORITHM,
+    )
+
+
+def revoke_token(token: str) -> None:
+    try:
+        expires_at = float(jwt.get_unverified_claims(token).get("exp", 0))
+    except JWTError:
+        return
+    token_cache.revoke(TokenCache.digest(token), expires_at)
+
+
+@traced("auth.decode_token")
+def decode_token(token: str) -> Dict[str, Any]:
+    # 命中缓存时跳过签名校验和JSON解析，只做一次字典查找
+    token_digest = TokenCache.digest(token)
+    if token_cache.is_revoked(token_digest):
+        raise JWTError("Token has been revoked")
+    claims = token_cache.get(token_digest)
+    if claims is None:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        token_cache.put(token_digest, claims)
+    return claims
+
+
 def verify_oauth_token(token: str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -26,10 +145,82 @@ def verify_oauth_token(token: str = Depends(oauth2_scheme)):
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         userId: str = payload.get("sub")
         if userId is None:
             raise credentials_exception
         return userId
     except JWTError:
         raise credentials_exception
+
+
+def verify_password_reset_token(token: str) -> str:
+    """返回重置令牌中的企业ID，只接受 create_password_reset_token 签发的令牌。"""
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid password reset token",
+    )
+    try:
+        payload = decode_token(token)
+    except JWTError:
+        raise credentials_exception
+    if payload.get("typ") != PASSWORD_RESET_TOKEN_TYPE or payload.get("sub") is None:
+        raise credentials_exception
+    return payload["sub"]
+
+
+def get_current_principal(token: str = Depends(oauth2_scheme)) -> Principal:
+    credentials_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid authentication credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    try:
+        payload = decode_token(token)
+    except JWTError:
+        raise credentials_exception
+    try:
+        token_version = int(payload.get("ver", 0))
+    except (TypeError, ValueError):
+        raise credentials_exception
+    # 没有角色或版本过旧的令牌需要重新登录
+    if (
+        payload.get("sub") is None
+        or payload.get("role") not in UserRole._value2member_map_
+        or token_version < MIN_TOKEN_VERSION
+    ):
+        raise credentials_exception
+    return Principal(
+        subject=payload["sub"],
+        role=payload["role"],
+        enterprise_id=payload.get("eid"),
+        refugee_id=payload.get("rid"),
+        token_version=token_version,
+    )
+
+
+def require_enterprise(principal: Principal = Depends(get_current_principal)) -> Principal:
+    if principal.role != UserRole.ENTERPRISE or principal.enterprise_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="This operation requires an enterprise account",
+        )
+    return principal
+
+
+def require_refugee(principal: Principal = Depends(get_current_principal)) -> Principal:
+    if principal.role != UserRole.REFUGEE or principal.refugee_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="This operation requires a refugee account",
+        )
+    return principal
+
+
+# 路由中直接使用的ID依赖，与 verify_oauth_token 的返回值保持一致
+def verify_enterprise_token(principal: Principal = Depends(require_enterprise)) -> str:
+    return str(principal.enterprise_id)
+
+
+def verify_refugee_token(principal: Principal = Depends(require_refugee)) -> str:
+    return str(principal.refugee_id)
@@ -0,0 +1,215 @@
+import time
+from datetime import date, datetime, timezone
+from enum import Enum
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Set, Tuple, Type
+from typing import get_args, get_origin, get_type_hints
+from fastapi import Header
+from fastapi.responses import Response
+from pydantic import BaseModel
+from fast_json import model_response
+from tracing import span
+
+try:
+    import msgpack
+except ImportError:  # 未安装 msgpack 时所有请求都返回 JSON
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+JSON_MEDIA_TYPE = "application/json"
+
+# 二进制格式说明（与 JSON 使用相同的 schema）：
+# - 模型列表编码为 {"fields": [...], "enums": {字段: [取值...]}, "rows": [[...], ...]}，
+#   每一行按 fields 的顺序排列，避免重复的键名；
+# - 时间编码为 UTC 毫秒时间戳，无时区的时间按 UTC 处理；
+# - 枚举编码为在 enums 对应列表中的下标。
+
+
+def _unwrap_optional(tp: Any) -> Any:
+    if get_origin(tp) is not None and type(None) in get_args(tp):
+        args = [arg for arg in get_args(tp) if arg is not type(None)]
+        if len(args) == 1:
+            return args[0]
+    return tp
+
+
+@lru_cache(maxsize=None)
+def _columns(model: Type[BaseModel]) -> Tuple[Tuple[str, Any], ...]:
+    hints = get_type_hints(model)
+    return tuple(
+        (name, _unwrap_optional(hints[name]))
+        for name in model.__fields__
+        if name in hints
+    )
+
+
+@lru_cache(maxsize=None)
+def _enum_index(enum_cls: Type[Enum]) -> Dict[Any, int]:
+    index = {}
+    for position, member in enumerate(enum_cls):
+        index[member] = position
+        index[member.value] = position
+    return index
+
+
+def encode_datetime(value: Any) -> Any:
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp() * 1000)
+    if isinstance(value, date):
+        return encode_datetime(datetime(value.year, value.month, value.day))
+    return value
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return encode_datetime(value)
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, BaseModel):
+        return encode_model(value)
+    if isinstance(value, (list, tuple)):
+        return [_encode_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _encode_value(item) for key, item in value.items()}
+    return value
+
+
+def encode_rows(
+    model: Type[BaseModel], items: List[BaseModel], fields: Optional[Set[str]] = None
+) -> Dict[str, Any]:
+    columns = [
+        (name, tp) for name, tp in _columns(model) if not fields or name in fields
+    ]
+    enums = {
+        name: [member.value for member in tp]
+        for name, tp in columns
+        if isinstance(tp, type) and issubclass(tp, Enum)
+    }
+    encoders = []
+    for name, tp in columns:
+        if name in enums:
+            index = _enum_index(tp)
+            encoders.append((name, lambda value, index=index: index[value]))
+        elif tp in (datetime, date):
+            encoders.append((name, encode_datetime))
+        else:
+            encoders.append((name, _encode_value))
+    rows = []
+    for item in items:
+        row = []
+        for name, encode in encoders:
+            value = getattr(item, name, None)
+            row.append(None if value is None else encode(value))
+        rows.append(row)
+    return {"fields": [name for name, _ in columns], "enums": enums, "rows": rows}
+
+
+def encode_model(model: BaseModel, fields: Optional[Set[str]] = None) -> Dict[str, Any]:
+    """把响应模型转换为可以 msgpack 序列化的结构，fields 只作用于列表中的每一项。"""
+    hints = get_type_hints(type(model))
+    result = {}
+    for name in model.__fields__:
+        value = getattr(model, name, None)
+        item_type = _unwrap_optional(hints.get(name))
+        if get_origin(item_type) in (list, List) and get_args(item_type):
+            item_model = get_args(item_type)[0]
+            if isinstance(item_model, type) and issubclass(item_model, BaseModel):
+                result[name] = encode_rows(item_model, value or [], fields)
+                continue
+        result[name] = _encode_value(value)
+    return result
+
+
+def pack(model: BaseModel, fields: Optional[Set[str]] = None) -> bytes:
+    with span("serialize.msgpack") as serialize_span:
+        body = msgpack.packb(encode_model(model, fields), use_bin_type=True)
+        serialize_span.set_attribute("bytes", len(body))
+    return body
+
+
+def response_format(accept: Optional[str] = Header(None)) -> str:
+    """根据 Accept 请求头选择响应格式，未安装 msgpack 时总是返回 JSON。"""
+    if msgpack is None or not accept:
+        return JSON_MEDIA_TYPE
+    for part in accept.lower().split(","):
+        media_type, _, params = part.strip().partition(";")
+        if media_type.strip() not in MSGPACK_MEDIA_TYPES:
+            continue
+        params = params.strip()
+        try:
+            quality = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            quality = 0.0
+        if quality > 0:
+            return MSGPACK_MEDIA_TYPE
+    return JSON_MEDIA_TYPE
+
+
+def negotiated_response(
+    model: BaseModel,
+    fields: Optional[Set[str]] = None,
+    media_type: str = JSON_MEDIA_TYPE,
+) -> Response:
+    if media_type == MSGPACK_MEDIA_TYPE:
+        response = Response(content=pack(model, fields), media_type=MSGPACK_MEDIA_TYPE)
+    else:
+        response = model_response(model, fields)
+    response.headers["Vary"] = "Accept"
+    return response
+
+
+def run_benchmark(rows: int = 100, rounds: int = 200) -> None:
+    """对比 JSON 与 msgpack 的响应大小和编码耗时：python binary_format.py"""
+    import gzip
+    from fast_json import dumps
+    from schemas import PaymentStatus, Task, TaskDifficulty, TaskListResponse
+    from schemas import TaskStatus, TaskType
+
+    now = datetime.now()
+    tasks = [
+        Task.construct(
+            id=i,
+            user_id=1000 + i,
+            enterprise_id=7,
+            title=f"Translate document #{i}",
+            description="Translate the attached customer support articles.",
+            type=TaskType.TRANSLATION,
+            difficulty=TaskDifficulty.MEDIUM,
+            deadline=now,
+            reward_per_unit=2.5,
+            total_units=40,
+            completed_units=i % 40,
+            resources=[f"https://example.com/resources/{i}/source.docx"],
+            status=TaskStatus.IN_PROGRESS,
+            payment_status=PaymentStatus.UNPAID,
+            created_at=now,
+            updated_at=now,
+            review_comment="",
+            task_comments=[],
+            rating=None,
+        )
+        for i in range(rows)
+    ]
+    response = TaskListResponse.construct(total_count=float(rows), tasks=tasks)
+
+    def measure(encode):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            body = encode()
+        return body, (time.perf_counter() - started) / rounds * 1000
+
+    results = [("json", *measure(lambda: dumps(response.dict())))]
+    if msgpack is not None:
+        results.append(("msgpack", *measure(lambda: pack(response))))
+    print(f"{rows} tasks, {rounds} rounds")
+    print(f"{'format':<10}{'bytes':>10}{'gzip bytes':>12}{'encode ms':>12}")
+    for name, body, elapsed in results:
+        compressed = len(gzip.compress(body))
+        print(f"{name:<10}{len(body):>10}{compressed:>12}{elapsed:>12.3f}")
+
+
+if __name__ == "__main__":
+    run_benchmark()
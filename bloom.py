@@ -0,0 +1,385 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import math
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from schemas import PARTITION_KEYS, TABLE_NAMES
+
+logger = logging.getLogger(__name__)
+
+# 按字段维护布隆过滤器，确定不存在的值直接返回未找到，不再扫描整张表。
+# 过滤器只会漏报“可能存在”，不会漏掉已写入的值：本实例的写入在写存储之前加入过滤器；
+# 写入过滤字段的实例同时在 BloomWatermark 表中更新本实例的写入时间（分区为表名，
+# RowKey 为实例ID）。过滤器判断不存在时读取该分区，其他实例在上次同步之后有过写入，
+# 就回退到存储查询。增量同步只在其他实例有新写入时才扫描表。
+BLOOM_FIELDS: Dict[str, Tuple[str, ...]] = {
+    TABLE_NAMES.REFUGEE: ("username", "email", "phone"),
+    TABLE_NAMES.ENTERPRISE: ("email",),
+    TABLE_NAMES.TASK: ("title",),
+}
+BLOOM_FALSE_POSITIVE_RATE = 0.01
+BLOOM_MIN_CAPACITY = 10000
+BLOOM_CAPACITY_HEADROOM = 2  # 按现有数据量的倍数分配容量，留出增长空间
+BLOOM_SYNC_SECONDS = 60  # 检查其他实例写入的间隔，期间该表的“不存在”回退到存储
+BLOOM_SYNC_OVERLAP_SECONDS = 5  # 增量同步时向前重叠的时间，容忍时钟偏差
+BLOOM_REBUILD_SECONDS = 3600  # 全量重建的间隔，清除已删除或修改的旧值
+INSTANCE_ID = uuid.uuid4().hex
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = BLOOM_FALSE_POSITIVE_RATE):
+        self.capacity = max(capacity, 1)
+        self.size = max(
+            8, int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        )
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value: str) -> Iterator[int]:
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, value: str) -> None:
+        # 所有位都已置位时视为重复值，不计数，增量同步重复加入的值不会占用容量
+        added = False
+        for position in self._positions(value):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        self.count += added
+
+    def __contains__(self, value: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value)
+        )
+
+    def estimated_false_positive_rate(self) -> float:
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class _FilterStats:
+    __slots__ = ("negatives", "probes", "false_positives")
+
+    def __init__(self):
+        self.negatives = self.probes = self.false_positives = 0
+
+
+def _field_value(value: Any) -> Optional[str]:
+    if value is None or value == "":
+        return None
+    return str(value)
+
+
+class ExistenceFilters:
+    """所有表字段的过滤器。过滤器建好之前对应字段的查询照常访问存储。"""
+
+    def __init__(self, fields: Optional[Dict[str, Tuple[str, ...]]] = None):
+        self.fields = BLOOM_FIELDS if fields is None else fields
+        self._filters: Dict[Tuple[str, str], BloomFilter] = {}
+        self._stats: Dict[Tuple[str, str], _FilterStats] = {}
+        # 重建期间的写入先记录下来，换入新过滤器前补上
+        self._building: Dict[str, List[Dict[str, Any]]] = {}
+        self._synced_at: Dict[str, datetime] = {}
+        self._lock = threading.Lock()
+
+    def might_contain(
+        self, table_name: str, field_name: str, value: Any
+    ) -> Optional[bool]:
+        """None 表示该字段没有可用的过滤器。"""
+        bloom = self._filters.get((table_name, field_name))
+        text = _field_value(value)
+        if bloom is None or text is None:
+            return None
+        present = text in bloom
+        stats = self._stats[(table_name, field_name)]
+        if present:
+            stats.probes += 1
+        else:
+            stats.negatives += 1
+        return present
+
+    def record_false_positive(self, table_name: str, field_name: str) -> None:
+        stats = self._stats.get((table_name, field_name))
+        if stats is not None:
+            stats.false_positives += 1
+
+    def add_entity(self, table_name: str, entity: Dict[str, Any]) -> None:
+        field_names = self.fields.get(table_name)
+        if not field_names:
+            return
+        with self._lock:
+            self._add_locked(table_name, entity)
+            building = self._building.get(table_name)
+            if building is not None:
+                building.append(
+                    {name: entity[name] for name in field_names if name in entity}
+                )
+
+    def _add_locked(self, table_name: str, entity: Dict[str, Any]) -> None:
+        for field_name in self.fields[table_name]:
+            bloom = self._filters.get((table_name, field_name))
+            text = _field_value(entity.get(field_name))
+            if bloom is not None and text is not None:
+                bloom.add(text)
+
+    def rebuild(self, table_name: str, rows: Iterable[Dict[str, Any]]) -> int:
+        """用流式扫描的结果重建该表的过滤器，返回扫描的行数。"""
+        field_names = self.fields[table_name]
+        started_at = datetime.now(timezone.utc)
+        with self._lock:
+            self._building[table_name] = []
+        try:
+            values: Dict[str, set] = {name: set() for name in field_names}
+            scanned = 0
+            for row in rows:
+                scanned += 1
+                for name in field_names:
+                    text = _field_value(row.get(name))
+                    if text is not None:
+                        values[name].add(text)
+        except BaseException:
+            with self._lock:
+                self._building.pop(table_name, None)
+            raise
+
+        with self._lock:
+            for name in field_names:
+                bloom = BloomFilter(
+                    max(BLOOM_MIN_CAPACITY, len(values[name]) * BLOOM_CAPACITY_HEADROOM)
+                )
+                for text in values[name]:
+                    bloom.add(text)
+                self._filters[(table_name, name)] = bloom
+                self._stats.setdefault((table_name, name), _FilterStats())
+            for entity in self._building.pop(table_name):
+                self._add_locked(table_name, entity)
+            self._synced_at[table_name] = started_at
+        return scanned
+
+    def catch_up(
+        self, table_name: str, rows: Iterable[Dict[str, Any]], started_at: datetime
+    ) -> int:
+        added = 0
+        for row in rows:
+            self.add_entity(table_name, row)
+            added += 1
+        self._synced_at[table_name] = started_at
+        return added
+
+    def synced_at(self, table_name: str) -> Optional[datetime]:
+        return self._synced_at.get(table_name)
+
+    def has_remote_writes(
+        self, table_name: str, watermarks: Iterable[Dict[str, Any]]
+    ) -> bool:
+        """其他实例在上次同步之后（减去时钟偏差）是否写入过该表的过滤字段。"""
+        synced_at = self._synced_at.get(table_name)
+        if synced_at is None:
+            return True
+        since = synced_at - timedelta(seconds=BLOOM_SYNC_OVERLAP_SECONDS)
+        return any(
+            row.get(PARTITION_KEYS.ROWKEY) != INSTANCE_ID
+            and datetime.fromisoformat(row["written_at"]) >= since
+            for row in watermarks
+        )
+
+    def needs_resize(self, table_name: str) -> bool:
+        return any(
+            bloom.count > bloom.capacity
+            for (name, _), bloom in list(self._filters.items())
+            if name == table_name
+        )
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for (table_name, field_name), bloom in list(self._filters.items()):
+            stats = self._stats[(table_name, field_name)]
+            absent = stats.negatives + stats.false_positives
+            result[f"{table_name}.{field_name}"] = {
+                "entries": bloom.count,
+                "capacity": bloom.capacity,
+                "hashes": bloom.hashes,
+                "memory_bytes": len(bloom.bits),
+                "estimated_fp_rate": bloom.estimated_false_positive_rate(),
+                "negatives": stats.negatives,
+                "probes": stats.probes,
+                "false_positives": stats.false_positives,
+                # 实际不存在的查询中，过滤器判断为“可能存在”的比例
+                "observed_fp_rate": stats.false_positives / absent if absent else 0.0,
+            }
+        return result
+
+
+existence_filters = ExistenceFilters()
+
+
+def _watermark_filter(table_name: str) -> str:
+    return f"PartitionKey eq '{table_name}'"
+
+
+def _remote_writes_since_sync(storage: Any, table_name: str) -> bool:
+    try:
+        watermarks = list(
+            storage.iter_entities(
+                TABLE_NAMES.BLOOM_WATERMARK, _watermark_filter(table_name)
+            )
+        )
+    except Exception:
+        logger.warning("Failed to read bloom watermarks", exc_info=True)
+        return True
+    return existence_filters.has_remote_writes(table_name, watermarks)
+
+
+def bloom_lookup(
+    missing: Any = None,
+) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """装饰按字段查找的方法 (table_name, field_name, field_value)，确定不存在时直接返回 missing。"""
+
+    def decorator(method: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if len(args) != 3 or kwargs:
+                return method(self, *args, **kwargs)
+            table_name, field_name, field_value = args
+            present = existence_filters.might_contain(
+                table_name, field_name, field_value
+            )
+            if present is False and not _remote_writes_since_sync(self, table_name):
+                return missing
+            result = method(self, *args, **kwargs)
+            if present is False and isinstance(result, dict):
+                # 其他实例写入、尚未同步的值
+                existence_filters.add_entity(table_name, result)
+            if present and not result:
+                existence_filters.record_false_positive(table_name, field_name)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def _written_entities(args: Tuple[Any, ...]) -> Iterator[Dict[str, Any]]:
+    # insert/update 的实体、update_entity_fields 的字段、批量更新的实体列表和事务操作
+    for arg in args:
+        if isinstance(arg, dict):
+            yield arg
+        elif isinstance(arg, list):
+            for item in arg:
+                if isinstance(item, dict):
+                    yield item
+                elif (
+                    isinstance(item, tuple)
+                    and len(item) > 1
+                    and isinstance(item[1], dict)
+                ):
+                    yield item[1]
+
+
+def bloom_write(method: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    装饰写方法，写入存储之前把值加入过滤器并更新本实例的写入时间，
+    保证本实例和其他实例并发的查询都不会得到错误的“不存在”。
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        table_name = args[0] if args else kwargs.get("table_name")
+        field_names = existence_filters.fields.get(table_name)
+        if field_names:
+            written = False
+            for entity in _written_entities(args[1:] + tuple(kwargs.values())):
+                existence_filters.add_entity(table_name, entity)
+                written = written or any(
+                    _field_value(entity.get(name)) is not None for name in field_names
+                )
+            if written:
+                watermark = {
+                    PARTITION_KEYS.PARKEY: table_name,
+                    PARTITION_KEYS.ROWKEY: INSTANCE_ID,
+                    "written_at": datetime.now(timezone.utc).isoformat(),
+                }
+                self.submit_transaction(
+                    TABLE_NAMES.BLOOM_WATERMARK, [("upsert", watermark)]
+                )
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class BloomRefresher:
+    """启动时全量构建过滤器，之后定期检查其他实例的写入并增量同步，定期全量重建。"""
+
+    def __init__(self, filters: Optional[ExistenceFilters] = None):
+        self.filters = filters or existence_filters
+        self._task: Optional[asyncio.Task] = None
+        self._scan: Optional[Callable[..., Iterable[Dict[str, Any]]]] = None
+
+    async def start(self, scan: Callable[..., Iterable[Dict[str, Any]]]) -> None:
+        """scan(table_name, filter_query, select) 流式返回实体，即 database.iter_entities。"""
+        if self._task is not None:
+            return
+        self._scan = scan
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def rebuild_table(self, table_name: str) -> int:
+        rows = self._scan(table_name, None, list(self.filters.fields[table_name]))
+        return self.filters.rebuild(table_name, rows)
+
+    def catch_up_table(self, table_name: str) -> int:
+        synced_at = self.filters.synced_at(table_name)
+        if synced_at is None:
+            return self.rebuild_table(table_name)
+        started_at = datetime.now(timezone.utc)
+        watermarks = self._scan(
+            TABLE_NAMES.BLOOM_WATERMARK, _watermark_filter(table_name), None
+        )
+        if not self.filters.has_remote_writes(table_name, watermarks):
+            return self.filters.catch_up(table_name, [], started_at)
+        since = synced_at - timedelta(seconds=BLOOM_SYNC_OVERLAP_SECONDS)
+        rows = self._scan(
+            table_name,
+            f"Timestamp ge datetime'{since.strftime('%Y-%m-%dT%H:%M:%SZ')}'",
+            list(self.filters.fields[table_name]),
+        )
+        return self.filters.catch_up(table_name, rows, started_at)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        last_rebuild = None
+        while True:
+            try:
+                full = last_rebuild is None or (
+                    loop.time() - last_rebuild >= BLOOM_REBUILD_SECONDS
+                )
+                for table_name in self.filters.fields:
+                    if full or self.filters.needs_resize(table_name):
+                        await loop.run_in_executor(None, self.rebuild_table, table_name)
+                    else:
+                        await loop.run_in_executor(None, self.catch_up_table, table_name)
+                if full:
+                    last_rebuild = loop.time()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to refresh bloom filters")
+            await asyncio.sleep(BLOOM_SYNC_SECONDS)
+
+
+bloom_refresher = BloomRefresher()
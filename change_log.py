@@ -0,0 +1,173 @@
+import json
+import re
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+from database import delete_entity, get_entity, insert_entity, iter_entities
+from database import query_entities_page
+from row_codec import decode_reward, decode_task, decode_withdraw
+from schemas import PARTITION_KEYS, TABLE_NAMES, SyncResponse
+
+# 每个难民用户一个分区，RowKey 以纳秒时间戳开头，即同步用的版本号
+CHANGE_LOG_RETENTION_DAYS = 30  # 早于该时间的版本需要客户端重新拉取完整列表
+CHANGE_LOG_SKEW_SECONDS = 2  # 多实例时钟偏差的容忍范围，同步时重复返回这段时间内的变更
+SYNC_MAX_CHANGES = 500  # 单次同步最多读取的变更记录数
+MAX_PAYLOAD_BYTES = 60 * 1024  # 超过该大小的实体不保存快照，同步时回源读取
+VERSION_WIDTH = 20
+# has_more 时返回的版本带该后缀：下一页从这条记录之后精确继续，不再回退时钟偏差，
+# 否则超过 SYNC_MAX_CHANGES 条变更落在偏差窗口内时会一直返回同一页
+CONTINUATION_SUFFIX = "~"  # URL 中不需要转义
+_VERSION_PATTERN = re.compile(rf"^\d{{{VERSION_WIDTH}}}(-[0-9a-f]{{6}})?~?$")
+
+
+class ChangeType:
+    TASK = "task"
+    TASK_REMOVED = "task_removed"
+    REWARD = "reward"
+    WITHDRAW = "withdraw"
+
+
+def _new_version() -> str:
+    return f"{time.time_ns():0{VERSION_WIDTH}d}-{uuid.uuid4().hex[:6]}"
+
+
+def _version_time_ns(version: str) -> int:
+    return int(version[:VERSION_WIDTH])
+
+
+def record_change(
+    user_id: Any, change_type: str, entity_key: Any, entity: Dict[str, Any]
+) -> bool:
+    """追加一条变更记录，保存实体快照，同步时不需要回表。"""
+    if not user_id or str(user_id) == "0":
+        return False
+    snapshot = {
+        key: value
+        for key, value in entity.items()
+        if key not in (PARTITION_KEYS.PARKEY, PARTITION_KEYS.ROWKEY)
+        and not key.startswith("odata")
+        and key not in ("Timestamp", "etag")
+    }
+    payload = json.dumps(snapshot, default=str)
+    if len(payload.encode("utf-8")) > MAX_PAYLOAD_BYTES:
+        payload = ""
+    row = {
+        PARTITION_KEYS.PARKEY: str(user_id),
+        PARTITION_KEYS.ROWKEY: _new_version(),
+        "change_type": change_type,
+        "entity_key": str(entity_key),
+        "source_partition_key": entity.get(PARTITION_KEYS.PARKEY, ""),
+        "source_row_key": entity.get(PARTITION_KEYS.ROWKEY, ""),
+        "payload": payload,
+        "created_at": datetime.now().isoformat(),
+    }
+    return insert_entity(TABLE_NAMES.CHANGE_LOG, row) is not None
+
+
+def record_task_change(
+    task_entity: Dict[str, Any], fields_to_update: Dict[str, Any]
+) -> None:
+    updated_task = {**task_entity, **fields_to_update}
+    previous_user = task_entity.get("user_id")
+    current_user = updated_task.get("user_id")
+    if previous_user and str(previous_user) != str(current_user):
+        # 任务被重新分配，通知原用户从本地列表中移除
+        record_change(previous_user, ChangeType.TASK_REMOVED, updated_task["id"], {})
+    record_change(current_user, ChangeType.TASK, updated_task.get("id"), updated_task)
+
+
+def _load_snapshot(row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    if row.get("payload"):
+        return json.loads(row["payload"])
+    table_name = {
+        ChangeType.TASK: TABLE_NAMES.TASK,
+        ChangeType.REWARD: TABLE_NAMES.REWARD_HISTORY,
+        ChangeType.WITHDRAW: TABLE_NAMES.WITHDRAW_REQUEST,
+    }.get(row["change_type"])
+    if table_name is None or not row.get("source_row_key"):
+        return None
+    return get_entity(table_name, row["source_partition_key"], row["source_row_key"])
+
+
+def get_changes_since(user_id: Any, since: Optional[str]) -> SyncResponse:
+    now_ns = time.time_ns()
+    horizon_ns = now_ns - CHANGE_LOG_RETENTION_DAYS * 86400 * 10**9
+    if (
+        not since
+        or not _VERSION_PATTERN.match(since)
+        or _version_time_ns(since) < horizon_ns
+    ):
+        # 首次同步或版本已过期：客户端重新拉取完整列表后从当前版本开始增量同步
+        return SyncResponse(version=f"{now_ns:0{VERSION_WIDTH}d}", reset=True)
+
+    if since.endswith(CONTINUATION_SUFFIX):
+        since = since[: -len(CONTINUATION_SUFFIX)]
+        lower_key = since
+    else:
+        lower = max(_version_time_ns(since) - CHANGE_LOG_SKEW_SECONDS * 10**9, 0)
+        lower_key = f"{lower:0{VERSION_WIDTH}d}"
+    rows = query_entities_page(
+        TABLE_NAMES.CHANGE_LOG,
+        f"PartitionKey eq '{user_id}' and RowKey gt '{lower_key}'",
+        SYNC_MAX_CHANGES,
+    )
+    has_more = len(rows) == SYNC_MAX_CHANGES
+    version = rows[-1][PARTITION_KEYS.ROWKEY] if rows else since
+    if has_more:
+        version += CONTINUATION_SUFFIX
+
+    # 同一实体只保留最新的一次变更
+    latest: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for row in rows:
+        change_type = row["change_type"]
+        if change_type == ChangeType.TASK_REMOVED:
+            latest.pop((ChangeType.TASK, row["entity_key"]), None)
+        elif change_type == ChangeType.TASK:
+            latest.pop((ChangeType.TASK_REMOVED, row["entity_key"]), None)
+        latest[(change_type, row["entity_key"])] = row
+
+    tasks, rewards, withdrawals, removed_task_ids = [], [], [], []
+    for (change_type, entity_key), row in latest.items():
+        if change_type == ChangeType.TASK_REMOVED:
+            removed_task_ids.append(int(entity_key))
+            continue
+        snapshot = _load_snapshot(row)
+        if snapshot is None:
+            continue
+        if change_type == ChangeType.TASK:
+            tasks.append(decode_task(snapshot))
+        elif change_type == ChangeType.REWARD:
+            rewards.append(decode_reward(snapshot))
+        elif change_type == ChangeType.WITHDRAW:
+            withdrawals.append(decode_withdraw(snapshot))
+
+    return SyncResponse.construct(
+        version=version,
+        reset=False,
+        has_more=has_more,
+        tasks=tasks,
+        removed_task_ids=removed_task_ids,
+        rewards=rewards,
+        withdrawals=withdrawals,
+    )
+
+
+# 删除超过保留期限的变更记录
+def prune_change_log() -> int:
+    horizon = (
+        datetime.now() - timedelta(days=CHANGE_LOG_RETENTION_DAYS)
+    ).isoformat()
+    deleted = 0
+    for row in iter_entities(TABLE_NAMES.CHANGE_LOG, f"created_at lt '{horizon}'"):
+        delete_entity(
+            TABLE_NAMES.CHANGE_LOG,
+            row[PARTITION_KEYS.PARKEY],
+            row[PARTITION_KEYS.ROWKEY],
+        )
+        deleted += 1
+    return deleted
+
+
+if __name__ == "__main__":
+    prune_change_log()
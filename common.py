@@ -1,14 +1,18 @@
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-import hashlib
 import json
-import smtplib
+from datetime import datetime
 from typing import Optional
 import uuid
 from database import (
+    OPTIMISTIC_ATTEMPTS,
     insert_entity,
     get_entity_by_field,
+    query_entities_with_etag,
+    update_entity_fields,
+    update_entity_if_match,
 )
+from email_outbox import enqueue_email
+from passwords import password_hasher
+from sorted_index import sync_withdraw_index
 from schemas import PARTITION_KEYS, TABLE_NAMES, RefugeeTask, WithdrawRequest
 
 
@@ -30,7 +34,7 @@ def process_task_resources(resources):
 
 
 # 写入难民用户表
-def save_refugee_to_database(refugee: RefugeeTask) -> RefugeeTask:
+def save_refugee_to_database(refugee: RefugeeTask) -> Optional[RefugeeTask]:
     # 将难民数据插入到Refugee表中
     entity = {
         "PartitionKey": str(refugee.user_id),
@@ -44,7 +48,8 @@ def save_refugee_to_database(refugee: RefugeeTask) -> RefugeeTask:
         "created_at": refugee.created_at.isoformat(),
         "updated_at": refugee.updated_at.isoformat(),
     }
-    insert_entity(TABLE_NAMES.REFUGEE, entity)
+    if insert_entity(TABLE_NAMES.REFUGEE, entity) is None:
+        return None
     return refugee
 
 
@@ -63,7 +68,9 @@ def save_withdraw_request(withdraw_request: WithdrawRequest) -> WithdrawRequest:
     }
 
     # Try to insert the entity
-    insert_entity(TABLE_NAMES.WITHDRAW_REQUEST, entity)
+    if not insert_entity(TABLE_NAMES.WITHDRAW_REQUEST, entity):
+        return None
+    sync_withdraw_index(entity)
     return entity
 
 
@@ -77,41 +84,42 @@ def get_user_balance(user_id: str) -> float:
     return float(user_entity.get("balance", 0))
 
 
-# 发送email方法
-def send_email(to_email: str, subject: str, body: str):
-    # Email configuration
-    smtp_server = "smtp.example.com"  # Replace with your SMTP server
-    smtp_port = 587  # Replace with your SMTP port
-    smtp_username = "your_username"  # Replace with your SMTP username
-    smtp_password = "your_password"  # Replace with your SMTP password
-    from_email = "noreply@yourcompany.com"  # Replace with your sender email
-
-    # Create message
-    message = MIMEMultipart()
-    message["From"] = from_email
-    message["To"] = to_email
-    message["Subject"] = subject
-
-    # Add body to email
-    message.attach(MIMEText(body, "plain"))
-
-    try:
-        # Create SMTP session
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()  # Enable TLS
-            server.login(smtp_username, smtp_password)
+def adjust_user_balance(user_id: str, delta: float) -> Optional[float]:
+    # 读取用户行和 ETag 后条件写入，并发的奖励和提现不会覆盖彼此的余额
+    # 返回新余额；用户不存在时抛出 ValueError，多次冲突后返回 None
+    for _ in range(OPTIMISTIC_ATTEMPTS):
+        rows = query_entities_with_etag(
+            TABLE_NAMES.REFUGEE,
+            f"PartitionKey eq '{user_id}' and RowKey eq '{user_id}'",
+        )
+        if not rows:
+            raise ValueError("User not found")
+        user_entity, etag = rows[0]
+        new_balance = float(user_entity.get("balance", 0)) + delta
+        if update_entity_if_match(
+            TABLE_NAMES.REFUGEE,
+            {
+                PARTITION_KEYS.PARKEY: user_entity[PARTITION_KEYS.PARKEY],
+                PARTITION_KEYS.ROWKEY: user_entity[PARTITION_KEYS.ROWKEY],
+                "balance": new_balance,
+                "updated_at": datetime.now().isoformat(),
+            },
+            etag,
+        ):
+            return new_balance
+    return None
 
-            # Send email
-            server.send_message(message)
 
-        print(f"Email sent successfully to {to_email}")
-    except Exception as e:
-        print(f"Failed to send email: {str(e)}")
-        raise
+# 发送email方法：写入发件箱后立即返回，由后台复用SMTP连接发送
+def send_email(to_email: str, subject: str, body: str) -> str:
+    outbox_id = enqueue_email(to_email, subject, body)
+    if outbox_id is None:
+        raise RuntimeError(f"Failed to queue email to {to_email}")
+    return outbox_id
 
 
 # 验证邮箱和密码
-def verify_enterprise_credentials(email: str, password: str) -> Optional[int]:
+async def verify_enterprise_credentials(email: str, password: str) -> Optional[int]:
     # 从数据库中获取企业数据
     enterprise = get_entity_by_field(TABLE_NAMES.ENTERPRISE, "email", email)
 
@@ -125,7 +133,18 @@ def verify_enterprise_credentials(email: str, password: str) -> Optional[int]:
         return None
 
     # 验证密码
-    verify_password = hashlib.md5(password.encode()).hexdigest() == stored_password_hash
-    if verify_password:
-        return int(enterprise.get("id"))
-    return None
+    verify_password, needs_rehash = await password_hasher.verify(
+        password, stored_password_hash
+    )
+    if not verify_password:
+        return None
+
+    # 旧的MD5哈希或旧参数的哈希在登录成功后升级
+    if needs_rehash:
+        update_entity_fields(
+            TABLE_NAMES.ENTERPRISE,
+            enterprise[PARTITION_KEYS.PARKEY],
+            enterprise[PARTITION_KEYS.ROWKEY],
+            {"password": await password_hasher.hash(password)},
+        )
+    return int(enterprise.get("id"))
@@ -0,0 +1,178 @@
+from typing import Callable, Dict, List, Tuple
+from app_logging import log_pipeline
+from bloom import existence_filters
+from email_outbox import email_worker
+from metrics import CallbackMetric, Labels, Registry
+from microcache import list_cache
+from passwords import password_hasher
+from single_flight import read_flight
+from tracing import trace_exporter
+
+# 把各组件 stats() 中的统计暴露为指标，抓取时读取
+# (指标名, 说明, stats 中的字段, 指标类型)
+MetricSpec = Tuple[str, str, str, str]
+
+MICROCACHE_METRICS: List[MetricSpec] = [
+    ("microcache_hits_total", "Fresh microcache hits.", "hits", "counter"),
+    (
+        "microcache_stale_hits_total",
+        "Stale microcache hits served while revalidating.",
+        "stale_hits",
+        "counter",
+    ),
+    ("microcache_misses_total", "Microcache misses.", "misses", "counter"),
+    (
+        "microcache_hit_ratio",
+        "Microcache hit ratio including stale hits.",
+        "hit_rate",
+        "gauge",
+    ),
+]
+BLOOM_METRICS: List[MetricSpec] = [
+    (
+        "bloom_negatives_total",
+        "Lookups answered as definitely absent without storage.",
+        "negatives",
+        "counter",
+    ),
+    (
+        "bloom_false_positives_total",
+        "Lookups the filter let through that found nothing.",
+        "false_positives",
+        "counter",
+    ),
+    (
+        "bloom_observed_false_positive_ratio",
+        "Observed false positive rate among absent values.",
+        "observed_fp_rate",
+        "gauge",
+    ),
+    ("bloom_memory_bytes", "Bloom filter bit array size.", "memory_bytes", "gauge"),
+    ("bloom_entries", "Distinct values added to the filter.", "entries", "gauge"),
+]
+READ_FLIGHT_METRICS: List[MetricSpec] = [
+    (
+        "storage_reads_executed_total",
+        "Storage reads actually executed.",
+        "executed",
+        "counter",
+    ),
+    (
+        "storage_reads_collapsed_total",
+        "Reads served by an identical in-flight read.",
+        "collapsed",
+        "counter",
+    ),
+    (
+        "storage_reads_collapse_ratio",
+        "Share of reads collapsed into another read.",
+        "collapse_ratio",
+        "gauge",
+    ),
+]
+PASSWORD_HASHER_METRICS: List[MetricSpec] = [
+    (
+        "password_hash_queue_depth",
+        "Password hashes waiting for a worker.",
+        "queue_depth",
+        "gauge",
+    ),
+    (
+        "password_hash_completed_total",
+        "Password hashes completed.",
+        "completed",
+        "counter",
+    ),
+    (
+        "password_hash_rejected_total",
+        "Password hashes rejected because the pool was overloaded.",
+        "rejected",
+        "counter",
+    ),
+]
+EMAIL_WORKER_METRICS: List[MetricSpec] = [
+    (
+        "email_outbox_queue_depth",
+        "Emails waiting in the outbox.",
+        "queue_depth",
+        "gauge",
+    ),
+    ("email_sent_total", "Emails sent.", "sent", "counter"),
+    ("email_failed_total", "Email send attempts that failed.", "failed", "counter"),
+    (
+        "email_dead_total",
+        "Emails given up after the maximum number of attempts.",
+        "dead",
+        "counter",
+    ),
+]
+TRACE_EXPORTER_METRICS: List[MetricSpec] = [
+    (
+        "traces_exported_total",
+        "Sampled traces written to the export file.",
+        "exported",
+        "counter",
+    ),
+    (
+        "traces_dropped_total",
+        "Sampled traces dropped because the queue was full or the write failed.",
+        "dropped",
+        "counter",
+    ),
+]
+LOG_PIPELINE_METRICS: List[MetricSpec] = [
+    ("log_queue_depth", "Log records waiting to be written.", "queue_depth", "gauge"),
+    (
+        "log_records_dropped_total",
+        "Log records dropped because the log queue was full.",
+        "dropped",
+        "counter",
+    ),
+]
+
+
+def _single(
+    stats: Callable[[], Dict[str, float]], key: str
+) -> Callable[[], Dict[Labels, float]]:
+    return lambda: {(): stats()[key]}
+
+
+def _keyed(
+    stats: Callable[[], Dict[str, Dict[str, float]]], key: str
+) -> Callable[[], Dict[Labels, float]]:
+    # 按 stats() 第一层的键作为标签，跳过以下划线开头的汇总项
+    return lambda: {
+        (name,): values[key]
+        for name, values in stats().items()
+        if not name.startswith("_")
+    }
+
+
+def register_component_metrics(registry: Registry) -> None:
+    for name, documentation, key, kind in MICROCACHE_METRICS:
+        registry.register(
+            CallbackMetric(
+                name, documentation, ("route",), _keyed(list_cache.stats, key), kind
+            )
+        )
+    for name, documentation, key, kind in BLOOM_METRICS:
+        registry.register(
+            CallbackMetric(
+                name,
+                documentation,
+                ("filter",),
+                _keyed(existence_filters.stats, key),
+                kind,
+            )
+        )
+    for stats, specs in (
+        (read_flight.stats, READ_FLIGHT_METRICS),
+        (password_hasher.stats, PASSWORD_HASHER_METRICS),
+        (email_worker.stats, EMAIL_WORKER_METRICS),
+        (trace_exporter.stats, TRACE_EXPORTER_METRICS),
+        (log_pipeline.stats, LOG_PIPELINE_METRICS),
+    ):
+        for name, documentation, key, kind in specs:
+            registry.register(
+                CallbackMetric(name, documentation, (), _single(stats, key), kind)
+            )
@@ -0,0 +1,129 @@
+import gzip
+from typing import List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # 未安装 brotli 时只支持 gzip
+    brotli = None
+
+COMPRESSION_MIN_BYTES = 1024  # 小于该大小的响应压缩收益不大，直接返回
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # 动态响应使用中等压缩级别，兼顾CPU与压缩率
+COMPRESSIBLE_TYPES = (
+    b"application/json",
+    b"application/msgpack",
+    b"text/",
+    b"application/javascript",
+)
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """按 Accept-Encoding 选择编码，q 值相同时优先 br。"""
+    offered = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        offered[name.strip()] = quality
+
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    best, best_quality = None, 0.0
+    for name in candidates:
+        quality = offered.get(name, offered.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def _encoded_etag(etag: bytes, encoding: str) -> bytes:
+    # 压缩后的表示与原始表示字节不同，强 ETag 需要区分
+    suffix = b"-gzip" if encoding == "gzip" else b"-br"
+    if etag.endswith(b'"'):
+        return etag[:-1] + suffix + b'"'
+    return etag + suffix
+
+
+class CompressionMiddleware:
+    """根据 Accept-Encoding 对较大的响应进行 br/gzip 压缩。"""
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        accept_encoding = ""
+        for name, value in scope.get("headers") or []:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        encoding = choose_encoding(accept_encoding) if accept_encoding else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        chunks: List[bytes] = []
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, passthrough
+            if passthrough:
+                await send(message)
+                return
+            if message["type"] == "http.response.start":
+                start_message = message
+                if not self._is_compressible(message.get("headers", [])):
+                    passthrough = True
+                    await send(message)
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            body = b"".join(chunks)
+            headers = [
+                (name, value)
+                for name, value in start_message.get("headers", [])
+                if name != b"content-length"
+            ]
+            if len(body) >= self.minimum_size:
+                body = compress(body, encoding)
+                headers = [
+                    (name, _encoded_etag(value, encoding) if name == b"etag" else value)
+                    for name, value in headers
+                ]
+                headers.append((b"content-encoding", encoding.encode()))
+            headers.append((b"vary", b"Accept-Encoding"))
+            headers.append((b"content-length", str(len(body)).encode()))
+            await send({**start_message, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
+
+    @staticmethod
+    def _is_compressible(headers: List[Tuple[bytes, bytes]]) -> bool:
+        content_type = b""
+        for name, value in headers:
+            if name == b"content-encoding":
+                return False
+            if name == b"content-type":
+                content_type = value
+        return content_type.startswith(COMPRESSIBLE_TYPES)
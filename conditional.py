@@ -0,0 +1,238 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Pattern, Tuple
+from tracing import span
+
+VALIDATOR_CACHE_SIZE = 10000  # 缓存的 ETag 数量上限
+# 其他实例上的写入不会通知本实例，缓存的 ETag 最多信任这么久，超过后仍需读取存储
+VALIDATOR_TTL_SECONDS = 5
+# 压缩中间件给压缩后的表示追加的后缀，比较时忽略
+ENCODING_SUFFIXES = ("-br", "-gzip")
+
+
+class CachePolicy:
+    def __init__(
+        self,
+        name: str,
+        pattern: str,
+        cache_control: str,
+        resource: Optional[str] = None,
+    ):
+        self.name = name
+        self.pattern: Pattern = re.compile(pattern)
+        self.cache_control = cache_control
+        # 资源键模板，例如 "task:{task_id}"；有资源键的接口可以在写入时精确失效
+        self.resource = resource
+
+    def resource_key(self, match) -> Optional[str]:
+        return self.resource.format(**match.groupdict()) if self.resource else None
+
+
+CACHE_POLICIES: List[CachePolicy] = [
+    CachePolicy(
+        "task",
+        r"/api/task/(?P<task_id>\d+)/(details|progress|feedback)",
+        "private, no-cache",
+        resource="task:{task_id}",
+    ),
+    CachePolicy("task-list", r"/api/task/(browse|mytasks|tasks)", "private, max-age=5"),
+    CachePolicy(
+        "reward",
+        r"/api/reward/(history|historys|withdraw-status|summary)",
+        "private, no-cache",
+    ),
+    CachePolicy("sync", r"/api/refugee/sync", "private, no-store"),
+]
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def _normalize_tag(tag: str) -> str:
+    tag = tag.strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    tag = tag.strip('"')
+    for suffix in ENCODING_SUFFIXES:
+        if tag.endswith(suffix):
+            return tag[: -len(suffix)]
+    return tag
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    expected = _normalize_tag(etag)
+    return any(_normalize_tag(tag) == expected for tag in if_none_match.split(","))
+
+
+class ValidatorCache:
+    """保存最近返回的 ETag，带 If-None-Match 的请求命中时直接返回304，不读取存储。"""
+
+    def __init__(self, max_size: int = VALIDATOR_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[str, float, Optional[str]]]" = (
+            OrderedDict()
+        )
+        self._by_resource: Dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            etag, expires_at, _ = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return None
+            return etag
+
+    def set(self, key: str, etag: str, resource: Optional[str]) -> None:
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (
+                etag,
+                time.monotonic() + VALIDATOR_TTL_SECONDS,
+                resource,
+            )
+            if resource:
+                self._by_resource.setdefault(resource, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, resource: str) -> None:
+        with self._lock:
+            for key in list(self._by_resource.pop(resource, ())):
+                self._entries.pop(key, None)
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry and entry[2]:
+            keys = self._by_resource.get(entry[2])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_resource[entry[2]]
+
+
+validator_cache = ValidatorCache()
+
+
+# 资源被修改后调用，使相关接口缓存的 ETag 失效
+def invalidate_resource(resource: str) -> None:
+    validator_cache.invalidate(resource)
+
+
+class ConditionalGetMiddleware:
+    """为配置的 GET 接口生成强 ETag、处理 If-None-Match 并设置 Cache-Control。"""
+
+    def __init__(
+        self,
+        app,
+        policies: Optional[List[CachePolicy]] = None,
+        cache: Optional[ValidatorCache] = None,
+    ):
+        self.app = app
+        self.policies = CACHE_POLICIES if policies is None else policies
+        self.cache = cache or validator_cache
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+        policy, match = self._match(scope["path"])
+        if policy is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        if_none_match = headers.get(b"if-none-match", b"").decode("latin-1")
+        resource = policy.resource_key(match)
+        cache_key = self._cache_key(scope, headers) if resource else None
+
+        if if_none_match and cache_key:
+            with span("cache.etag") as cache_span:
+                etag = self.cache.get(cache_key)
+                cache_span.set_attribute("cache.result", "hit" if etag else "miss")
+            if etag and etag_matches(if_none_match, etag):
+                await self._not_modified(send, etag, policy.cache_control, [])
+                return
+
+        start_message = None
+        chunks: List[bytes] = []
+
+        async def send_wrapper(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(chunks)
+            response_headers = list(start_message.get("headers", []))
+            if start_message["status"] != 200:
+                await send(start_message)
+                await send({"type": "http.response.body", "body": body})
+                return
+
+            etag = make_etag(body)
+            if cache_key:
+                self.cache.set(cache_key, etag, resource)
+            if if_none_match and etag_matches(if_none_match, etag):
+                vary = [(k, v) for k, v in response_headers if k == b"vary"]
+                await self._not_modified(send, etag, policy.cache_control, vary)
+                return
+            response_headers.append((b"etag", etag.encode()))
+            response_headers.append((b"cache-control", policy.cache_control.encode()))
+            await send({**start_message, "headers": response_headers})
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
+
+    def _match(self, path: str):
+        for policy in self.policies:
+            match = policy.pattern.fullmatch(path)
+            if match is not None:
+                return policy, match
+        return None, None
+
+    @staticmethod
+    def _cache_key(scope, headers: Dict[bytes, bytes]) -> str:
+        # 不同用户、不同响应格式的同一接口分别缓存
+        return hashlib.sha256(
+            b"\n".join(
+                [
+                    scope["path"].encode(),
+                    scope.get("query_string", b""),
+                    headers.get(b"authorization", b""),
+                    headers.get(b"accept", b""),
+                ]
+            )
+        ).hexdigest()
+
+    @staticmethod
+    async def _not_modified(
+        send, etag: str, cache_control: str, extra_headers: List[Tuple[bytes, bytes]]
+    ) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 304,
+                "headers": [
+                    (b"etag", etag.encode()),
+                    (b"cache-control", cache_control.encode()),
+                    *extra_headers,
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": b""})
@@ -1,9 +1,18 @@
 from azure.data.tables import TableServiceClient, TableClient
+from azure.core import MatchConditions
 from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
-from typing import Dict, Any, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from itertools import islice
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 import logging
 import configparser
 import os
+from bloom import bloom_lookup, bloom_write
+from metrics import observe_storage
+from query_budget import account_query, report_rows_read
+from single_flight import coalesce, invalidates
+from tracing import redact_filter, traced_storage
 
 # 配置日志记录
 # Azure SDK 日志级别包括：
@@ -17,6 +26,34 @@ import os
 # 这意味着只会记录 WARNING、ERROR 和 CRITICAL 级别的日志
 # 而 INFO 和 DEBUG 级别的日志将被忽略
 logging.getLogger("azure").setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+# Azure Table 的限制：单个过滤条件最多15个比较，单个事务最多100个操作
+MAX_FILTER_COMPARISONS = 15
+MAX_TRANSACTION_OPERATIONS = 100
+BATCH_MAX_WORKERS = 8  # 批量操作时并发请求的线程数
+MAX_RESULTS_PER_PAGE = 1000  # 服务端单页最多返回的行数
+# 条件写入失败的状态码：412 实体已被修改，409 要创建的实体已存在
+CONFLICT_STATUS_CODES = (409, 412)
+OPTIMISTIC_ATTEMPTS = 10  # 条件写入冲突后重新读取并重试的次数
+
+# 批量操作共用一个线程池，不在每次调用时创建、销毁线程
+_batch_executor = ThreadPoolExecutor(
+    max_workers=BATCH_MAX_WORKERS, thread_name_prefix="storage-batch"
+)
+
+
+class ConcurrentModification(Exception):
+    """条件事务中的实体在读取之后已被修改或创建，调用方应重新读取后重试。"""
+
+
+def is_conflict(error: BaseException) -> bool:
+    return getattr(error, "status_code", None) in CONFLICT_STATUS_CODES
+
+
+def if_not_modified(etag: str, **options: Any) -> Dict[str, Any]:
+    # 事务操作的参数：只在 ETag 仍然匹配时执行
+    return {**options, "etag": etag, "match_condition": MatchConditions.IfNotModified}
 
 
 class AzureTableStorage:
@@ -32,24 +69,28 @@ class AzureTableStorage:
     def create_table(self, table_name: str) -> None:
         try:
             self.table_service_client.create_table(table_name)
-            print(f"Table '{table_name}' created successfully.")
+            logger.info("Table created", extra={"table": table_name})
         except ResourceExistsError:
-            print(f"Table '{table_name}' already exists.")
+            logger.debug("Table already exists", extra={"table": table_name})
 
     def delete_table(self, table_name: str) -> None:
         try:
             self.table_service_client.delete_table(table_name)
-            print(f"Table '{table_name}' deleted successfully.")
+            logger.info("Table deleted", extra={"table": table_name})
         except ResourceNotFoundError:
-            print(f"Table '{table_name}' not found.")
+            logger.warning("Table not found", extra={"table": table_name})
 
+    @traced_storage
+    @invalidates
+    @bloom_write
+    @observe_storage
     def insert_entity(
         self, table_name: str, entity: Dict[str, Any]
     ) -> Optional[Dict[str, Any]]:
         table_client = self.table_service_client.get_table_client(table_name)
         try:
             created_entity = table_client.create_entity(entity)
-            print(f"Entity inserted successfully into table '{table_name}'.")
+            logger.debug("Entity inserted", extra={"table": table_name})
             # 获取新添加的数据
             partition_key = entity.get("PartitionKey")
             row_key = entity.get("RowKey")
@@ -59,25 +100,79 @@ class AzureTableStorage:
             else:
                 return dict(created_entity)
         except Exception as e:
-            print(f"Error inserting entity into table '{table_name}': {str(e)}")
+            logger.error("Error inserting entity: %s", e, extra={"table": table_name})
             return None
 
+    @traced_storage
+    @invalidates
+    @bloom_write
+    @observe_storage
     def update_entity(self, table_name: str, entity: Dict[str, Any]) -> None:
         table_client = self.table_service_client.get_table_client(table_name)
         try:
             table_client.update_entity(mode="merge", entity=entity)
-            print(f"Entity updated successfully in table '{table_name}'.")
+            logger.debug("Entity updated", extra={"table": table_name})
         except Exception as e:
-            print(f"Error updating entity in table '{table_name}': {str(e)}")
+            logger.error("Error updating entity: %s", e, extra={"table": table_name})
+
+    @traced_storage
+    @invalidates
+    @bloom_write
+    @observe_storage
+    def update_entity_if_match(
+        self, table_name: str, entity: Dict[str, Any], etag: str
+    ) -> Optional[str]:
+        # 乐观并发：成功时返回新的 ETag，供调用方继续条件写入；
+        # 实体在读取之后被修改或删除时返回 None，由调用方重新读取或放弃
+        table_client = self.table_service_client.get_table_client(table_name)
+        try:
+            metadata = table_client.update_entity(
+                mode="merge",
+                entity=entity,
+                etag=etag,
+                match_condition=MatchConditions.IfNotModified,
+            )
+            return metadata["etag"]
+        except ResourceNotFoundError:
+            return None
+        except Exception as e:
+            if not is_conflict(e):
+                logger.error(
+                    "Error updating entity: %s", e, extra={"table": table_name}
+                )
+            return None
 
+    @traced_storage
+    @invalidates
+    @observe_storage
     def delete_entity(self, table_name: str, partition_key: str, row_key: str) -> None:
         table_client = self.table_service_client.get_table_client(table_name)
         try:
             table_client.delete_entity(partition_key, row_key)
-            print(f"Entity deleted successfully from table '{table_name}'.")
+            logger.debug("Entity deleted", extra={"table": table_name})
+        except ResourceNotFoundError:
+            logger.debug("Entity to delete not found", extra={"table": table_name})
+
+    @traced_storage
+    @account_query
+    @coalesce
+    @observe_storage
+    def get_entity(
+        self, table_name: str, partition_key: str, row_key: str
+    ) -> Optional[Dict[str, Any]]:
+        table_client = self.table_service_client.get_table_client(table_name)
+        try:
+            return dict(table_client.get_entity(partition_key, row_key))
         except ResourceNotFoundError:
-            print(f"Entity not found in table '{table_name}'.")
+            return None
+        except Exception as e:
+            logger.error("Error getting entity: %s", e, extra={"table": table_name})
+            return None
 
+    @traced_storage
+    @account_query
+    @coalesce
+    @observe_storage
     def query_entities(
         self, table_name: str, filter_query: Optional[str] = None
     ) -> List[Dict[str, Any]]:
@@ -86,14 +181,180 @@ class AzureTableStorage:
             entities = table_client.query_entities(filter_query)
             return [dict(entity) for entity in entities]
         except Exception as e:
-            print(f"Error querying entities from table '{table_name}': {str(e)}")
+            logger.error("Error querying entities: %s", e, extra={"table": table_name})
             return []
 
+    @traced_storage
+    @account_query
+    @coalesce
+    @observe_storage
+    def query_entities_page(
+        self, table_name: str, filter_query: Optional[str], page_size: int
+    ) -> List[Dict[str, Any]]:
+        table_client = self.table_service_client.get_table_client(table_name)
+        try:
+            # 按 PartitionKey/RowKey 顺序读取前 page_size 行。服务端单页最多1000行，
+            # 也可能提前返回不满的一页，迭代时会跟随续传令牌继续读取
+            entities = table_client.query_entities(
+                filter_query, results_per_page=min(page_size, MAX_RESULTS_PER_PAGE)
+            )
+            return [dict(entity) for entity in islice(entities, page_size)]
+        except Exception as e:
+            logger.error(
+                "Error querying entity page: %s", e, extra={"table": table_name}
+            )
+            return []
+
+    @traced_storage
+    @account_query
+    @observe_storage
+    def query_entities_with_etag(
+        self, table_name: str, filter_query: Optional[str] = None
+    ) -> List[Tuple[Dict[str, Any], str]]:
+        # 返回 (实体, ETag)，供条件写入使用；读取失败时抛出异常
+        table_client = self.table_service_client.get_table_client(table_name)
+        return [
+            (dict(entity), entity.metadata["etag"])
+            for entity in table_client.query_entities(filter_query)
+        ]
+
+    @traced_storage
+    @account_query
+    @observe_storage
+    def iter_entities(
+        self,
+        table_name: str,
+        filter_query: Optional[str] = None,
+        select: Optional[List[str]] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        # 流式遍历，按页从存储读取，不会一次性加载整张表；select 只读取需要的字段
+        table_client = self.table_service_client.get_table_client(table_name)
+        if filter_query:
+            entities = table_client.query_entities(filter_query, select=select)
+        else:
+            entities = table_client.list_entities(select=select)
+        for entity in entities:
+            yield dict(entity)
+
+    @traced_storage
+    @invalidates
+    @bloom_write
+    @observe_storage
+    def submit_transaction(
+        self, table_name: str, operations: List[Tuple[Any, ...]]
+    ) -> bool:
+        # 同一个 PartitionKey 下的批量操作，要么全部成功要么全部失败
+        table_client = self.table_service_client.get_table_client(table_name)
+        try:
+            table_client.submit_transaction(operations)
+            return True
+        except Exception as e:
+            logger.error(
+                "Error submitting transaction: %s", e, extra={"table": table_name}
+            )
+            return False
+
+    @traced_storage
+    @invalidates
+    @bloom_write
+    @observe_storage
+    def submit_conditional_transaction(
+        self, table_name: str, operations: List[Tuple[Any, ...]]
+    ) -> bool:
+        # 与 submit_transaction 相同，但条件不满足时抛出 ConcurrentModification
+        table_client = self.table_service_client.get_table_client(table_name)
+        try:
+            table_client.submit_transaction(operations)
+            return True
+        except Exception as e:
+            if is_conflict(e):
+                raise ConcurrentModification(str(e)) from e
+            logger.error(
+                "Error submitting transaction: %s", e, extra={"table": table_name}
+            )
+            return False
+
+    @traced_storage
+    def get_entities_by_field_values(
+        self, table_name: str, field_name: str, field_values: List[Any]
+    ) -> List[Dict[str, Any]]:
+        # Azure Table 单个过滤条件最多包含15个比较，按块组合成 OR 查询并发执行。
+        # 任一块查询失败时抛出异常，调用方不能把存储故障当作实体不存在
+        chunks = [
+            field_values[i : i + MAX_FILTER_COMPARISONS]
+            for i in range(0, len(field_values), MAX_FILTER_COMPARISONS)
+        ]
+
+        def query_chunk(values: List[Any]) -> List[Dict[str, Any]]:
+            filter_query = " or ".join(
+                f"{field_name} eq {value}"
+                if isinstance(value, (int, float))
+                else f"{field_name} eq '{value}'"
+                for value in values
+            )
+            return list(self.iter_entities(table_name, filter_query))
+
+        # 每个线程在调用方上下文的副本中执行，查询计入当前请求的 trace 和查询预算
+        contexts = [copy_context() for _ in chunks]
+        results = _batch_executor.map(
+            lambda context, chunk: context.run(query_chunk, chunk),
+            contexts,
+            chunks,
+        )
+        return [entity for chunk in results for entity in chunk]
+
+    @traced_storage
+    @invalidates
+    @bloom_write
+    def batch_update_entities(
+        self, table_name: str, entities: List[Dict[str, Any]]
+    ) -> Dict[Tuple[str, str], bool]:
+        # 按 PartitionKey 分组，每组按事务上限切块；不同分区的事务并发提交
+        chunks = []
+        partitions: Dict[str, List[Dict[str, Any]]] = {}
+        for entity in entities:
+            partitions.setdefault(entity["PartitionKey"], []).append(entity)
+        for partition_entities in partitions.values():
+            for i in range(0, len(partition_entities), MAX_TRANSACTION_OPERATIONS):
+                chunks.append(partition_entities[i : i + MAX_TRANSACTION_OPERATIONS])
+
+        def update_chunk(chunk: List[Dict[str, Any]]) -> Dict[Tuple[str, str], bool]:
+            operations = [("update", entity, {"mode": "merge"}) for entity in chunk]
+            if self.submit_transaction(table_name, operations):
+                return {(e["PartitionKey"], e["RowKey"]): True for e in chunk}
+            # 事务失败时逐条更新，找出具体失败的实体
+            results = {}
+            table_client = self.table_service_client.get_table_client(table_name)
+            for entity in chunk:
+                try:
+                    table_client.update_entity(mode="merge", entity=entity)
+                    results[(entity["PartitionKey"], entity["RowKey"])] = True
+                except Exception as e:
+                    logger.error(
+                        "Error updating entity: %s", e, extra={"table": table_name}
+                    )
+                    results[(entity["PartitionKey"], entity["RowKey"])] = False
+            return results
+
+        results: Dict[Tuple[str, str], bool] = {}
+        contexts = [copy_context() for _ in chunks]
+        for chunk_results in _batch_executor.map(
+            lambda context, chunk: context.run(update_chunk, chunk),
+            contexts,
+            chunks,
+        ):
+            results.update(chunk_results)
+        return results
+
+    @traced_storage
+    @account_query
+    @observe_storage
     def get_latest_id_by_partition(self, table_name: str, partition_key: str) -> int:
         table_client = self.table_service_client.get_table_client(table_name)
         try:
             entities = table_client.query_entities("")
             entities_list = list(entities)
+            report_rows_read(len(entities_list))
 
             if entities_list:
                 # 找出最大的user_id
@@ -107,6 +368,11 @@ class AzureTableStorage:
         except Exception as e:
             return 1
 
+    @traced_storage
+    @bloom_lookup(missing=False)
+    @account_query
+    @coalesce
+    @observe_storage
     def check_field_exists(
         self, table_name: str, field_name: str, field_value: Any
     ) -> bool:
@@ -121,9 +387,16 @@ class AzureTableStorage:
             # 检查是否有匹配的实体
             return any(entities)
         except Exception as e:
-            print(f"Error checking field existence in table '{table_name}': {str(e)}")
+            logger.error(
+                "Error checking field existence: %s", e, extra={"table": table_name}
+            )
             return False
 
+    @traced_storage
+    @bloom_lookup(missing=None)
+    @account_query
+    @coalesce
+    @observe_storage
     def get_entity_by_field(
         self, table_name: str, field_name: str, field_value: Any
     ) -> Optional[Dict[str, Any]]:
@@ -146,9 +419,15 @@ class AzureTableStorage:
             else:
                 return None
         except Exception as e:
-            print(f"Error getting entity by field from table '{table_name}': {str(e)}")
+            logger.error(
+                "Error getting entity by field: %s", e, extra={"table": table_name}
+            )
             return None
 
+    @traced_storage
+    @invalidates
+    @bloom_write
+    @observe_storage
     def update_entity_fields(
         self,
         table_name: str,
@@ -172,9 +451,15 @@ class AzureTableStorage:
 
             return True
         except Exception as e:
-            print(f"Error updating entity fields in table '{table_name}': {str(e)}")
+            logger.error(
+                "Error updating entity fields: %s", e, extra={"table": table_name}
+            )
             return False
 
+    @traced_storage
+    @account_query
+    @coalesce
+    @observe_storage
     def get_all_entities(
         self, table_name: str, page: int = 1, page_size: int = 10, **search_params
     ) -> Tuple[List[Dict[str, Any]], int]:
@@ -197,7 +482,11 @@ class AzureTableStorage:
                         filter_query.append(f"{key} eq {str(value).lower()}")
 
             filter_string = " and ".join(filter_query) if filter_query else None
-            print(filter_string)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Listing entities",
+                    extra={"table": table_name, "filter": redact_filter(filter_string)},
+                )
             # 获取符合条件的实体
             if filter_string:
                 entities = list(table_client.query_entities(filter_string))
@@ -219,7 +508,7 @@ class AzureTableStorage:
 
             return result, total_count
         except Exception as e:
-            print(f"Error getting entities from table '{table_name}': {str(e)}")
+            logger.error("Error getting entities: %s", e, extra={"table": table_name})
             return [], 0
 
 
@@ -233,8 +522,17 @@ create_table = azure_storage.create_table
 delete_table = azure_storage.delete_table
 insert_entity = azure_storage.insert_entity
 update_entity = azure_storage.update_entity
+update_entity_if_match = azure_storage.update_entity_if_match
 delete_entity = azure_storage.delete_entity
+get_entity = azure_storage.get_entity
 query_entities = azure_storage.query_entities
+query_entities_page = azure_storage.query_entities_page
+query_entities_with_etag = azure_storage.query_entities_with_etag
+iter_entities = azure_storage.iter_entities
+submit_transaction = azure_storage.submit_transaction
+submit_conditional_transaction = azure_storage.submit_conditional_transaction
+get_entities_by_field_values = azure_storage.get_entities_by_field_values
+batch_update_entities = azure_storage.batch_update_entities
 get_latest_id_by_partition = azure_storage.get_latest_id_by_partition
 check_field_exists = azure_storage.check_field_exists
 get_entity_by_field = azure_storage.get_entity_by_field
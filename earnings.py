@@ -0,0 +1,258 @@
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+from database import (
+    MAX_TRANSACTION_OPERATIONS,
+    OPTIMISTIC_ATTEMPTS,
+    ConcurrentModification,
+    get_entity,
+    get_entity_by_field,
+    if_not_modified,
+    iter_entities,
+    query_entities,
+    query_entities_with_etag,
+    submit_conditional_transaction,
+)
+from schemas import PARTITION_KEYS, TABLE_NAMES, EarningsSummaryResponse
+
+logger = logging.getLogger(__name__)
+
+# 每个用户一个分区，每个统计维度一行，写入奖励时增量更新。
+# 统计行都带 ETag 条件写入，并发的奖励或重建不会覆盖彼此的结果，冲突时重新读取后重试
+LIFETIME_ROW_KEY = "lifetime"
+
+
+def _to_datetime(value: Any) -> datetime:
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    return datetime.fromisoformat(str(value))
+
+
+def day_key(moment: datetime) -> str:
+    return f"day:{moment:%Y-%m-%d}"
+
+
+def week_key(moment: datetime) -> str:
+    year, week, _ = moment.isocalendar()
+    return f"week:{year}-W{week:02d}"
+
+
+def month_key(moment: datetime) -> str:
+    return f"month:{moment:%Y-%m}"
+
+
+def type_key(task_type: str) -> str:
+    return f"type:{task_type}"
+
+
+def aggregate_row_keys(created_at: datetime, task_type: Optional[str]) -> List[str]:
+    row_keys = [
+        LIFETIME_ROW_KEY,
+        day_key(created_at),
+        week_key(created_at),
+        month_key(created_at),
+    ]
+    if task_type:
+        row_keys.append(type_key(task_type))
+    return row_keys
+
+
+def _read_aggregates(
+    filter_query: Optional[str],
+) -> Dict[Tuple[str, str], Tuple[Dict[str, Any], str]]:
+    # 一次查询取回所需的统计行和 ETag
+    # 读取失败时直接抛出异常，避免在空数据上累加覆盖已有统计
+    return {
+        (entity[PARTITION_KEYS.PARKEY], entity[PARTITION_KEYS.ROWKEY]): (entity, etag)
+        for entity, etag in query_entities_with_etag(
+            TABLE_NAMES.EARNINGS_AGGREGATE, filter_query
+        )
+    }
+
+
+def _write_operation(
+    existing: Optional[Tuple[Dict[str, Any], str]], entity: Dict[str, Any]
+) -> Tuple[Any, ...]:
+    # 已有的行只在读取之后未被修改时覆盖，不存在的行用 create，被并发创建时同样冲突
+    if existing is None:
+        return ("create", entity)
+    return ("update", entity, if_not_modified(existing[1], mode="replace"))
+
+
+# 写入奖励记录后调用，更新该用户的各项累计收入
+def record_reward(
+    user_id: Any, amount: float, task_type: Optional[str], created_at: Any
+) -> bool:
+    created_at = _to_datetime(created_at)
+    row_keys = aggregate_row_keys(created_at, task_type)
+    partition_key = str(user_id)
+    row_filter = " or ".join(f"RowKey eq '{row_key}'" for row_key in row_keys)
+    for _ in range(OPTIMISTIC_ATTEMPTS):
+        try:
+            existing = _read_aggregates(
+                f"PartitionKey eq '{partition_key}' and ({row_filter})"
+            )
+        except Exception as e:
+            logger.error(
+                "Error reading earnings aggregates for user '%s': %s", user_id, e
+            )
+            return False
+        now = datetime.now().isoformat()
+
+        operations = []
+        for row_key in row_keys:
+            current = existing.get((partition_key, row_key))
+            current_entity = current[0] if current else {}
+            entity = {
+                PARTITION_KEYS.PARKEY: partition_key,
+                PARTITION_KEYS.ROWKEY: row_key,
+                "amount": float(current_entity.get("amount", 0)) + float(amount),
+                "count": int(current_entity.get("count", 0)) + 1,
+                "updated_at": now,
+            }
+            operations.append(_write_operation(current, entity))
+        try:
+            return submit_conditional_transaction(
+                TABLE_NAMES.EARNINGS_AGGREGATE, operations
+            )
+        except ConcurrentModification:
+            continue
+    logger.error("Earnings aggregates for user '%s' kept conflicting", user_id)
+    return False
+
+
+def get_lifetime_earnings(user_id: Any) -> float:
+    entity = get_entity(TABLE_NAMES.EARNINGS_AGGREGATE, str(user_id), LIFETIME_ROW_KEY)
+    return float(entity.get("amount", 0)) if entity else 0.0
+
+
+def get_earnings_summary(
+    user_id: Any, now: Optional[datetime] = None
+) -> EarningsSummaryResponse:
+    now = now or datetime.now()
+    period_keys = [LIFETIME_ROW_KEY, day_key(now), week_key(now), month_key(now)]
+    # 本期统计行与按任务类型统计行在同一个分区内，一次查询取回
+    row_filter = " or ".join(f"RowKey eq '{row_key}'" for row_key in period_keys)
+    entities = query_entities(
+        TABLE_NAMES.EARNINGS_AGGREGATE,
+        f"PartitionKey eq '{user_id}' and "
+        f"({row_filter} or (RowKey ge 'type:' and RowKey lt 'type;'))",
+    )
+    by_row_key = {entity[PARTITION_KEYS.ROWKEY]: entity for entity in entities}
+
+    def amount(row_key: str) -> float:
+        return float(by_row_key.get(row_key, {}).get("amount", 0))
+
+    return EarningsSummaryResponse(
+        lifetime_earnings=amount(period_keys[0]),
+        today_earnings=amount(period_keys[1]),
+        week_earnings=amount(period_keys[2]),
+        month_earnings=amount(period_keys[3]),
+        reward_count=int(by_row_key.get(LIFETIME_ROW_KEY, {}).get("count", 0)),
+        earnings_by_task_type={
+            row_key[len("type:") :]: float(entity.get("amount", 0))
+            for row_key, entity in by_row_key.items()
+            if row_key.startswith("type:")
+        },
+    )
+
+
+# 根据 RewardHistory 表重新计算累计收入，每次只处理一个用户分区。
+# 写入的是重新计算的绝对值，事务分块中途失败或重复运行都会收敛到正确结果；
+# 先读取统计行的 ETag 再扫描奖励记录，扫描期间有奖励写入时冲突，重新计算该用户。
+def rebuild_earnings_aggregates(user_id: Optional[Any] = None) -> int:
+    """返回重新计算的用户数。"""
+    if user_id is not None:
+        return int(_rebuild_user(str(user_id), {}))
+
+    # 有奖励记录的用户，以及只剩统计行的用户（需要删除）
+    partition_keys = {
+        str(reward.get("user_id"))
+        for reward in iter_entities(
+            TABLE_NAMES.REWARD_HISTORY,
+            f"PartitionKey eq '{TABLE_NAMES.REWARD_HISTORY}'",
+            ["user_id"],
+        )
+    }
+    partition_keys.update(
+        row[PARTITION_KEYS.PARKEY]
+        for row in iter_entities(
+            TABLE_NAMES.EARNINGS_AGGREGATE, None, [PARTITION_KEYS.PARKEY]
+        )
+    )
+    task_types: Dict[Any, Optional[str]] = {}
+    return sum(
+        _rebuild_user(partition_key, task_types)
+        for partition_key in sorted(partition_keys)
+    )
+
+
+def _user_totals(
+    partition_key: str, task_types: Dict[Any, Optional[str]]
+) -> Dict[str, List[float]]:
+    totals: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0])
+    if not partition_key.isdigit():
+        return totals
+    for reward in iter_entities(
+        TABLE_NAMES.REWARD_HISTORY,
+        f"PartitionKey eq '{TABLE_NAMES.REWARD_HISTORY}' "
+        f"and user_id eq {int(partition_key)}",
+    ):
+        task_type = reward.get("task_type")
+        if not task_type:
+            # 早期的奖励记录没有保存任务类型，按任务ID回查一次并缓存
+            task_id = reward.get("task_id")
+            if task_id not in task_types:
+                task = get_entity_by_field(TABLE_NAMES.TASK, "id", task_id)
+                task_types[task_id] = task.get("type") if task else None
+            task_type = task_types[task_id]
+
+        created_at = _to_datetime(reward.get("created_at"))
+        for row_key in aggregate_row_keys(created_at, task_type):
+            totals[row_key][0] += float(reward.get("amount", 0))
+            totals[row_key][1] += 1
+    return totals
+
+
+def _rebuild_user(partition_key: str, task_types: Dict[Any, Optional[str]]) -> bool:
+    for _ in range(OPTIMISTIC_ATTEMPTS):
+        existing = _read_aggregates(f"PartitionKey eq '{partition_key}'")
+        totals = _user_totals(partition_key, task_types)
+        now = datetime.now().isoformat()
+        # 删除已不存在对应奖励记录的统计行，用户没有任何奖励时整个分区被清空
+        operations = [
+            ("delete", entity, if_not_modified(etag))
+            for (_, row_key), (entity, etag) in existing.items()
+            if row_key not in totals
+        ]
+        operations += [
+            _write_operation(
+                existing.get((partition_key, row_key)),
+                {
+                    PARTITION_KEYS.PARKEY: partition_key,
+                    PARTITION_KEYS.ROWKEY: row_key,
+                    "amount": amount,
+                    "count": count,
+                    "updated_at": now,
+                },
+            )
+            for row_key, (amount, count) in totals.items()
+        ]
+        try:
+            for i in range(0, len(operations), MAX_TRANSACTION_OPERATIONS):
+                # 其他错误已记录日志，已写入的分块在下次重建时被覆盖
+                if not submit_conditional_transaction(
+                    TABLE_NAMES.EARNINGS_AGGREGATE,
+                    operations[i : i + MAX_TRANSACTION_OPERATIONS],
+                ):
+                    return False
+            return True
+        except ConcurrentModification:
+            continue
+    logger.error("Earnings aggregates for user '%s' kept conflicting", partition_key)
+    return False
+
+
+if __name__ == "__main__":
+    rebuild_earnings_aggregates()
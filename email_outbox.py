@@ -0,0 +1,388 @@
+import asyncio
+import logging
+import queue
+import random
+import smtplib
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Any, Dict, List, Optional, Tuple
+from database import (
+    delete_entity,
+    insert_entity,
+    query_entities_with_etag,
+    update_entity_if_match,
+)
+from schemas import PARTITION_KEYS, TABLE_NAMES
+
+logger = logging.getLogger(__name__)
+
+# Email configuration
+SMTP_SERVER = "smtp.example.com"  # Replace with your SMTP server
+SMTP_PORT = 587  # Replace with your SMTP port
+SMTP_USERNAME = "your_username"  # Replace with your SMTP username
+SMTP_PASSWORD = "your_password"  # Replace with your SMTP password
+SMTP_STARTTLS = True
+FROM_EMAIL = "noreply@yourcompany.com"  # Replace with your sender email
+
+# 发件箱配置
+EMAIL_SMTP_POOL_SIZE = 2  # 保持的SMTP连接数，同时也是并发发送的线程数
+EMAIL_SMTP_IDLE_SECONDS = 60  # 连接空闲超过该时间后关闭
+EMAIL_BATCH_SIZE = 20  # 单个连接上一次连续发送的邮件数
+EMAIL_MAX_ATTEMPTS = 5
+EMAIL_RETRY_BASE_SECONDS = 10
+EMAIL_RETRY_MAX_SECONDS = 1800
+EMAIL_POLL_INTERVAL_SECONDS = 5
+EMAIL_SMTP_TIMEOUT_SECONDS = 10
+# 认领邮件后的租约时长，多个实例不会重复发送同一封邮件；需要大于一批邮件的发送时间
+EMAIL_LEASE_SECONDS = 300
+# 待发送的邮件在以表名为分区键的分区中，进入死信的邮件移到单独的分区，不再被扫描
+EMAIL_DEAD_PARTITION = "dead"
+
+
+class EmailStatus:
+    PENDING = "pending"
+    DEAD = "dead"
+
+
+def build_message(to_email: str, subject: str, body: str) -> MIMEMultipart:
+    message = MIMEMultipart()
+    message["From"] = FROM_EMAIL
+    message["To"] = to_email
+    message["Subject"] = subject
+    message.attach(MIMEText(body, "plain"))
+    return message
+
+
+class SmtpConnectionPool:
+    """复用已登录的SMTP连接，避免每封邮件都重新建立连接、STARTTLS和登录。"""
+
+    def __init__(
+        self,
+        host: str = SMTP_SERVER,
+        port: int = SMTP_PORT,
+        username: str = SMTP_USERNAME,
+        password: str = SMTP_PASSWORD,
+        starttls: bool = SMTP_STARTTLS,
+        size: int = EMAIL_SMTP_POOL_SIZE,
+        idle_seconds: float = EMAIL_SMTP_IDLE_SECONDS,
+    ):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.size = size
+        self.idle_seconds = idle_seconds
+        self.connections_opened = 0
+        # 池中保存 (连接, 最后使用时间)，None 表示尚未建立连接的空位
+        self._pool: "queue.Queue" = queue.Queue()
+        for _ in range(size):
+            self._pool.put(None)
+
+    def _connect(self) -> smtplib.SMTP:
+        server = smtplib.SMTP(self.host, self.port, timeout=EMAIL_SMTP_TIMEOUT_SECONDS)
+        if self.starttls:
+            server.starttls()
+        if self.username:
+            server.login(self.username, self.password)
+        self.connections_opened += 1
+        return server
+
+    @staticmethod
+    def _close(server: Optional[smtplib.SMTP]) -> None:
+        if server is None:
+            return
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def _checkout(self) -> smtplib.SMTP:
+        slot = self._pool.get()
+        if slot is not None:
+            server, last_used = slot
+            if time.monotonic() - last_used < self.idle_seconds:
+                try:
+                    if server.noop()[0] == 250:
+                        return server
+                except smtplib.SMTPException:
+                    pass
+                except OSError:
+                    pass
+            self._close(server)
+        try:
+            return self._connect()
+        except Exception:
+            self._pool.put(None)
+            raise
+
+    def send_batch(self, messages: List[MIMEMultipart]) -> List[Optional[str]]:
+        """在同一个连接上依次发送，返回每封邮件的错误信息（成功为 None）。"""
+        errors: List[Optional[str]] = []
+        server = self._checkout()
+        try:
+            for message in messages:
+                try:
+                    server.send_message(message)
+                    errors.append(None)
+                except smtplib.SMTPRecipientsRefused as e:
+                    errors.append(str(e))
+                except smtplib.SMTPException as e:
+                    errors.append(str(e))
+                    if isinstance(e, smtplib.SMTPServerDisconnected):
+                        raise
+        except Exception as e:
+            # 连接已不可用，剩余邮件全部标记失败并丢弃该连接
+            errors.extend([str(e)] * (len(messages) - len(errors)))
+            self._close(server)
+            self._pool.put(None)
+            return errors
+        self._pool.put((server, time.monotonic()))
+        return errors
+
+    def close(self) -> None:
+        while not self._pool.empty():
+            slot = self._pool.get_nowait()
+            if slot is not None:
+                self._close(slot[0])
+
+
+# 将邮件写入发件箱，立即返回，由后台发送
+def enqueue_email(to_email: str, subject: str, body: str) -> Optional[str]:
+    now = datetime.now().isoformat()
+    row_key = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+    entity = {
+        PARTITION_KEYS.PARKEY: TABLE_NAMES.EMAIL_OUTBOX,
+        PARTITION_KEYS.ROWKEY: row_key,
+        "to_email": to_email,
+        "subject": subject,
+        "body": body,
+        "status": EmailStatus.PENDING,
+        "attempts": 0,
+        "next_attempt_at": now,
+        "locked_until": "",
+        "last_error": "",
+        "created_at": now,
+    }
+    if not insert_entity(TABLE_NAMES.EMAIL_OUTBOX, entity):
+        return None
+    email_worker.notify()
+    return row_key
+
+
+class EmailWorker:
+    """后台读取发件箱并通过连接池批量发送，失败按指数退避重试。"""
+
+    def __init__(
+        self,
+        pool: Optional[SmtpConnectionPool] = None,
+        batch_size: int = EMAIL_BATCH_SIZE,
+        max_attempts: int = EMAIL_MAX_ATTEMPTS,
+        poll_interval: float = EMAIL_POLL_INTERVAL_SECONDS,
+    ):
+        self.pool = pool or SmtpConnectionPool()
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._scan_lock: Optional[asyncio.Lock] = None
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._queue_depth = 0
+        self._sent = 0
+        self._failed = 0
+        self._dead = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def notify(self) -> None:
+        if self._wakeup is not None and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        self._stopping = False
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._scan_lock = asyncio.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.pool.size,
+            thread_name_prefix="smtp",
+        )
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        # wait_for 在事件被同时触发时可能吞掉取消，因此额外设置停止标志
+        self._stopping = True
+        if self._task is not None:
+            self._wakeup.set()
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.pool.close()
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                self._wakeup.clear()
+                await self.process_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error processing email outbox: {str(e)}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_due(self) -> int:
+        # 同一时间只有一次扫描，避免同一封邮件被重复发送
+        async with self._scan_lock:
+            return await self._process_due()
+
+    async def _process_due(self) -> int:
+        loop = asyncio.get_running_loop()
+        rows = await loop.run_in_executor(None, self._claim_due)
+        batches = [
+            rows[i : i + self.batch_size] for i in range(0, len(rows), self.batch_size)
+        ]
+        await asyncio.gather(
+            *[loop.run_in_executor(self._executor, self._send_rows, batch) for batch in batches]
+        )
+        return len(rows)
+
+    def _claim_due(self) -> List[Tuple[Dict[str, Any], str]]:
+        # 用 ETag 条件写入 locked_until 认领到期邮件，只发送认领成功的，
+        # 其他实例已认领或同时认领的邮件会被跳过；返回 (邮件, 认领后的 ETag)
+        now = datetime.now()
+        rows = query_entities_with_etag(
+            TABLE_NAMES.EMAIL_OUTBOX,
+            f"PartitionKey eq '{TABLE_NAMES.EMAIL_OUTBOX}' "
+            f"and status eq '{EmailStatus.PENDING}' "
+            f"and next_attempt_at le '{now.isoformat()}'",
+        )
+        # 保留最近一次扫描到的待发送数量，指标在两次扫描之间不会归零
+        with self._lock:
+            self._queue_depth = len(rows)
+        locked_until = (now + timedelta(seconds=EMAIL_LEASE_SECONDS)).isoformat()
+        claimed = []
+        for row, etag in sorted(rows, key=lambda r: r[0][PARTITION_KEYS.ROWKEY]):
+            if (row.get("locked_until") or "") > now.isoformat():
+                continue
+            claimed_etag = update_entity_if_match(
+                TABLE_NAMES.EMAIL_OUTBOX,
+                {
+                    PARTITION_KEYS.PARKEY: row[PARTITION_KEYS.PARKEY],
+                    PARTITION_KEYS.ROWKEY: row[PARTITION_KEYS.ROWKEY],
+                    "locked_until": locked_until,
+                },
+                etag,
+            )
+            if claimed_etag:
+                claimed.append((row, claimed_etag))
+        return claimed
+
+    def _send_rows(self, rows: List[Tuple[Dict[str, Any], str]]) -> None:
+        messages = [
+            build_message(row["to_email"], row["subject"], row["body"])
+            for row, _ in rows
+        ]
+        started = time.perf_counter()
+        try:
+            errors = self.pool.send_batch(messages)
+        except Exception as e:
+            errors = [str(e)] * len(rows)
+        elapsed = (time.perf_counter() - started) / max(len(rows), 1)
+
+        for (row, etag), error in zip(rows, errors):
+            if error is None:
+                delete_entity(
+                    TABLE_NAMES.EMAIL_OUTBOX,
+                    row[PARTITION_KEYS.PARKEY],
+                    row[PARTITION_KEYS.ROWKEY],
+                )
+                self._record(sent=True, latency=elapsed)
+            else:
+                self._retry(row, etag, error)
+                self._record(sent=False, latency=elapsed)
+
+    def _retry(self, row: Dict[str, Any], etag: str, error: str) -> None:
+        attempts = int(row.get("attempts", 0)) + 1
+        fields = {"attempts": attempts, "locked_until": "", "last_error": error[:1024]}
+        dead = attempts >= self.max_attempts
+        if dead:
+            fields["status"] = EmailStatus.DEAD
+        else:
+            delay = min(
+                EMAIL_RETRY_BASE_SECONDS * (2 ** (attempts - 1)), EMAIL_RETRY_MAX_SECONDS
+            ) * random.uniform(0.8, 1.2)
+            fields["next_attempt_at"] = (
+                datetime.now() + timedelta(seconds=delay)
+            ).isoformat()
+        # 带认领时的 ETag 写入：租约过期后邮件可能已被其他实例认领，此时不再覆盖
+        if not update_entity_if_match(
+            TABLE_NAMES.EMAIL_OUTBOX,
+            {
+                PARTITION_KEYS.PARKEY: row[PARTITION_KEYS.PARKEY],
+                PARTITION_KEYS.ROWKEY: row[PARTITION_KEYS.ROWKEY],
+                **fields,
+            },
+            etag,
+        ):
+            logger.warning(f"Lost the lease on email to {row['to_email']}")
+            return
+        if not dead:
+            return
+
+        with self._lock:
+            self._dead += 1
+        logger.warning(f"Email to {row['to_email']} dead-lettered: {error}")
+        # 移到死信分区，写入失败时该行仍为 dead 状态，不会再被发送
+        if insert_entity(
+            TABLE_NAMES.EMAIL_OUTBOX,
+            {**row, **fields, PARTITION_KEYS.PARKEY: EMAIL_DEAD_PARTITION},
+        ):
+            delete_entity(
+                TABLE_NAMES.EMAIL_OUTBOX,
+                row[PARTITION_KEYS.PARKEY],
+                row[PARTITION_KEYS.ROWKEY],
+            )
+
+    def _record(self, sent: bool, latency: float) -> None:
+        with self._lock:
+            if sent:
+                self._sent += 1
+                self._queue_depth = max(self._queue_depth - 1, 0)
+                self._latency_total += latency
+                self._latency_max = max(self._latency_max, latency)
+            else:
+                self._failed += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "queue_depth": self._queue_depth,
+                "sent": self._sent,
+                "failed": self._failed,
+                "dead": self._dead,
+                "avg_send_seconds": (
+                    self._latency_total / self._sent if self._sent else 0.0
+                ),
+                "max_send_seconds": self._latency_max,
+                "connections_opened": self.pool.connections_opened,
+            }
+
+
+email_worker = EmailWorker()
@@ -1,12 +1,21 @@
-import hashlib
 import json
 import uuid
 from fastapi import APIRouter, Body, Depends, File, UploadFile, Query, HTTPException
-from typing import List, Optional
+from starlette.concurrency import run_in_threadpool
+from typing import Any, Dict, List, Optional, Tuple
 from datetime import datetime
-from auth_token import create_access_token, verify_oauth_token
-from common import process_task_resources, send_email, verify_enterprise_credentials
+from auth_token import (
+    create_enterprise_token,
+    create_password_reset_token,
+    get_current_principal,
+    revoke_token,
+    verify_enterprise_token,
+    verify_password_reset_token,
+)
+from common import send_email, verify_enterprise_credentials
 from schemas import (
+    BatchItemResult,
+    BatchOperationResponse,
     CommonResponseBool,
     EnterpriseRegistration,
     EnterpriseResponse,
@@ -20,43 +29,148 @@ from schemas import (
     TaskProgress,
     TaskStatus,
     TaskType,
+    TaskBatchPayRequest,
+    TaskBatchReviewRequest,
     TaskCreate,
+    WebhookEndpoint,
+    WebhookEndpointCreate,
+    WebhookEndpointListResponse,
+    WebhookEventType,
     PARTITION_KEYS,
     TABLE_NAMES,
 )
+from passwords import password_hasher
 from database import (
+    batch_update_entities,
+    get_entities_by_field_values,
     get_latest_id_by_partition,
     insert_entity,
     get_entity_by_field,
     update_entity_fields,
     get_all_entities,
 )
+from fast_json import model_response, parse_fields
+from reservations import (
+    ReservationConflict,
+    move_reservations,
+    normalize,
+    release_reservations,
+    reserve_new_owner,
+)
+from microcache import (
+    enterprise_tasks_tag,
+    invalidate_task_lists,
+    list_cache,
+    task_result_tags,
+)
+from row_codec import decode_task
+from sorted_index import (
+    INDEX_KINDS,
+    InvalidCursor,
+    read_index_page,
+    sync_task_indexes,
+)
+from webhooks import (
+    deactivate_webhook_endpoint,
+    enqueue_task_event,
+    enqueue_task_events,
+    list_webhook_endpoints,
+    WebhookTargetError,
+    register_webhook_endpoint,
+)
 
 router = APIRouter()
 
 
+def _batch_item(
+    task_id: int, status_code: int, detail: Optional[str] = None
+) -> BatchItemResult:
+    return BatchItemResult(
+        task_id=task_id,
+        success=status_code == 200,
+        status_code=status_code,
+        detail=detail,
+    )
+
+
+def _batch_response(
+    task_ids: List[int], results: Dict[int, BatchItemResult]
+) -> BatchOperationResponse:
+    ordered = [results[task_id] for task_id in task_ids]
+    succeeded = sum(1 for result in ordered if result.success)
+    return BatchOperationResponse(
+        results=ordered, succeeded=succeeded, failed=len(ordered) - succeeded
+    )
+
+
+async def _load_tasks_by_id(task_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+    # 合并为少量 OR 查询并发执行，而不是逐个任务扫描
+    try:
+        task_entities = await run_in_threadpool(
+            get_entities_by_field_values, TABLE_NAMES.TASK, "id", task_ids
+        )
+    except Exception:
+        # 查询失败时整批返回 503，不能逐项报告为任务不存在
+        raise HTTPException(
+            status_code=503, detail="Task storage is unavailable, please retry"
+        )
+    return {int(task["id"]): task for task in task_entities}
+
+
+def _apply_task_updates(
+    updates: List[Tuple[Dict[str, Any], Dict[str, Any]]]
+) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    # 按分区分组提交批量事务，返回更新成功的 (原任务, 更新字段)
+    outcome = batch_update_entities(
+        TABLE_NAMES.TASK,
+        [
+            {
+                PARTITION_KEYS.PARKEY: task_entity[PARTITION_KEYS.PARKEY],
+                PARTITION_KEYS.ROWKEY: task_entity[PARTITION_KEYS.ROWKEY],
+                **fields_to_update,
+            }
+            for task_entity, fields_to_update in updates
+        ],
+    )
+    succeeded = [
+        (task_entity, fields_to_update)
+        for task_entity, fields_to_update in updates
+        if outcome.get(
+            (task_entity[PARTITION_KEYS.PARKEY], task_entity[PARTITION_KEYS.ROWKEY])
+        )
+    ]
+    for task_entity, fields_to_update in succeeded:
+        sync_task_indexes(task_entity, fields_to_update)
+    return succeeded
+
+
 # 账户管理
 # 企业用户注册，填写公司信息。
 @router.post("/api/enterprise/register", response_model=EnterpriseResponse)
 async def register_enterprise(enterprise: EnterpriseRegistration):
     try:
-        # 检查邮箱是否已被注册
-        existing_enterprise = get_entity_by_field(
-            TABLE_NAMES.ENTERPRISE, "email", enterprise.email
-        )
-        if existing_enterprise:
-            raise HTTPException(status_code=400, detail="Email already registered")
+        # 先计算密码哈希：哈希池繁忙时直接返回503，不会留下占用记录
+        hashed_password = await password_hasher.hash(enterprise.password)
 
-        # 生成新的企业ID
-        new_id = get_latest_id_by_partition(TABLE_NAMES.ENTERPRISE, "id")
+        # 生成新的企业ID并占用邮箱，邮箱已被注册时立即失败
+        row_key = str(uuid.uuid4())
+        owner = (TABLE_NAMES.ENTERPRISE, row_key)
+        unique_fields = {"email": enterprise.email}
+        try:
+            new_id = await run_in_threadpool(
+                reserve_new_owner,
+                TABLE_NAMES.ENTERPRISE,
+                "id",
+                unique_fields,
+                lambda _: owner,
+            )
+        except ReservationConflict:
+            raise HTTPException(status_code=400, detail="Email already registered")
 
         # 创建新的企业对象
-        hashed_password = hashlib.md5(
-            enterprise.password.encode()
-        ).hexdigest()  # 使用SHA256进行密码哈希
         new_enterprise = {
             "PartitionKey": TABLE_NAMES.ENTERPRISE,
-            "RowKey": str(uuid.uuid4()),  # Generate a unique UUID
+            "RowKey": row_key,  # Generate a unique UUID
             "id": new_id,  # Convert new_id to string
             "name": enterprise.name,
             "email": enterprise.email,
@@ -78,6 +192,7 @@ async def register_enterprise(enterprise: EnterpriseRegistration):
             "created_at": datetime.now().isoformat(),
             "updated_at": datetime.now().isoformat(),
         }
+        new_enterprise_data = None
         try:
             # 将新企业添加到Azure表存储并获取新添加的企业数据
             new_enterprise_data = insert_entity(TABLE_NAMES.ENTERPRISE, new_enterprise)
@@ -96,7 +211,16 @@ async def register_enterprise(enterprise: EnterpriseRegistration):
             # 转换为EnterpriseResponse对象并返回
             return EnterpriseResponse(**new_enterprise_data)
         except Exception as e:
+            # 企业行没有写入，释放占用
+            if not new_enterprise_data:
+                await run_in_threadpool(
+                    release_reservations, TABLE_NAMES.ENTERPRISE, owner, unique_fields
+                )
+            if isinstance(e, HTTPException):
+                raise
             raise HTTPException(status_code=400, detail=f"Bad Request: {str(e)}")
+    except HTTPException as http_ex:
+        raise http_ex
     except Exception as e:
         # 如果发生错误，抛出HTTP异常
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
@@ -113,26 +237,26 @@ async def login_enterprise(
         if oauth_token:
             # OAuth认证逻辑
             # 这里应该验证OAuth token并获取企业信息
-            enterprise_id = verify_oauth_token(
-                oauth_token
-            )  # 假设这个函数用于验证OAuth token
-
-            if enterprise_id is None:
+            principal = get_current_principal(oauth_token)
+            # 只允许企业令牌换取新的企业令牌
+            if principal.enterprise_id is None:
                 raise HTTPException(status_code=401, detail="Invalid or expired token")
-            access_token = create_access_token(data={"sub": str(enterprise_id)})
+            access_token = create_enterprise_token(principal.enterprise_id)
         elif email and password:
             # 邮箱密码认证逻辑
-            enterprise_id = verify_enterprise_credentials(
+            enterprise_id = await verify_enterprise_credentials(
                 email, password
             )  # 从数据库中获取认证id
             if not enterprise_id:
                 raise HTTPException(status_code=401, detail="Invalid email or password")
-            access_token = create_access_token(data={"sub": str(enterprise_id)})
+            access_token = create_enterprise_token(enterprise_id)
         else:
             raise HTTPException(status_code=400, detail="Invalid login credentials")
 
         # 返回登录响应
         return LoginEnterpriseResponse(access_token=access_token, token_type="bearer")
+    except HTTPException:
+        raise
     except Exception as e:
         error_message = (
             str(e) if str(e) else "An unexpected error occurred during login"
@@ -150,7 +274,7 @@ async def forgot_password(email: str):
             raise HTTPException(status_code=404, detail="Email not found")
 
         # 生成重置令牌
-        reset_token = create_access_token(data={"sub": str(enterprise["id"])})
+        reset_token = create_password_reset_token(enterprise["id"])
 
         # 构建重置链接
         reset_link = f"https://yourwebsite.com/reset-password?token={reset_token}"
@@ -172,11 +296,11 @@ async def forgot_password(email: str):
 async def reset_password(
     reset_token: str,
     new_password: str,
-    enterprise_id: str = Depends(verify_oauth_token),
+    enterprise_id: str = Depends(verify_enterprise_token),
 ):
     try:
         # 验证重置令牌
-        token_enterprise_id = verify_oauth_token(reset_token)
+        token_enterprise_id = verify_password_reset_token(reset_token)
         if token_enterprise_id != enterprise_id:
             raise HTTPException(
                 status_code=401, detail="Token does not match the enterprise ID"
@@ -190,7 +314,7 @@ async def reset_password(
             raise HTTPException(status_code=404, detail="Enterprise not found")
 
         # 更新密码
-        new_password_hash = hashlib.md5(new_password.encode()).hexdigest()
+        new_password_hash = await password_hasher.hash(new_password)
         enterprise["password"] = new_password_hash
 
         # 更新数据库中的企业信息
@@ -205,6 +329,9 @@ async def reset_password(
                 status_code=500, detail="Failed to update enterprise profile"
             )
 
+        # 重置令牌只能使用一次
+        revoke_token(reset_token)
+
         return CommonResponseBool(result=True)
     except HTTPException as http_ex:
         raise http_ex
@@ -216,14 +343,13 @@ async def reset_password(
 @router.put("/api/enterprise/update-profile", response_model=EnterpriseResponse)
 async def update_enterprise_profile(
     enterprise_update: EnterpriseRegistration,
-    enterprise_id: str = Depends(verify_oauth_token),
+    enterprise_id: str = Depends(verify_enterprise_token),
 ):
     try:
         # 从数据库获取现有企业信息
         existing_enterprise = get_entity_by_field(
             TABLE_NAMES.ENTERPRISE, "id", enterprise_id
         )
-        print(existing_enterprise)
         if not existing_enterprise:
             raise HTTPException(status_code=404, detail="Enterprise not found")
 
@@ -231,13 +357,28 @@ async def update_enterprise_profile(
             **existing_enterprise,
             **enterprise_update.dict(exclude_unset=True),
         }
+        owner = (
+            existing_enterprise[PARTITION_KEYS.PARKEY],
+            existing_enterprise[PARTITION_KEYS.ROWKEY],
+        )
+        changed, previous = {}, {}
         if enterprise_update.email:
-            if enterprise_update.email != existing_enterprise[
-                "email"
-            ] and get_entity_by_field(
-                TABLE_NAMES.ENTERPRISE, "email", enterprise_update.email
+            if normalize("email", enterprise_update.email) != normalize(
+                "email", existing_enterprise.get("email") or ""
             ):
-                raise HTTPException(status_code=400, detail="Email already exists")
+                # 在占用表中原子地占用新邮箱并释放旧邮箱
+                changed = {"email": enterprise_update.email}
+                previous = {"email": existing_enterprise.get("email")}
+                try:
+                    await run_in_threadpool(
+                        move_reservations,
+                        TABLE_NAMES.ENTERPRISE,
+                        owner,
+                        previous,
+                        changed,
+                    )
+                except ReservationConflict:
+                    raise HTTPException(status_code=400, detail="Email already exists")
             updated_enterprise["email"] = enterprise_update.email
 
         # 更新企业信息
@@ -251,6 +392,13 @@ async def update_enterprise_profile(
             updated_enterprise,
         )
         if not update_success:
+            # 恢复原来的占用；原邮箱已被他人占用时保留新邮箱的占用
+            try:
+                await run_in_threadpool(
+                    move_reservations, TABLE_NAMES.ENTERPRISE, owner, changed, previous
+                )
+            except ReservationConflict:
+                pass
             raise HTTPException(
                 status_code=500, detail="Failed to update enterprise profile"
             )
@@ -273,16 +421,10 @@ async def batch_upload_tasks(files: List[UploadFile] = File(...)):
 # 创建单个任务
 @router.post("/api/task/create", response_model=Task)
 async def create_task(
-    task: TaskCreate, enterprise_id: str = Depends(verify_oauth_token)
+    task: TaskCreate, enterprise_id: str = Depends(verify_enterprise_token)
 ):
     try:
-        # 验证企业用户
-        enterprise = get_entity_by_field(
-            TABLE_NAMES.ENTERPRISE, PARTITION_KEYS.ROWKEY, enterprise_id
-        )
-        if not enterprise:
-            raise HTTPException(status_code=404, detail="Enterprise not found")
-
+        # 企业身份已由令牌中的角色声明确认，无需再查询企业表
         # 验证任务标题是否已存在
         existing_task = get_entity_by_field(TABLE_NAMES.TASK, "title", task.title)
         if existing_task:
@@ -331,6 +473,7 @@ async def create_task(
         insert_task = insert_entity(TABLE_NAMES.TASK, task_entity)
         if not insert_task:
             raise HTTPException(status_code=500, detail="Failed to create task")
+        invalidate_task_lists(task_entity)
 
         # Convert the insert_task response to a Task object
         created_task = Task(
@@ -366,7 +509,7 @@ async def create_task(
 # 获取企业发布的任务列表
 @router.get("/api/task/tasks", response_model=TaskListResponse)
 async def list_enterprise_tasks(
-    enterprise_id: int = Depends(verify_oauth_token),
+    enterprise_id: int = Depends(verify_enterprise_token),
     status: Optional[TaskStatus] = Query(None),
     type: Optional[TaskType] = Query(None),
     difficulty: Optional[TaskDifficulty] = Query(None),
@@ -374,7 +517,11 @@ async def list_enterprise_tasks(
     max_reward: Optional[float] = Query(None, ge=0),
     page: int = Query(1, ge=1),
     page_size: int = Query(10, ge=1, le=100),
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return for each item"
+    ),
 ):
+    selected_fields = parse_fields(fields, Task)
     try:
         # 构建查询参数
         search_params = {"enterprise_id": enterprise_id}
@@ -390,16 +537,22 @@ async def list_enterprise_tasks(
             search_params["reward_per_unit__le"] = max_reward
 
         # 从数据库获取企业发布的任务列表
-        all_tasks, total_count = get_all_entities(
-            TABLE_NAMES.TASK, page, page_size, **search_params
+        all_tasks, total_count = await list_cache.get_or_load(
+            "list_enterprise_tasks",
+            {**search_params, "page": page, "page_size": page_size},
+            lambda: get_all_entities(
+                TABLE_NAMES.TASK, page, page_size, **search_params
+            ),
+            tags=[enterprise_tasks_tag(enterprise_id)],
+            result_tags=task_result_tags,
         )
         # 将原始实体转换为Task对象
-        tasks = []
-        for task in all_tasks:
-            task["resources"] = process_task_resources(task.get("resources"))
-            tasks.append(Task(**task))
+        tasks = [decode_task(task) for task in all_tasks]
 
-        return TaskListResponse(total_count=total_count, tasks=tasks)
+        return model_response(
+            TaskListResponse.construct(total_count=float(total_count), tasks=tasks),
+            selected_fields,
+        )
     except HTTPException as http_ex:
         raise http_ex
     except Exception as e:
@@ -412,11 +565,13 @@ async def list_enterprise_tasks(
 # 查看任务实时进度
 @router.get("/api/task/{task_id}/progress", response_model=TaskProgress)
 async def get_task_progress(
-    task_id: int, enterprise_id: str = Depends(verify_oauth_token)
+    task_id: int, enterprise_id: str = Depends(verify_enterprise_token)
 ):
     try:
         # 从数据库获取任务信息
-        task_entity = get_entity_by_field(TABLE_NAMES.TASK, "id", task_id)
+        task_entity = await run_in_threadpool(
+            get_entity_by_field, TABLE_NAMES.TASK, "id", task_id
+        )
         if not task_entity:
             raise HTTPException(status_code=404, detail="Task not found")
 
@@ -428,8 +583,7 @@ async def get_task_progress(
             )
 
         # 将原始实体转换为Task对象
-        task_entity["resources"] = process_task_resources(task_entity.get("resources"))
-        task = Task(**task_entity)
+        task = decode_task(task_entity)
 
         # 计算进度百分比
         progress_percentage = (
@@ -457,7 +611,7 @@ async def get_task_progress(
 
 # 暂停任务
 @router.put("/api/task/{task_id}/pause", response_model=CommonResponseBool)
-async def pause_task(task_id: int, enterprise_id: str = Depends(verify_oauth_token)):
+async def pause_task(task_id: int, enterprise_id: str = Depends(verify_enterprise_token)):
     try:
         # 从数据库获取任务
         task_entity = get_entity_by_field(TABLE_NAMES.TASK, "id", task_id)
@@ -497,6 +651,8 @@ async def pause_task(task_id: int, enterprise_id: str = Depends(verify_oauth_tok
         if not is_paused:
             raise HTTPException(status_code=500, detail="Failed to pause the task")
 
+        sync_task_indexes(task_entity, fields_to_update)
+
         return CommonResponseBool(result=is_paused)
     except HTTPException as http_ex:
         raise http_ex
@@ -509,7 +665,7 @@ async def pause_task(task_id: int, enterprise_id: str = Depends(verify_oauth_tok
 
 # 取消任务
 @router.delete("/api/task/{task_id}/cancel", response_model=CommonResponseBool)
-async def cancel_task(task_id: int, enterprise_id: str = Depends(verify_oauth_token)):
+async def cancel_task(task_id: int, enterprise_id: str = Depends(verify_enterprise_token)):
     try:
         # 从数据库获取任务
         task_entity = get_entity_by_field(TABLE_NAMES.TASK, "id", task_id)
@@ -546,6 +702,8 @@ async def cancel_task(task_id: int, enterprise_id: str = Depends(verify_oauth_to
         if not is_cancelled:
             raise HTTPException(status_code=500, detail="Failed to cancel the task")
 
+        sync_task_indexes(task_entity, fields_to_update)
+
         return CommonResponseBool(result=is_cancelled)
     except HTTPException as http_ex:
         raise http_ex
@@ -559,7 +717,7 @@ async def cancel_task(task_id: int, enterprise_id: str = Depends(verify_oauth_to
 # 审核已完成的任务结果，决定是否验收
 @router.post("/api/task/{task_id}/review", response_model=CommonResponseBool)
 async def review_task(
-    task_id: int, is_accepted: bool, enterprise_id: str = Depends(verify_oauth_token)
+    task_id: int, is_accepted: bool, enterprise_id: str = Depends(verify_enterprise_token)
 ):
     try:
         # 从数据库获取任务
@@ -614,6 +772,13 @@ async def review_task(
                 status_code=500, detail="Failed to update the task after review"
             )
 
+        sync_task_indexes(task_entity, fields_to_update)
+        enqueue_task_event(
+            WebhookEventType.TASK_REVIEWED,
+            {**task_entity, **fields_to_update},
+            is_accepted=is_accepted,
+        )
+
         # 如果任务被接受，可以在这里添加奖励发放的逻辑
 
         return CommonResponseBool(result=True)
@@ -626,12 +791,92 @@ async def review_task(
         )
 
 
+# 批量审核已完成的任务，逐项返回结果
+@router.post("/api/task/review-batch", response_model=BatchOperationResponse)
+async def review_task_batch(
+    review_request: TaskBatchReviewRequest,
+    enterprise_id: str = Depends(verify_enterprise_token),
+):
+    try:
+        # 同一任务出现多次时以最后一次为准
+        reviews = {review.task_id: review for review in review_request.reviews}
+        task_ids = list(reviews)
+        tasks_by_id = await _load_tasks_by_id(task_ids)
+
+        results: Dict[int, BatchItemResult] = {}
+        updates = []
+        now = datetime.now().isoformat()
+        for task_id in task_ids:
+            task_entity = tasks_by_id.get(task_id)
+            if not task_entity:
+                results[task_id] = _batch_item(task_id, 404, "Task not found")
+                continue
+            if str(task_entity.get("enterprise_id")) != enterprise_id:
+                results[task_id] = _batch_item(
+                    task_id, 403, "You don't have permission to review this task"
+                )
+                continue
+            if task_entity.get("status") != TaskStatus.IN_PROGRESS.value:
+                results[task_id] = _batch_item(
+                    task_id, 400, "Task is not in progress and cannot be reviewed"
+                )
+                continue
+            total_units = task_entity.get("total_units", 0)
+            completed_units = task_entity.get("completed_units", 0)
+            if completed_units < total_units:
+                results[task_id] = _batch_item(
+                    task_id,
+                    400,
+                    f"Not all task units are completed. Completed: {completed_units}/{total_units}",
+                )
+                continue
+            fields_to_update = {
+                "status": (
+                    TaskStatus.COMPLETED.value
+                    if reviews[task_id].is_accepted
+                    else TaskStatus.IN_PROGRESS.value
+                ),
+                "updated_at": now,
+            }
+            updates.append((task_entity, fields_to_update))
+
+        succeeded = await run_in_threadpool(_apply_task_updates, updates)
+        for task_entity, _ in updates:
+            results[int(task_entity["id"])] = _batch_item(
+                int(task_entity["id"]), 500, "Failed to update the task after review"
+            )
+        for is_accepted in (True, False):
+            reviewed = [
+                {**task_entity, **fields_to_update}
+                for task_entity, fields_to_update in succeeded
+                if reviews[int(task_entity["id"])].is_accepted == is_accepted
+            ]
+            for task in reviewed:
+                results[int(task["id"])] = _batch_item(int(task["id"]), 200)
+            if reviewed:
+                await run_in_threadpool(
+                    enqueue_task_events,
+                    WebhookEventType.TASK_REVIEWED,
+                    reviewed,
+                    is_accepted=is_accepted,
+                )
+
+        return _batch_response(task_ids, results)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"An error occurred while reviewing tasks: {str(e)}",
+        )
+
+
 # 提供任务结果反馈和评分
 @router.post("/api/task/{task_id}/feedback", response_model=CommonResponseBool)
 async def provide_task_feedback(
     task_id: int,
     feedback: TaskFeedbackInfo,
-    enterprise_id: str = Depends(verify_oauth_token),
+    enterprise_id: str = Depends(verify_enterprise_token),
 ):
     try:
         # 从数据库获取任务
@@ -671,6 +916,8 @@ async def provide_task_feedback(
                 status_code=500, detail="Failed to update task with feedback"
             )
 
+        sync_task_indexes(task_entity, fields_to_update)
+
         return CommonResponseBool(result=True)
     except HTTPException as http_ex:
         raise http_ex
@@ -685,7 +932,7 @@ async def provide_task_feedback(
 # 设置指定任务报酬数量
 @router.post("/api/reward/{task_id}/set", response_model=CommonResponseBool)
 async def set_reward(
-    task_id: int, reward_num: float, enterprise_id: str = Depends(verify_oauth_token)
+    task_id: int, reward_num: float, enterprise_id: str = Depends(verify_enterprise_token)
 ):
     try:
         # 从数据库获取任务
@@ -723,6 +970,8 @@ async def set_reward(
         if not is_updated:
             raise HTTPException(status_code=500, detail="Failed to update task reward")
 
+        sync_task_indexes(task_entity, fields_to_update)
+
         return CommonResponseBool(result=True)
     except HTTPException as http_ex:
         raise http_ex
@@ -735,7 +984,7 @@ async def set_reward(
 
 # 任务通过审核后发起支付
 @router.post("/api/reward/{task_id}/pay", response_model=CommonResponseBool)
-async def pay_reward(task_id: int, enterprise_id: str = Depends(verify_oauth_token)):
+async def pay_reward(task_id: int, enterprise_id: str = Depends(verify_enterprise_token)):
     try:
         # 从数据库获取任务
         task_entity = get_entity_by_field(TABLE_NAMES.TASK, "id", task_id)
@@ -773,6 +1022,11 @@ async def pay_reward(task_id: int, enterprise_id: str = Depends(verify_oauth_tok
                     status_code=500, detail="Failed to update task payment status"
                 )
 
+            sync_task_indexes(task_entity, fields_to_update)
+            enqueue_task_event(
+                WebhookEventType.TASK_PAID, {**task_entity, **fields_to_update}
+            )
+
             return CommonResponseBool(result=True)
         else:
             raise HTTPException(status_code=500, detail="Payment failed")
@@ -785,34 +1039,99 @@ async def pay_reward(task_id: int, enterprise_id: str = Depends(verify_oauth_tok
         )
 
 
+# 批量支付已完成的任务，逐项返回结果
+@router.post("/api/reward/pay-batch", response_model=BatchOperationResponse)
+async def pay_reward_batch(
+    pay_request: TaskBatchPayRequest,
+    enterprise_id: str = Depends(verify_enterprise_token),
+):
+    try:
+        task_ids = list(dict.fromkeys(pay_request.task_ids))
+        tasks_by_id = await _load_tasks_by_id(task_ids)
+
+        results: Dict[int, BatchItemResult] = {}
+        updates = []
+        now = datetime.now().isoformat()
+        for task_id in task_ids:
+            task_entity = tasks_by_id.get(task_id)
+            if not task_entity:
+                results[task_id] = _batch_item(task_id, 404, "Task not found")
+                continue
+            if str(task_entity.get("enterprise_id")) != enterprise_id:
+                results[task_id] = _batch_item(
+                    task_id, 403, "You don't have permission to pay for this task"
+                )
+                continue
+            if task_entity.get("status") != TaskStatus.COMPLETED.value:
+                results[task_id] = _batch_item(task_id, 400, "Task is not completed yet")
+                continue
+            if task_entity.get("payment_status") == PaymentStatus.PAID.value:
+                results[task_id] = _batch_item(task_id, 400, "Task is already paid")
+                continue
+            # Mock支付过程，与单个支付接口一致
+            fields_to_update = {
+                "payment_status": PaymentStatus.PAID.value,
+                "updated_at": now,
+            }
+            updates.append((task_entity, fields_to_update))
+
+        succeeded = await run_in_threadpool(_apply_task_updates, updates)
+        for task_entity, _ in updates:
+            results[int(task_entity["id"])] = _batch_item(
+                int(task_entity["id"]), 500, "Failed to update task payment status"
+            )
+        paid = [
+            {**task_entity, **fields_to_update}
+            for task_entity, fields_to_update in succeeded
+        ]
+        for task in paid:
+            results[int(task["id"])] = _batch_item(int(task["id"]), 200)
+        if paid:
+            await run_in_threadpool(
+                enqueue_task_events, WebhookEventType.TASK_PAID, paid
+            )
+
+        return _batch_response(task_ids, results)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"An error occurred during batch payment: {str(e)}"
+        )
+
+
 # 获取支付历史和报酬明细
 @router.get("/api/reward/historys", response_model=TaskListResponse)
 async def get_reward_history(
-    enterprise_id: str = Depends(verify_oauth_token),
+    enterprise_id: str = Depends(verify_enterprise_token),
     page: int = Query(1, ge=1, description="Page number"),
     page_size: int = Query(10, ge=1, le=100, description="Number of items per page"),
+    cursor: Optional[str] = Query(None, description="Cursor from the previous page"),
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return for each item"
+    ),
 ):
+    selected_fields = parse_fields(fields, Task)
     try:
-        # 获取所有已支付的任务
-        search_params = {
-            "enterprise_id": enterprise_id,
-            "payment_status": PaymentStatus.PAID.value,
-        }
-        # 获取所有任务
-        all_paid_tasks, total_count = get_all_entities(
-            TABLE_NAMES.TASK, page, page_size, **search_params
+        # 从已支付任务索引中按支付时间倒序读取一页
+        all_paid_tasks, total_count, next_cursor = read_index_page(
+            INDEX_KINDS.PAID_TASKS, enterprise_id, page_size, cursor, page
         )
 
-        reward_history = []
-        for task in all_paid_tasks:
-            # 确保 resources 字段是一个列表
-            task["resources"] = process_task_resources(task["resources"])
-            reward_history.append(Task(**task))
-
-        # Sort reward history by updated_at in descending order
-        reward_history.sort(key=lambda x: x.updated_at, reverse=True)
+        reward_history = [decode_task(task) for task in all_paid_tasks]
 
-        return TaskListResponse(total_count=total_count, tasks=reward_history)
+        return model_response(
+            TaskListResponse.construct(
+                total_count=float(total_count),
+                tasks=reward_history,
+                next_cursor=next_cursor,
+            ),
+            selected_fields,
+        )
+    except HTTPException as http_ex:
+        raise http_ex
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -821,11 +1140,60 @@ async def get_reward_history(
 
 
 # API接口
-@router.post("/api/task/integrate")
-async def integrate_task():
-    return {"message": "Task integration successful"}
+# 注册Webhook接收端，任务状态变化时主动推送通知
+@router.post("/api/task/integrate", response_model=WebhookEndpoint)
+async def integrate_task(
+    endpoint: WebhookEndpointCreate, enterprise_id: str = Depends(verify_enterprise_token)
+):
+    try:
+        # 注册时解析接收端域名，放到线程池中执行
+        created_endpoint = await run_in_threadpool(
+            register_webhook_endpoint, enterprise_id, endpoint
+        )
+        if not created_endpoint:
+            raise HTTPException(
+                status_code=500, detail="Failed to register webhook endpoint"
+            )
+        return created_endpoint
+    except WebhookTargetError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException as http_ex:
+        raise http_ex
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"An error occurred while registering the webhook: {str(e)}",
+        )
 
 
-@router.get("/api/task/status-callback")
-async def task_status_callback():
-    return {"message": "Task status updated"}
+# 查看已注册的Webhook接收端
+@router.get("/api/task/status-callback", response_model=WebhookEndpointListResponse)
+async def task_status_callback(enterprise_id: str = Depends(verify_enterprise_token)):
+    try:
+        endpoints = list_webhook_endpoints(enterprise_id)
+        return WebhookEndpointListResponse(
+            endpoints=endpoints, total_count=len(endpoints)
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"An error occurred while fetching webhooks: {str(e)}",
+        )
+
+
+# 停用Webhook接收端
+@router.delete("/api/task/integrate/{endpoint_id}", response_model=CommonResponseBool)
+async def remove_task_integration(
+    endpoint_id: str, enterprise_id: str = Depends(verify_enterprise_token)
+):
+    try:
+        if not deactivate_webhook_endpoint(enterprise_id, endpoint_id):
+            raise HTTPException(status_code=404, detail="Webhook endpoint not found")
+        return CommonResponseBool(result=True)
+    except HTTPException as http_ex:
+        raise http_ex
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"An error occurred while removing the webhook: {str(e)}",
+        )
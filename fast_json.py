@@ -0,0 +1,85 @@
+import json
+from datetime import date, datetime
+from enum import Enum
+from typing import Any, Dict, Optional, Set, Type
+from fastapi import HTTPException
+from fastapi.responses import Response
+from pydantic import BaseModel
+from tracing import span
+
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时使用标准库
+    orjson = None
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=_default)
+    return json.dumps(
+        content, default=_default, ensure_ascii=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    """使用 orjson 序列化的 JSON 响应，未安装时退回标准库 json。"""
+
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        with span("serialize.json") as serialize_span:
+            body = dumps(content)
+            serialize_span.set_attribute("bytes", len(body))
+        return body
+
+
+def parse_fields(fields: Optional[str], model: Type[BaseModel]) -> Optional[Set[str]]:
+    """解析 fields=a,b,c 查询参数，未知字段返回400。"""
+    if not fields:
+        return None
+    selected = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = selected - set(model.__fields__)
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+        )
+    return selected
+
+
+def select_fields(data: Dict[str, Any], fields: Optional[Set[str]]) -> Dict[str, Any]:
+    # 只裁剪列表中的每一项，总数、游标等顶层字段保持不变
+    if fields is None:
+        return data
+    for key, value in data.items():
+        if isinstance(value, list):
+            data[key] = [
+                {name: field for name, field in item.items() if name in fields}
+                if isinstance(item, dict)
+                else item
+                for item in value
+            ]
+    return data
+
+
+def model_response(
+    model: BaseModel, fields: Optional[Set[str]] = None, status_code: int = 200
+) -> Response:
+    """
+    直接序列化已构造好的模型。返回 Response 时 FastAPI 不会再按 response_model
+    把模型转成字典后重新校验一遍，接口上的 response_model 仍用于生成文档。
+    """
+    return FastJSONResponse(
+        content=select_fields(model.dict(), fields), status_code=status_code
+    )
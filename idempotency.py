@@ -0,0 +1,303 @@
+import asyncio
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from starlette.concurrency import run_in_threadpool
+from database import (
+    delete_entity,
+    insert_entity,
+    query_entities_with_etag,
+    update_entity_fields,
+    update_entity_if_match,
+)
+from schemas import PARTITION_KEYS, TABLE_NAMES
+
+IDEMPOTENCY_HEADER = "idempotency-key"
+REPLAYED_HEADER = b"idempotent-replayed"
+IDEMPOTENCY_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+IDEMPOTENCY_TTL_SECONDS = 24 * 3600  # 已完成响应的保留时间
+IDEMPOTENCY_LOCK_SECONDS = 60  # 超过该时间仍未完成的请求视为已中断，可以重新执行
+IDEMPOTENCY_WAIT_SECONDS = 10  # 等待其他实例上同一请求完成的最长时间
+IDEMPOTENCY_POLL_SECONDS = 0.2
+IDEMPOTENCY_CLAIM_ATTEMPTS = 3  # 登记或接管记录时与其他实例冲突的重试次数
+IDEMPOTENCY_MAX_BODY_BYTES = 60 * 1024  # Azure Table 单个二进制属性上限为 64KB
+RESPONSE_ROW_KEY = "response"
+
+
+class RecordStatus:
+    PENDING = "pending"
+    COMPLETED = "completed"
+
+
+CachedResponse = Tuple[int, List[List[str]], bytes]
+
+
+class IdempotencyStore:
+    """以 Idempotency-Key 为键保存已完成的响应，带过期时间。方法都是同步的存储调用。"""
+
+    def get(self, scope_key: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """返回 (记录, ETag)，不存在或已过期时为 (None, None)。"""
+        rows = query_entities_with_etag(
+            TABLE_NAMES.IDEMPOTENCY_KEY,
+            f"PartitionKey eq '{scope_key}' and RowKey eq '{RESPONSE_ROW_KEY}'",
+        )
+        if not rows:
+            return None, None
+        record, etag = rows[0]
+        if datetime.fromisoformat(record["expires_at"]) < datetime.now():
+            self.release(scope_key)
+            return None, None
+        return record, etag
+
+    def claim(self, scope_key: str, fingerprint: str) -> bool:
+        now = datetime.now()
+        entity = {
+            PARTITION_KEYS.PARKEY: scope_key,
+            PARTITION_KEYS.ROWKEY: RESPONSE_ROW_KEY,
+            "status": RecordStatus.PENDING,
+            "fingerprint": fingerprint,
+            "locked_until": (
+                now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+            ).isoformat(),
+            "expires_at": (now + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)).isoformat(),
+            "created_at": now.isoformat(),
+        }
+        return insert_entity(TABLE_NAMES.IDEMPOTENCY_KEY, entity) is not None
+
+    def take_over(self, scope_key: str, etag: str) -> bool:
+        # 接管已中断的请求，只有读取之后未被其他实例接管时才成功
+        return update_entity_if_match(
+            TABLE_NAMES.IDEMPOTENCY_KEY,
+            {
+                PARTITION_KEYS.PARKEY: scope_key,
+                PARTITION_KEYS.ROWKEY: RESPONSE_ROW_KEY,
+                "locked_until": (
+                    datetime.now() + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+                ).isoformat(),
+            },
+            etag,
+        ) is not None
+
+    def complete(self, scope_key: str, response: CachedResponse) -> bool:
+        status_code, headers, body = response
+        return update_entity_fields(
+            TABLE_NAMES.IDEMPOTENCY_KEY,
+            scope_key,
+            RESPONSE_ROW_KEY,
+            {
+                "status": RecordStatus.COMPLETED,
+                "status_code": status_code,
+                "headers": json.dumps(headers),
+                "body": body,
+                "expires_at": (
+                    datetime.now() + timedelta(seconds=IDEMPOTENCY_TTL_SECONDS)
+                ).isoformat(),
+            },
+        )
+
+    def release(self, scope_key: str) -> None:
+        delete_entity(TABLE_NAMES.IDEMPOTENCY_KEY, scope_key, RESPONSE_ROW_KEY)
+
+
+def _record_to_response(record: Dict[str, Any]) -> CachedResponse:
+    return (
+        int(record["status_code"]),
+        json.loads(record.get("headers") or "[]"),
+        bytes(record.get("body") or b""),
+    )
+
+
+def _is_stale(record: Dict[str, Any]) -> bool:
+    return datetime.fromisoformat(record["locked_until"]) < datetime.now()
+
+
+class IdempotencyMiddleware:
+    """
+    对带有 Idempotency-Key 请求头的写操作：
+    同一个调用方、同一个接口、同一个键只执行一次，重试直接返回保存的响应；
+    同一进程内的并发重复请求等待第一次执行的结果，而不是同时执行。
+    存储操作都在线程池中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, app, store: Optional[IdempotencyStore] = None):
+        self.app = app
+        self.store = store or IdempotencyStore()
+        # scope_key -> (第一次执行的 Future, 请求体指纹)
+        self._inflight: Dict[str, Tuple[asyncio.Future, str]] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in IDEMPOTENCY_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        key = headers.get(IDEMPOTENCY_HEADER.encode())
+        if not key:
+            await self.app(scope, receive, send)
+            return
+
+        body = await self._read_body(receive)
+        # 键的作用域包含调用方的凭证和接口路径，不同用户使用相同的键互不影响
+        scope_key = hashlib.sha256(
+            b"\n".join(
+                [
+                    scope["method"].encode(),
+                    scope["path"].encode(),
+                    scope.get("query_string", b""),
+                    headers.get(b"authorization", b""),
+                    key,
+                ]
+            )
+        ).hexdigest()
+        fingerprint = hashlib.sha256(body).hexdigest()
+
+        inflight = self._inflight.get(scope_key)
+        if inflight is not None:
+            inflight_future, inflight_fingerprint = inflight
+            if inflight_fingerprint != fingerprint:
+                detail = "Idempotency-Key was reused with a different request"
+                await self._send_response(send, self._error(422, detail), False)
+                return
+            # 只有已保存或本身就是重放的响应才标记为重放，未保存的 5xx 原样返回
+            response, replayable = await asyncio.shield(inflight_future)
+            await self._send_response(send, response, replayed=replayable)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[scope_key] = (future, fingerprint)
+        try:
+            response, replayed, saved = await self._execute(
+                scope, body, scope_key, fingerprint
+            )
+            future.set_result((response, replayed or saved))
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(scope_key, None)
+        await self._send_response(send, response, replayed=replayed)
+
+    async def _execute(
+        self, scope, body: bytes, scope_key: str, fingerprint: str
+    ) -> Tuple[CachedResponse, bool, bool]:
+        """返回 (响应, 是否为重放, 是否已保存)。"""
+        in_progress = "A request with this Idempotency-Key is still in progress"
+        for _ in range(IDEMPOTENCY_CLAIM_ATTEMPTS):
+            record, etag = await run_in_threadpool(self.store.get, scope_key)
+            if record is None:
+                if await run_in_threadpool(self.store.claim, scope_key, fingerprint):
+                    break
+                # 其他实例在读取和写入之间抢先登记了同一个键
+                continue
+            if record.get("fingerprint") != fingerprint:
+                detail = "Idempotency-Key was reused with a different request"
+                return self._error(422, detail), False, False
+            if record["status"] == RecordStatus.COMPLETED:
+                return _record_to_response(record), True, False
+            if not _is_stale(record):
+                record, finished = await self._wait_for_other_instance(scope_key)
+                if not finished:
+                    return self._error(409, in_progress), False, False
+                if record is not None and record["status"] == RecordStatus.COMPLETED:
+                    return _record_to_response(record), True, False
+                # 记录已被释放或已中断，重新读取后登记或接管
+                continue
+            # 上一次执行已中断，带 ETag 接管，多个实例只有一个成功
+            if await run_in_threadpool(self.store.take_over, scope_key, etag):
+                break
+        else:
+            return self._error(409, in_progress), False, False
+
+        try:
+            response = await self._run_app(scope, body)
+        except BaseException:
+            # 应用抛出异常时释放记录，否则重试要等到锁过期才能执行
+            await run_in_threadpool(self.store.release, scope_key)
+            raise
+        status_code, _, response_body = response
+        if status_code < 500 and len(response_body) <= IDEMPOTENCY_MAX_BODY_BYTES:
+            saved = await run_in_threadpool(self.store.complete, scope_key, response)
+        else:
+            # 服务端错误或响应过大时不保存，允许客户端重试
+            await run_in_threadpool(self.store.release, scope_key)
+            saved = False
+        return response, False, saved
+
+    async def _wait_for_other_instance(
+        self, scope_key: str
+    ) -> Tuple[Optional[Dict[str, Any]], bool]:
+        # 返回 (最新记录, 是否已结束等待)，超时仍未完成时第二项为 False
+        deadline = asyncio.get_running_loop().time() + IDEMPOTENCY_WAIT_SECONDS
+        while asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(IDEMPOTENCY_POLL_SECONDS)
+            record, _ = await run_in_threadpool(self.store.get, scope_key)
+            if record is None or record["status"] == RecordStatus.COMPLETED:
+                return record, True
+            if _is_stale(record):
+                return record, True
+        return None, False
+
+    async def _run_app(self, scope, body: bytes) -> CachedResponse:
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return {"type": "http.disconnect"}
+
+        status_code = 500
+        response_headers: List[List[str]] = []
+        chunks: List[bytes] = []
+
+        async def send(message):
+            nonlocal status_code, response_headers
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                response_headers = [
+                    [name.decode("latin-1"), value.decode("latin-1")]
+                    for name, value in message.get("headers", [])
+                ]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, send)
+        return status_code, response_headers, b"".join(chunks)
+
+    @staticmethod
+    async def _read_body(receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] != "http.request":
+                break
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        return b"".join(chunks)
+
+    @staticmethod
+    def _error(status_code: int, detail: str) -> CachedResponse:
+        body = json.dumps({"detail": detail}).encode()
+        return (
+            status_code,
+            [["content-type", "application/json"], ["content-length", str(len(body))]],
+            body,
+        )
+
+    @staticmethod
+    async def _send_response(send, response: CachedResponse, replayed: bool) -> None:
+        status_code, headers, body = response
+        raw_headers = [
+            (name.encode("latin-1"), value.encode("latin-1")) for name, value in headers
+        ]
+        if replayed:
+            raw_headers.append((REPLAYED_HEADER, b"true"))
+        await send(
+            {"type": "http.response.start", "status": status_code, "headers": raw_headers}
+        )
+        await send({"type": "http.response.body", "body": body})
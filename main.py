@@ -1,15 +1,97 @@
+import asyncio
 import logging
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from app_logging import RequestIdMiddleware, configure_logging
 from enterprise_routes import router as enterprise_router
 from refugee_routes import router as refugee_router
+from bloom import bloom_refresher
+from component_metrics import register_component_metrics
+from compression import CompressionMiddleware
+from conditional import ConditionalGetMiddleware
+from database import create_table, iter_entities
+from email_outbox import email_worker
+from idempotency import IdempotencyMiddleware
+from profiler import ProfilerMiddleware
+from profiler import router as profiler_router
+from metrics import CONTENT_TYPE, MetricsMiddleware, event_loop_monitor, registry
+from query_budget import QueryBudgetMiddleware
+from rate_limit import RateLimitMiddleware
+from reservations import backfill_reservations
+from schemas import TABLE_NAMES
+from tracing import TracingMiddleware, trace_exporter
+from webhooks import webhook_dispatcher
 
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+# 后添加的中间件在外层：请求依次经过 Profiler、RequestId、Tracing、QueryBudget、
+# Metrics、RateLimit、Compression、ConditionalGet、Idempotency，最后到达路由
+# 写操作支持 Idempotency-Key 请求头，客户端重试时直接返回首次执行的结果
+app.add_middleware(IdempotencyMiddleware)
+# GET 接口的 ETag、If-None-Match 与 Cache-Control
+app.add_middleware(ConditionalGetMiddleware)
+# 按 Accept-Encoding 压缩较大的响应，幂等缓存中保存的是未压缩的原始响应
+app.add_middleware(CompressionMiddleware)
+# 限流与过载保护，在幂等、条件请求和路由之前拒绝请求，被拒绝的请求不访问存储
+app.add_middleware(RateLimitMiddleware)
+# 在限流之外记录所有请求（包括被限流的）的数量与延迟
+app.add_middleware(MetricsMiddleware)
+# 统计每个请求的存储查询，超出路由预算时记录或拒绝；需要在追踪之内以写入根 span
+app.add_middleware(QueryBudgetMiddleware)
+# 请求级追踪，只导出慢请求和出错的请求
+app.add_middleware(TracingMiddleware)
+# 请求ID写入每条日志，并在响应头 X-Request-ID 返回
+app.add_middleware(RequestIdMiddleware)
+# 按需开启的采样分析，未开启时不做任何工作
+app.add_middleware(ProfilerMiddleware)
+register_component_metrics(registry)
+
 app.include_router(enterprise_router)
 app.include_router(refugee_router)
+app.include_router(profiler_router)
+
+
+async def run_reservation_backfill() -> None:
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, backfill_reservations)
+    except Exception:
+        logger.exception("Failed to backfill unique reservations")
+
+
+@app.on_event("startup")
+async def start_background_workers():
+    for table_name in [
+        TABLE_NAMES.WEBHOOK_ENDPOINT,
+        TABLE_NAMES.WEBHOOK_OUTBOX,
+        TABLE_NAMES.WEBHOOK_DEAD_LETTER,
+        TABLE_NAMES.SORTED_INDEX,
+        TABLE_NAMES.EARNINGS_AGGREGATE,
+        TABLE_NAMES.IDEMPOTENCY_KEY,
+        TABLE_NAMES.EMAIL_OUTBOX,
+        TABLE_NAMES.CHANGE_LOG,
+        TABLE_NAMES.UNIQUE_RESERVATION,
+        TABLE_NAMES.BLOOM_WATERMARK,
+    ]:
+        create_table(table_name)
+    # 一次性补录，在后台运行，不阻塞启动；完成之前注册接口额外检查用户表
+    app.state.reservation_backfill = asyncio.create_task(run_reservation_backfill())
+    await webhook_dispatcher.start()
+    await email_worker.start()
+    await bloom_refresher.start(iter_entities)
+    await event_loop_monitor.start()
+    await trace_exporter.start()
+
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    app.state.reservation_backfill.cancel()
+    await webhook_dispatcher.stop()
+    await email_worker.stop()
+    await bloom_refresher.stop()
+    await event_loop_monitor.stop()
+    await trace_exporter.stop()
 
 
 @app.get("/")
@@ -17,6 +99,11 @@ async def root():
     return {"message": "Hello World"}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     logger.info("Debug: Entering main block")
     try:
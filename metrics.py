@@ -0,0 +1,406 @@
+import abc
+import asyncio
+import functools
+import threading
+import time
+import types
+import weakref
+from bisect import bisect_left
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from starlette.routing import Match
+
+# Prometheus 文本格式的指标。每次记录只写当前线程的分片，不加锁，
+# 不依赖 prometheus_client；组件的 stats() 在抓取时通过回调读取。
+CONTENT_TYPE = "text/plain; version=0.0.4"
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+ROWS_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+EVENT_LOOP_LAG_INTERVAL = 0.5  # 事件循环延迟的采样间隔（秒）
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[Any]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    ) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _sample_lines(
+    name: str, labelnames: Sequence[str], items: Iterable[Tuple[Labels, float]]
+) -> List[str]:
+    return [
+        f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}"
+        for labels, value in items
+    ]
+
+
+class _ShardOwner:
+    __slots__ = ("__weakref__",)
+
+
+class _ThreadShards(threading.local):
+    """
+    每个线程只写自己的分片，记录时不需要加锁；抓取时合并所有线程的分片。
+    线程结束时线程局部数据被释放，owner 随之回收，分片并入已结束线程的合计，
+    分片数不会随线程池反复创建线程而增长。
+    """
+
+    def __init__(self, metric: "Metric"):
+        self.values: Dict[Labels, Any] = {}
+        self.owner = _ShardOwner()
+        metric._add_shard(self.values)
+        weakref.finalize(self.owner, metric._retire_shard, self.values)
+
+
+class Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._shards: List[Dict[Labels, Any]] = []
+        self._retired: Dict[Labels, Any] = {}
+        self._lock = threading.Lock()
+        self._local = _ThreadShards(self)
+
+    def header(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+    def _add_shard(self, values: Dict[Labels, Any]) -> None:
+        with self._lock:
+            self._shards.append(values)
+
+    def _retire_shard(self, values: Dict[Labels, Any]) -> None:
+        with self._lock:
+            self._shards = [shard for shard in self._shards if shard is not values]
+            self._merge(self._retired, values)
+
+    def _merge(self, total: Dict[Labels, Any], shard: Dict[Labels, Any]) -> None:
+        for labels, value in list(shard.items()):
+            total[labels] = total.get(labels, 0.0) + value
+
+    def _merged(self) -> Dict[Labels, Any]:
+        merged: Dict[Labels, Any] = {}
+        with self._lock:
+            self._merge(merged, self._retired)
+            shards = list(self._shards)
+        for shard in shards:
+            self._merge(merged, shard)
+        return merged
+
+    @abc.abstractmethod
+    def samples(self) -> List[str]:
+        """指标的样本行，不含 HELP 和 TYPE。"""
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str) -> None:
+        values = self._local.values
+        values[labels] = values.get(labels, 0.0) + 1.0
+
+    def add(self, amount: float, *labels: str) -> None:
+        values = self._local.values
+        values[labels] = values.get(labels, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        return _sample_lines(self.name, self.labelnames, self._merged().items())
+
+
+class Gauge(Counter):
+    """可增可减的计数，例如处理中的请求数。"""
+
+    kind = "gauge"
+
+    def dec(self, *labels: str) -> None:
+        values = self._local.values
+        values[labels] = values.get(labels, 0.0) - 1.0
+
+
+class CallbackMetric(Metric):
+    """抓取时调用 callback 取值，callback 返回 {标签值元组: 数值}。"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str],
+        callback: Callable[[], Dict[Labels, float]],
+        kind: str = "gauge",
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+        self.kind = kind
+
+    def samples(self) -> List[str]:
+        return _sample_lines(self.name, self.labelnames, self.callback().items())
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._width = len(self.buckets) + 1
+
+    def observe(self, value: float, *labels: str) -> None:
+        # 每个标签组合：各桶的计数（非累计），最后一个元素是总和
+        series_by_labels = self._local.values
+        series = series_by_labels.get(labels)
+        if series is None:
+            series = series_by_labels[labels] = [0] * self._width + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def _merge(self, total: Dict[Labels, Any], shard: Dict[Labels, Any]) -> None:
+        for labels, series in list(shard.items()):
+            merged = total.setdefault(labels, [0] * self._width + [0.0])
+            for i, value in enumerate(list(series)):
+                merged[i] += value
+
+    def samples(self) -> List[str]:
+        merged = self._merged()
+        lines = []
+        names = self.labelnames + ("le",)
+        for labels, series in merged.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+                cumulative += count
+                bucket_labels = _format_labels(names, labels + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            base = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{base} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{base} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in list(self._metrics.values()):
+            samples = metric.samples()
+            if samples:
+                lines.extend(metric.header())
+                lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests_total = registry.register(
+    Counter(
+        "http_requests_total",
+        "HTTP requests by route and status code.",
+        ("method", "route", "status"),
+    )
+)
+http_request_duration_seconds = registry.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "HTTP request latency by route and status code.",
+        ("method", "route", "status"),
+    )
+)
+http_requests_in_flight = registry.register(
+    Gauge("http_requests_in_flight", "HTTP requests currently being processed.")
+)
+storage_call_duration_seconds = registry.register(
+    Histogram(
+        "storage_call_duration_seconds",
+        "Azure Table storage call latency by method and table.",
+        ("method", "table"),
+    )
+)
+storage_rows_returned = registry.register(
+    Histogram(
+        "storage_rows_returned",
+        "Rows returned per Azure Table storage call by method and table.",
+        ("method", "table"),
+        buckets=ROWS_BUCKETS,
+    )
+)
+event_loop_lag_seconds = registry.register(
+    Histogram(
+        "event_loop_lag_seconds",
+        "Delay between a scheduled event loop wakeup and when it ran.",
+    )
+)
+rate_limited_total = registry.register(
+    Counter(
+        "rate_limited_total",
+        "Requests rejected by rate limiting (429) or load shedding (503).",
+        ("reason",),
+    )
+)
+
+
+def row_count(result: Any) -> int:
+    if result is None or result is False:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], list):
+        # get_all_entities 返回 (当前页, 总数)，总数才是从存储读取的行数
+        return int(result[1])
+    return 1
+
+
+def _observe_rows(rows: Any, method_name: str, table_name: str, started: float):
+    count = 0
+    try:
+        for row in rows:
+            count += 1
+            yield row
+    finally:
+        storage_call_duration_seconds.observe(
+            time.perf_counter() - started, method_name, table_name
+        )
+        storage_rows_returned.observe(count, method_name, table_name)
+
+
+def observe_storage(method: Callable[..., Any]) -> Callable[..., Any]:
+    """装饰 AzureTableStorage 的方法，记录每次实际访问存储的耗时和返回行数。"""
+    method_name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        table_name = str(args[0] if args else kwargs.get("table_name"))
+        started = time.perf_counter()
+        result = method(self, *args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            # 流式遍历在迭代结束时记录，包含读取所有分页的时间
+            return _observe_rows(result, method_name, table_name, started)
+        storage_call_duration_seconds.observe(
+            time.perf_counter() - started, method_name, table_name
+        )
+        storage_rows_returned.observe(row_count(result), method_name, table_name)
+        return result
+
+    return wrapper
+
+
+def route_label(scope) -> str:
+    route = scope.get("route")
+    if route is None and scope.get("app") is not None:
+        # 被限流或幂等重放的请求没有经过路由，按路由表匹配出模板
+        for candidate in getattr(scope["app"], "routes", ()):
+            match, _ = candidate.matches(scope)
+            if match == Match.FULL:
+                route = candidate
+                break
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """按路由模板（而不是实际路径）记录请求数、延迟和处理中的请求数。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.dec()
+            labels = (scope["method"], route_label(scope), str(status))
+            http_requests_total.inc(*labels)
+            http_request_duration_seconds.observe(
+                time.perf_counter() - started, *labels
+            )
+
+
+class EventLoopLagMonitor:
+    """定期休眠固定时间，实际唤醒时间与预期之差即事件循环被阻塞的时间。"""
+
+    def __init__(self, interval: float = EVENT_LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.last_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, loop.time() - expected)
+            event_loop_lag_seconds.observe(self.last_lag)
+
+
+event_loop_monitor = EventLoopLagMonitor()
+registry.register(
+    CallbackMetric(
+        "event_loop_lag_last_seconds",
+        "Most recent event loop lag sample.",
+        (),
+        lambda: {(): event_loop_monitor.last_lag},
+    )
+)
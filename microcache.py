@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from starlette.concurrency import run_in_threadpool
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+MICROCACHE_MAX_ENTRIES = 2000
+# 任务的这些字段变化时，可能进入或离开某个筛选结果，需要使整个列表缓存失效
+TASK_FILTER_FIELDS = (
+    "status",
+    "user_id",
+    "type",
+    "difficulty",
+    "reward_per_unit",
+    "enterprise_id",
+)
+
+
+class RouteCacheConfig:
+    """ttl 内直接返回缓存；超过 ttl 但在 stale_ttl 内先返回旧结果，同时后台刷新。"""
+
+    def __init__(self, enabled: bool = True, ttl: float = 2.0, stale_ttl: float = 30.0):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+
+MICROCACHE_ROUTES: Dict[str, RouteCacheConfig] = {
+    "browse_tasks": RouteCacheConfig(ttl=2.0, stale_ttl=30.0),
+    "list_enterprise_tasks": RouteCacheConfig(ttl=2.0, stale_ttl=15.0),
+}
+
+
+class _Entry:
+    __slots__ = ("value", "fresh_until", "stale_until", "tags", "refreshing")
+
+    def __init__(self, value: Any, config: RouteCacheConfig, tags: Set[str]):
+        now = time.monotonic()
+        self.value = value
+        self.fresh_until = now + config.ttl
+        self.stale_until = now + config.ttl + config.stale_ttl
+        self.tags = tags
+        self.refreshing = False
+
+
+class _RouteStats:
+    __slots__ = ("hits", "stale_hits", "misses", "refreshes")
+
+    def __init__(self):
+        self.hits = self.stale_hits = self.misses = self.refreshes = 0
+
+
+CacheKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class MicroCache:
+    """进程内的列表结果缓存，按标签精确失效。读取在事件循环中进行，失效可以来自线程池。"""
+
+    def __init__(
+        self,
+        routes: Optional[Dict[str, RouteCacheConfig]] = None,
+        max_entries: int = MICROCACHE_MAX_ENTRIES,
+    ):
+        self.routes = MICROCACHE_ROUTES if routes is None else routes
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[CacheKey, _Entry]" = OrderedDict()
+        self._by_tag: Dict[str, Set[CacheKey]] = {}
+        self._loading: Dict[CacheKey, asyncio.Future] = {}
+        # 后台刷新任务，保留引用避免任务在完成前被回收
+        self._refreshes: Set[asyncio.Task] = set()
+        self._stats: Dict[str, _RouteStats] = {}
+        self._lock = threading.Lock()
+        # 每次失效加一，加载期间发生过失效的结果不写入缓存
+        self._epoch = 0
+
+    @staticmethod
+    def make_key(route: str, params: Dict[str, Any]) -> CacheKey:
+        return (
+            route,
+            tuple(
+                sorted((name, str(value)) for name, value in params.items() if value is not None)
+            ),
+        )
+
+    async def get_or_load(
+        self,
+        route: str,
+        params: Dict[str, Any],
+        loader: Callable[[], Any],
+        tags: Iterable[str] = (),
+        result_tags: Optional[Callable[[Any], Iterable[str]]] = None,
+    ) -> Any:
+        config = self.routes.get(route)
+        if config is None or not config.enabled:
+            return loader()
+
+        stats = self._stats.setdefault(route, _RouteStats())
+        key = self.make_key(route, params)
+        with span("cache.microcache") as cache_span:
+            cache_span.set_attribute("cache.route", route)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+            now = time.monotonic()
+            if entry is not None and now < entry.stale_until:
+                if now < entry.fresh_until:
+                    stats.hits += 1
+                    cache_span.set_attribute("cache.result", "hit")
+                else:
+                    stats.stale_hits += 1
+                    cache_span.set_attribute("cache.result", "stale")
+                    if not entry.refreshing:
+                        entry.refreshing = True
+                        stats.refreshes += 1
+                        task = asyncio.get_running_loop().create_task(
+                            self._load(key, config, loader, tags, result_tags)
+                        )
+                        self._refreshes.add(task)
+                        task.add_done_callback(self._refresh_done)
+                return entry.value
+
+            stats.misses += 1
+            cache_span.set_attribute("cache.result", "miss")
+            loading = self._loading.get(key)
+            if loading is not None:
+                return await asyncio.shield(loading)
+            return await self._load(key, config, loader, tags, result_tags)
+
+    async def _load(
+        self,
+        key: CacheKey,
+        config: RouteCacheConfig,
+        loader: Callable[[], Any],
+        tags: Iterable[str],
+        result_tags: Optional[Callable[[Any], Iterable[str]]],
+    ) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        epoch = self._epoch
+        try:
+            value = await run_in_threadpool(loader)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refreshing = False
+            raise
+        finally:
+            self._loading.pop(key, None)
+        future.set_result(value)
+
+        entry_tags = set(tags)
+        if result_tags is not None:
+            entry_tags.update(result_tags(value))
+        with self._lock:
+            if epoch == self._epoch:
+                self._store(key, _Entry(value, config, entry_tags))
+            else:
+                self._remove(key)
+        return value
+
+    def _refresh_done(self, task: asyncio.Task) -> None:
+        self._refreshes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Background cache refresh failed", exc_info=task.exception())
+
+    def _store(self, key: CacheKey, entry: _Entry) -> None:
+        self._remove(key)
+        self._entries[key] = entry
+        for tag in entry.tags:
+            self._by_tag.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: CacheKey) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry.tags:
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tag[tag]
+
+    def invalidate_tags(self, *tags: str) -> None:
+        with self._lock:
+            self._epoch += 1
+            for tag in tags:
+                for key in list(self._by_tag.get(tag, ())):
+                    self._remove(key)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        result = {}
+        for route, stats in self._stats.items():
+            lookups = stats.hits + stats.stale_hits + stats.misses
+            result[route] = {
+                "hits": stats.hits,
+                "stale_hits": stats.stale_hits,
+                "misses": stats.misses,
+                "refreshes": stats.refreshes,
+                "hit_rate": (stats.hits + stats.stale_hits) / lookups if lookups else 0.0,
+            }
+        result["_entries"] = {"size": len(self._entries)}
+        return result
+
+
+list_cache = MicroCache()
+
+
+def task_result_tags(result: Tuple[List[Dict[str, Any]], int]) -> List[str]:
+    entities, _ = result
+    return [f"task:{entity.get('id')}" for entity in entities]
+
+
+def enterprise_tasks_tag(enterprise_id: Any) -> str:
+    return f"tasks:enterprise:{enterprise_id}"
+
+
+BROWSE_TASKS_TAG = "tasks:browse"
+
+
+# 任务创建或更新后调用，使包含该任务或可能受其影响的列表缓存失效
+def invalidate_task_lists(
+    task_entity: Dict[str, Any], fields_to_update: Optional[Dict[str, Any]] = None
+) -> None:
+    fields_to_update = fields_to_update or {}
+    updated_task = {**task_entity, **fields_to_update}
+    tags = [f"task:{updated_task.get('id')}"]
+    created = not fields_to_update
+    if created or any(
+        name in fields_to_update and fields_to_update[name] != task_entity.get(name)
+        for name in TASK_FILTER_FIELDS
+    ):
+        tags.append(BROWSE_TASKS_TAG)
+        tags.append(enterprise_tasks_tag(updated_task.get("enterprise_id")))
+    list_cache.invalidate_tags(*tags)
@@ -0,0 +1,151 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Tuple
+from fastapi import HTTPException, status
+
+# 密码哈希配置：scrypt 的 CPU/内存成本，修改后旧哈希会在下次登录时自动升级
+SCRYPT_N = 2**14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SCRYPT_DKLEN = 32
+SCRYPT_MAXMEM = 64 * 1024 * 1024
+SALT_BYTES = 16
+PASSWORD_HASH_WORKERS = 4  # 执行哈希计算的线程数
+PASSWORD_HASH_MAX_QUEUE = 64  # 排队等待的哈希任务上限，超过后直接返回503
+LEGACY_MD5_LENGTH = 32
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.b64decode(data.encode("ascii"))
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int, dklen: int) -> bytes:
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, dklen=dklen, maxmem=SCRYPT_MAXMEM
+    )
+
+
+def hash_password_sync(password: str) -> str:
+    # 格式: scrypt$N$r$p$salt$hash
+    salt = os.urandom(SALT_BYTES)
+    derived = _scrypt(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P, SCRYPT_DKLEN)
+    return "$".join(
+        [
+            "scrypt",
+            str(SCRYPT_N),
+            str(SCRYPT_R),
+            str(SCRYPT_P),
+            _b64encode(salt),
+            _b64encode(derived),
+        ]
+    )
+
+
+def is_legacy_hash(stored_hash: str) -> bool:
+    return len(stored_hash) == LEGACY_MD5_LENGTH and "$" not in stored_hash
+
+
+def needs_rehash(stored_hash: str) -> bool:
+    if is_legacy_hash(stored_hash):
+        return True
+    parts = stored_hash.split("$")
+    return parts[0] != "scrypt" or parts[1:4] != [
+        str(SCRYPT_N),
+        str(SCRYPT_R),
+        str(SCRYPT_P),
+    ]
+
+
+def verify_password_sync(password: str, stored_hash: str) -> bool:
+    if not stored_hash:
+        return False
+    if is_legacy_hash(stored_hash):
+        # 兼容早期使用 MD5 保存的密码，登录成功后会升级为 scrypt
+        legacy = hashlib.md5(password.encode()).hexdigest()
+        return hmac.compare_digest(legacy, stored_hash)
+    try:
+        algorithm, n, r, p, salt, expected = stored_hash.split("$")
+        if algorithm != "scrypt":
+            return False
+        expected_bytes = _b64decode(expected)
+        derived = _scrypt(
+            password, _b64decode(salt), int(n), int(r), int(p), len(expected_bytes)
+        )
+        return hmac.compare_digest(derived, expected_bytes)
+    except ValueError:
+        return False
+
+
+class PasswordHasher:
+    """在有界线程池中执行密码哈希，避免阻塞事件循环；排队过多时拒绝新请求。"""
+
+    def __init__(
+        self,
+        workers: int = PASSWORD_HASH_WORKERS,
+        max_queue: int = PASSWORD_HASH_MAX_QUEUE,
+    ):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="password-hash"
+        )
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_seconds = 0.0
+
+    async def _run(self, func, *args):
+        with self._lock:
+            if self._pending >= self.workers + self.max_queue:
+                self._rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Server is busy, please retry later",
+                    headers={"Retry-After": "1"},
+                )
+            self._pending += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, func, *args
+            )
+        finally:
+            with self._lock:
+                self._pending -= 1
+                self._completed += 1
+                self._total_seconds += time.perf_counter() - started
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password_sync, password)
+
+    async def verify(self, password: str, stored_hash: str) -> Tuple[bool, bool]:
+        """返回 (密码是否正确, 是否需要用当前参数重新哈希)。"""
+        is_valid = await self._run(verify_password_sync, password, stored_hash or "")
+        return is_valid, is_valid and needs_rehash(stored_hash)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "in_flight": min(self._pending, self.workers),
+                "queue_depth": max(self._pending - self.workers, 0),
+                "completed": self._completed,
+                "rejected": self._rejected,
+                "avg_seconds": (
+                    self._total_seconds / self._completed if self._completed else 0.0
+                ),
+            }
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,241 @@
+import asyncio
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+from fastapi import APIRouter, Depends, Header, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from metrics import route_label
+
+# 按需开启的采样分析器：被选中的请求在事件循环上运行时，后台线程定期读取事件循环线程的调用栈，
+# 按路由聚合，输出火焰图工具可以直接读取的折叠栈格式（flamegraph.pl、speedscope）。
+# 未开启时中间件只做一次判断。管理接口需要 PROFILER_ADMIN_TOKEN，未配置时接口不存在（404）。
+PROFILER_ADMIN_TOKEN = os.getenv("PROFILER_ADMIN_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # 随机分析的请求比例
+PROFILE_INTERVAL = 0.005  # 采样间隔（秒）
+PROFILE_MAX_SECONDS = 600  # 单次按路由分析的最长时间
+PROFILE_MAX_DEPTH = 128
+PROFILE_MAX_STACKS = 5000  # 每个路由保留的不同调用栈数，超出的样本计入 "(truncated)"
+TRUNCATED_STACK = "(truncated)"
+
+
+class ProfileSession:
+    def __init__(self, route: Optional[str], seconds: float):
+        self.route = route  # None 表示所有路由
+        self.until = time.monotonic() + seconds
+
+    def matches(self, route: str, now: float) -> bool:
+        return now < self.until and (self.route is None or self.route == route)
+
+
+class SamplingProfiler:
+    def __init__(self, sample_rate: float = PROFILE_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.interval = PROFILE_INTERVAL
+        self.sessions: List[ProfileSession] = []
+        self._stacks: Dict[str, Dict[str, int]] = {}
+        self._tasks: Dict[asyncio.Task, str] = {}
+        self._frame_names: Dict[object, str] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.samples = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.sessions) or self.sample_rate > 0
+
+    def should_profile(self, scope) -> Optional[str]:
+        """返回需要分析的请求的路由，不需要时返回 None。"""
+        route = None
+        if self.sessions:
+            now = time.monotonic()
+            self.sessions = [s for s in self.sessions if now < s.until]
+            route = route_label(scope)
+            if any(session.matches(route, now) for session in self.sessions):
+                return route
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            return route or route_label(scope)
+        return None
+
+    def start_session(self, route: Optional[str], seconds: float) -> ProfileSession:
+        session = ProfileSession(route, seconds)
+        self.sessions.append(session)
+        return session
+
+    def stop_sessions(self) -> None:
+        self.sessions = []
+
+    def add_task(self, task: asyncio.Task, route: str) -> None:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.get_running_loop()
+                self._loop_thread_id = threading.get_ident()
+            self._tasks[task] = route
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="profiler", daemon=True
+                )
+                self._thread.start()
+
+    def remove_task(self, task: asyncio.Task) -> None:
+        with self._lock:
+            self._tasks.pop(task, None)
+
+    def _run(self) -> None:
+        # 没有被分析的请求时退出，下一个请求再启动
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._tasks:
+                    self._thread = None
+                    return
+            self._sample()
+
+    def _sample(self) -> None:
+        task = asyncio.current_task(self._loop)
+        route = self._tasks.get(task) if task is not None else None
+        if route is None:
+            return
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        stack = self._collapse(frame)
+        with self._lock:
+            stacks = self._stacks.setdefault(route, {})
+            if stack not in stacks and len(stacks) >= PROFILE_MAX_STACKS:
+                stack = TRUNCATED_STACK
+            stacks[stack] = stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def _frame_name(self, code) -> str:
+        name = self._frame_names.get(code)
+        if name is None:
+            filename = code.co_filename.rsplit(os.sep, 1)[-1]
+            name = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+            # 折叠栈格式中分号分隔帧，空格分隔计数
+            name = self._frame_names[code] = name.replace(";", ":").replace(" ", "_")
+        return name
+
+    def _collapse(self, frame) -> str:
+        names = []
+        while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+            names.append(self._frame_name(frame.f_code))
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def collapsed(self, route: Optional[str] = None) -> str:
+        """每行 "路由;帧;帧;... 样本数"，路由作为火焰图的根。"""
+        with self._lock:
+            items = [
+                (name, dict(stacks))
+                for name, stacks in self._stacks.items()
+                if route is None or name == route
+            ]
+        lines = []
+        for name, stacks in items:
+            root = name.replace(";", ":").replace(" ", "_")
+            for stack, count in sorted(stacks.items()):
+                lines.append(f"{root};{stack} {count}")
+        return "\n".join(lines) + ("\n" if lines else "")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stacks = {}
+            self.samples = 0
+
+    def status(self) -> Dict[str, object]:
+        now = time.monotonic()
+        with self._lock:
+            routes = {
+                name: sum(stacks.values()) for name, stacks in self._stacks.items()
+            }
+        return {
+            "sample_rate": self.sample_rate,
+            "sessions": [
+                {"route": s.route, "remaining_seconds": round(s.until - now, 1)}
+                for s in self.sessions
+                if now < s.until
+            ],
+            "profiling_requests": len(self._tasks),
+            "samples": self.samples,
+            "routes": routes,
+        }
+
+
+profiler = SamplingProfiler()
+
+
+class ProfilerMiddleware:
+    def __init__(self, app, sampling_profiler: Optional[SamplingProfiler] = None):
+        self.app = app
+        self.profiler = sampling_profiler or profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.enabled:
+            await self.app(scope, receive, send)
+            return
+        route = self.profiler.should_profile(scope)
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+
+        task = asyncio.current_task()
+        self.profiler.add_task(task, route)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.profiler.remove_task(task)
+
+
+def require_profiler_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    if not PROFILER_ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(
+        x_admin_token, PROFILER_ADMIN_TOKEN
+    ):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+router = APIRouter(
+    prefix="/admin/profile",
+    include_in_schema=False,
+    dependencies=[Depends(require_profiler_admin)],
+)
+
+
+# 分析 N 秒内匹配路由模板的所有请求，route 为空时分析所有路由
+@router.post("/start")
+async def start_profiling(
+    route: Optional[str] = Query(None, description="Route template to profile"),
+    seconds: float = Query(30, gt=0, le=PROFILE_MAX_SECONDS),
+):
+    profiler.start_session(route, seconds)
+    return profiler.status()
+
+
+@router.post("/stop")
+async def stop_profiling():
+    profiler.stop_sessions()
+    return profiler.status()
+
+
+@router.get("/status")
+async def profiling_status():
+    return profiler.status()
+
+
+# 折叠栈格式，例如 flamegraph.pl profile.txt > profile.svg，或直接导入 speedscope
+@router.get("", response_class=PlainTextResponse)
+async def collapsed_stacks(route: Optional[str] = Query(None)):
+    return PlainTextResponse(profiler.collapsed(route))
+
+
+@router.delete("")
+async def clear_profile():
+    profiler.clear()
+    return profiler.status()
@@ -0,0 +1,366 @@
+import functools
+import logging
+import os
+import re
+import threading
+import types
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from fastapi import HTTPException
+from metrics import ROWS_BUCKETS, Counter, Histogram, registry, route_label, row_count
+from tracing import current_span, redact_filter
+
+logger = logging.getLogger(__name__)
+
+# 每次存储查询按访问方式分类：
+# point     - PartitionKey + RowKey 精确读取
+# partition - 限定在一个分区内的扫描
+# table     - 不限定分区，服务端扫描整张表（按非键字段过滤都属于这一类）
+# 每个请求累计查询次数、全表扫描次数、读取的行数，超出该路由的预算时记录日志或拒绝请求，
+# 防止新接口重新引入随数据量线性增长的查询。
+# Azure Table 不返回服务端实际检查过的行数，这里无法得到；rows_scanned 是存储传回给
+# 本服务的行数，只有聚合类方法（例如只返回最大ID）通过 report_rows_read 报告的行数
+# 与返回值不同。服务端按非键字段过滤的开销由 max_table_scans 限制。
+QUERY_POINT = "point"
+QUERY_PARTITION = "partition"
+QUERY_TABLE = "table"
+
+BUDGET_LOG = "log"
+BUDGET_REJECT = "reject"
+QUERY_BUDGET_ACTION = os.getenv("QUERY_BUDGET_ACTION", BUDGET_LOG)
+
+
+class QueryBudget:
+    """None 表示不限制；action 为 None 时使用 QUERY_BUDGET_ACTION。"""
+
+    def __init__(
+        self,
+        max_rows_scanned: Optional[int] = None,
+        max_table_scans: Optional[int] = None,
+        action: Optional[str] = None,
+    ):
+        self.max_rows_scanned = max_rows_scanned
+        self.max_table_scans = max_table_scans
+        self._action = action
+
+    @property
+    def action(self) -> str:
+        return self._action or QUERY_BUDGET_ACTION
+
+
+DEFAULT_QUERY_BUDGET = QueryBudget(max_rows_scanned=5000, max_table_scans=5)
+# 按路由模板配置，基于有序索引分页的接口只应读取一页左右的数据，且不允许全表扫描
+QUERY_BUDGETS: Dict[str, QueryBudget] = {
+    "/api/task/mytasks": QueryBudget(max_rows_scanned=500, max_table_scans=0),
+    "/api/task/tasks": QueryBudget(max_rows_scanned=500, max_table_scans=1),
+    "/api/reward/withdraw-status": QueryBudget(
+        max_rows_scanned=500, max_table_scans=0
+    ),
+    "/api/reward/historys": QueryBudget(max_rows_scanned=500, max_table_scans=0),
+    "/api/task/{task_id}/details": QueryBudget(max_rows_scanned=50, max_table_scans=1),
+}
+
+storage_queries_total = registry.register(
+    Counter(
+        "storage_queries_total",
+        "Storage queries by table and access kind (point, partition, table).",
+        ("table", "kind"),
+    )
+)
+storage_rows_scanned = registry.register(
+    Histogram(
+        "storage_rows_scanned",
+        "Rows read from storage per query by table and access kind.",
+        ("table", "kind"),
+        buckets=ROWS_BUCKETS,
+    )
+)
+query_budget_exceeded_total = registry.register(
+    Counter(
+        "query_budget_exceeded_total",
+        "Requests that exceeded their route's query budget.",
+        ("route", "action"),
+    )
+)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_PARENTHESES = re.compile(r"\([^()]*\)")
+_TOP_LEVEL_OR = re.compile(r"\bor\b", re.IGNORECASE)
+_PARTITION_PREFIX = re.compile(
+    r"^\s*PartitionKey\s+eq\s+'[^']*'\s*(?:and\s+(?P<rest>.*))?$",
+    re.IGNORECASE | re.DOTALL,
+)
+_ROW_KEY_POINTS = re.compile(
+    r"^\s*\(?\s*RowKey\s+eq\s+'[^']*'(?:\s+or\s+RowKey\s+eq\s+'[^']*')*\s*\)?\s*$",
+    re.IGNORECASE,
+)
+
+
+def _has_top_level_or(text: str) -> bool:
+    # and 的优先级高于 or，括号外出现 or 时整个条件不再限定在一个分区
+    text = _STRING_LITERAL.sub("''", text)
+    while True:
+        stripped = _PARENTHESES.sub("", text)
+        if stripped == text:
+            break
+        text = stripped
+    return bool(_TOP_LEVEL_OR.search(text))
+
+
+def classify_filter(filter_query: Optional[str]) -> str:
+    if not filter_query:
+        return QUERY_TABLE
+    match = _PARTITION_PREFIX.match(_STRING_LITERAL.sub("''", filter_query))
+    if match is None:
+        return QUERY_TABLE
+    rest = match.group("rest")
+    if not rest:
+        return QUERY_PARTITION
+    if _has_top_level_or(rest):
+        return QUERY_TABLE
+    if _ROW_KEY_POINTS.match(rest):
+        return QUERY_POINT
+    return QUERY_PARTITION
+
+
+_FILTER_ARGUMENT_METHODS = (
+    "query_entities",
+    "query_entities_page",
+    "query_entities_with_etag",
+    "iter_entities",
+)
+_FIELD_ARGUMENT_METHODS = ("check_field_exists", "get_entity_by_field")
+_KEY_ARGUMENT_METHODS = ("get_entity",)
+_KEY_FILTER = "PartitionKey eq '?' and RowKey eq '?'"
+
+
+def describe_query(
+    method_name: str, args: Tuple[Any, ...], kwargs: Dict[str, Any]
+) -> Tuple[str, Optional[str]]:
+    """返回 (访问方式, 过滤条件)，args 不含 self。"""
+    if method_name in _FILTER_ARGUMENT_METHODS:
+        filter_query = args[1] if len(args) > 1 else kwargs.get("filter_query")
+        return classify_filter(filter_query), filter_query
+    if method_name in _FIELD_ARGUMENT_METHODS:
+        field_name = args[1] if len(args) > 1 else kwargs.get("field_name")
+        kind = QUERY_PARTITION if field_name == "PartitionKey" else QUERY_TABLE
+        return kind, f"{field_name} eq ?"
+    if method_name in _KEY_ARGUMENT_METHODS:
+        return QUERY_POINT, _KEY_FILTER
+    if method_name == "get_all_entities":
+        names = [
+            name
+            for name, value in kwargs.items()
+            if name not in ("page", "page_size") and value is not None
+        ]
+        kind = QUERY_PARTITION if "PartitionKey" in names else QUERY_TABLE
+        return kind, " and ".join(f"{name} eq ?" for name in names) or None
+    # get_latest_id_by_partition 等读取整张表的方法
+    return QUERY_TABLE, None
+
+
+class QueryBudgetExceeded(HTTPException):
+    """策略拒绝而不是服务端错误，返回 503，detail 说明超出的预算。"""
+
+    def __init__(self, reason: str):
+        super().__init__(
+            status_code=503,
+            detail=f"Request rejected: query budget for this route exceeded ({reason})",
+        )
+        self.reason = reason
+
+
+class QueryUsage:
+    """一个请求内的存储查询统计，可能被线程池中的多个查询同时更新。"""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.queries = 0
+        self.table_scans = 0
+        self.rows_scanned = 0
+        self.rows_returned = 0
+        self.exceeded: Optional[str] = None
+        self._budget: Optional[QueryBudget] = None
+        self._lock = threading.Lock()
+
+    @property
+    def route(self) -> str:
+        return route_label(self.scope)
+
+    @property
+    def budget(self) -> QueryBudget:
+        # 第一次查询时路由已经匹配完成
+        if self._budget is None:
+            self._budget = QUERY_BUDGETS.get(self.route, DEFAULT_QUERY_BUDGET)
+        return self._budget
+
+    def _violation(self) -> Optional[str]:
+        budget = self.budget
+        if (
+            budget.max_table_scans is not None
+            and self.table_scans > budget.max_table_scans
+        ):
+            return f"{self.table_scans} table scans > {budget.max_table_scans}"
+        if (
+            budget.max_rows_scanned is not None
+            and self.rows_scanned > budget.max_rows_scanned
+        ):
+            return f"{self.rows_scanned} rows scanned > {budget.max_rows_scanned}"
+        return None
+
+    def _check(self) -> Optional[str]:
+        reason = self._violation()
+        if reason is not None and self.exceeded is None:
+            self.exceeded = reason
+        return reason
+
+    def start_query(self, kind: str) -> None:
+        # 只在执行之前拒绝，拒绝时不会真正访问存储；
+        # 已经超出的读取行数由本请求的下一次查询拒绝
+        with self._lock:
+            self.queries += 1
+            if kind == QUERY_TABLE:
+                self.table_scans += 1
+            reason = self._check()
+        if reason is not None and self.budget.action == BUDGET_REJECT:
+            raise QueryBudgetExceeded(reason)
+
+    def finish_query(self, rows_scanned: int, rows_returned: int) -> None:
+        # 查询已经完成，只记录，不丢弃已经得到的结果
+        with self._lock:
+            self.rows_scanned += rows_scanned
+            self.rows_returned += rows_returned
+            self._check()
+
+
+_usage: ContextVar[Optional[QueryUsage]] = ContextVar("query_usage", default=None)
+_rows_read: ContextVar[Optional[List[Optional[int]]]] = ContextVar(
+    "rows_read", default=None
+)
+
+
+def report_rows_read(count: int) -> None:
+    """读取的行数与返回值不一致的存储方法（例如只返回最大ID）调用，报告实际读取的行数。"""
+    holder = _rows_read.get()
+    if holder is not None:
+        holder[0] = count
+
+
+def _rows_returned(result: Any) -> int:
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        return len(result[0])
+    return row_count(result)
+
+
+def _record(
+    usage: Optional[QueryUsage],
+    storage_span: Any,
+    table_name: str,
+    kind: str,
+    rows_scanned: int,
+    rows_returned: int,
+) -> None:
+    storage_queries_total.inc(table_name, kind)
+    storage_rows_scanned.observe(rows_scanned, table_name, kind)
+    storage_span.set_attribute("db.rows_scanned", rows_scanned)
+    if usage is not None:
+        usage.finish_query(rows_scanned, rows_returned)
+
+
+def _accounted_rows(
+    rows: Any,
+    usage: Optional[QueryUsage],
+    storage_span: Any,
+    table_name: str,
+    kind: str,
+):
+    # 逐行读取时存储传回的行数就是调用方取走的行数，两者按同一个值记录
+    count = 0
+    try:
+        for row in rows:
+            count += 1
+            yield row
+    finally:
+        _record(usage, storage_span, table_name, kind, count, count)
+
+
+def account_query(method: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    装饰 AzureTableStorage 的读取方法：分类查询，统计读取和返回的行数，写入指标、
+    当前 trace 和本请求的查询预算。放在缓存、合并等装饰器外层，
+    统计的是接口发出的查询，不受缓存是否命中影响；放在布隆过滤器之内，
+    过滤器直接判断不存在的查找不访问存储，不计入。写方法不装饰。
+    """
+    method_name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        kind, filter_query = describe_query(method_name, args, kwargs)
+        table_name = str(args[0] if args else kwargs.get("table_name"))
+        storage_span = current_span()
+        storage_span.set_attribute("db.query_kind", kind)
+        if filter_query:
+            storage_span.set_attribute("db.filter", redact_filter(filter_query))
+        usage = _usage.get()
+        if usage is not None:
+            usage.start_query(kind)
+
+        holder: List[Optional[int]] = [None]
+        token = _rows_read.set(holder)
+        try:
+            result = method(self, *args, **kwargs)
+        finally:
+            _rows_read.reset(token)
+        if isinstance(result, types.GeneratorType):
+            return _accounted_rows(result, usage, storage_span, table_name, kind)
+        rows_scanned = holder[0] if holder[0] is not None else row_count(result)
+        _record(
+            usage, storage_span, table_name, kind, rows_scanned, _rows_returned(result)
+        )
+        return result
+
+    return wrapper
+
+
+class QueryBudgetMiddleware:
+    """为每个请求累计查询统计，结束时写入根 span，超出预算时记录一条警告。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        usage = QueryUsage(scope)
+        token = _usage.set(usage)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _usage.reset(token)
+            if usage.queries:
+                self._report(usage)
+
+    def _report(self, usage: QueryUsage) -> None:
+        root_span = current_span()
+        root_span.set_attribute("query.count", usage.queries)
+        root_span.set_attribute("query.table_scans", usage.table_scans)
+        root_span.set_attribute("query.rows_scanned", usage.rows_scanned)
+        root_span.set_attribute("query.rows_returned", usage.rows_returned)
+        if usage.exceeded is None:
+            return
+        action = usage.budget.action
+        query_budget_exceeded_total.inc(usage.route, action)
+        logger.warning(
+            "Query budget exceeded: %s",
+            usage.exceeded,
+            extra={
+                "route": usage.route,
+                "action": action,
+                "queries": usage.queries,
+                "table_scans": usage.table_scans,
+                "rows_scanned": usage.rows_scanned,
+                "rows_returned": usage.rows_returned,
+            },
+        )
@@ -0,0 +1,249 @@
+import abc
+import json
+import math
+import re
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional, Pattern, Tuple
+from urllib.parse import parse_qs
+from auth_token import decode_token
+from metrics import rate_limited_total
+
+RATE_LIMIT_SHARDS = 64  # 令牌桶分片数量，每个分片一把锁
+RATE_LIMIT_SHARD_MAX_BUCKETS = 10000  # 单个分片超过该数量时清理空闲的令牌桶
+# 部署在 Azure App Service 反向代理之后，代理把客户端地址追加在 X-Forwarded-For 末尾。
+# 只信任最右边由代理添加的这些项，左边的内容由客户端控制；0 表示不使用该请求头
+TRUSTED_PROXY_COUNT = 1
+ADMISSION_MAX_IN_FLIGHT = 200  # 同时处理中的请求上限，超过后所有请求返回503
+# 登录、找回密码等可降级的接口在负载达到该比例时优先拒绝
+ADMISSION_SHED_RATIO = 0.7
+# 请求中用于识别账号的参数，未携带令牌的认证接口按账号限流
+IDENTITY_PARAMS = ("username", "email", "contact")
+
+
+class Limit:
+    """令牌桶参数：每秒补充 rate 个令牌，最多积累 burst 个。"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+
+
+class RateLimitRule:
+    def __init__(
+        self,
+        name: str,
+        pattern: str,
+        methods: Tuple[str, ...] = ("POST",),
+        per_ip: Optional[Limit] = None,
+        per_user: Optional[Limit] = None,
+        per_route: Optional[Limit] = None,
+        sheddable: bool = True,
+    ):
+        self.name = name
+        self.pattern: Pattern = re.compile(pattern)
+        self.methods = methods
+        self.per_ip = per_ip
+        self.per_user = per_user
+        self.per_route = per_route
+        self.sheddable = sheddable
+
+    def matches(self, method: str, path: str) -> bool:
+        return method in self.methods and self.pattern.fullmatch(path) is not None
+
+
+RATE_LIMIT_RULES: List[RateLimitRule] = [
+    RateLimitRule(
+        "login",
+        r"/api/(refugee|enterprise)/login",
+        per_ip=Limit(rate=0.5, burst=10),
+        per_user=Limit(rate=0.1, burst=5),
+        per_route=Limit(rate=100, burst=200),
+    ),
+    RateLimitRule(
+        "forgot-password",
+        r"/api/(refugee|enterprise)/forgot-password",
+        methods=("GET", "POST"),
+        per_ip=Limit(rate=0.05, burst=3),
+        per_user=Limit(rate=0.01, burst=2),
+        per_route=Limit(rate=20, burst=50),
+    ),
+    RateLimitRule(
+        "register",
+        r"/api/(refugee|enterprise)/register",
+        per_ip=Limit(rate=0.05, burst=5),
+        per_route=Limit(rate=20, burst=50),
+    ),
+    RateLimitRule(
+        "apply",
+        r"/api/task/\d+/apply",
+        per_ip=Limit(rate=2, burst=20),
+        per_user=Limit(rate=1, burst=10),
+        per_route=Limit(rate=200, burst=400),
+    ),
+]
+
+
+class RateLimitBackend(abc.ABC):
+    """令牌桶存储接口，多实例部署时可以替换为共享存储的实现。"""
+
+    @abc.abstractmethod
+    def consume(self, key: str, limit: Limit, cost: float = 1.0) -> Tuple[bool, float]:
+        """尝试消耗令牌，返回 (是否允许, 需要等待的秒数)。"""
+
+
+class ShardedMemoryBackend(RateLimitBackend):
+    def __init__(
+        self,
+        shards: int = RATE_LIMIT_SHARDS,
+        shard_max_buckets: int = RATE_LIMIT_SHARD_MAX_BUCKETS,
+    ):
+        self.shard_max_buckets = shard_max_buckets
+        self._buckets: List[Dict[str, List[float]]] = [{} for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+
+    def consume(self, key: str, limit: Limit, cost: float = 1.0) -> Tuple[bool, float]:
+        index = zlib.crc32(key.encode()) % len(self._buckets)
+        now = time.monotonic()
+        with self._locks[index]:
+            buckets = self._buckets[index]
+            bucket = buckets.get(key)
+            if bucket is None:
+                if len(buckets) >= self.shard_max_buckets:
+                    self._evict_idle(buckets, now)
+                bucket = buckets[key] = [float(limit.burst), now, limit.burst / limit.rate]
+            tokens, updated_at, _ = bucket
+            tokens = min(limit.burst, tokens + (now - updated_at) * limit.rate)
+            if tokens >= cost:
+                bucket[0], bucket[1] = tokens - cost, now
+                return True, 0.0
+            bucket[0], bucket[1] = tokens, now
+            return False, (cost - tokens) / limit.rate
+
+    @staticmethod
+    def _evict_idle(buckets: Dict[str, List[float]], now: float) -> None:
+        # 已经补满的令牌桶与新建的没有区别，可以直接删除
+        for key, (_, updated_at, refill_seconds) in list(buckets.items()):
+            if now - updated_at >= refill_seconds:
+                del buckets[key]
+
+
+class RateLimitMiddleware:
+    """按 IP、账号和接口进行令牌桶限流，并根据处理中的请求数进行过载保护。"""
+
+    def __init__(
+        self,
+        app,
+        rules: Optional[List[RateLimitRule]] = None,
+        backend: Optional[RateLimitBackend] = None,
+        max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+        shed_ratio: float = ADMISSION_SHED_RATIO,
+    ):
+        self.app = app
+        self.rules = RATE_LIMIT_RULES if rules is None else rules
+        self.backend = backend or ShardedMemoryBackend()
+        self.max_in_flight = max_in_flight
+        self.shed_threshold = int(max_in_flight * shed_ratio)
+        self.in_flight = 0
+        self.rejected = 0
+        self.shed = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        rule = self._match(scope["method"], scope["path"])
+        # 过载保护在任何存储操作之前执行
+        if self.in_flight >= self.max_in_flight or (
+            rule is not None and rule.sheddable and self.in_flight >= self.shed_threshold
+        ):
+            self.shed += 1
+            rate_limited_total.inc("shed")
+            await self._reject(send, 503, "Server is busy, please retry later", 1)
+            return
+
+        if rule is not None:
+            retry_after = self._check_limits(rule, scope)
+            if retry_after is not None:
+                self.rejected += 1
+                rate_limited_total.inc(rule.name)
+                await self._reject(send, 429, "Too many requests", retry_after)
+                return
+
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+    def _match(self, method: str, path: str) -> Optional[RateLimitRule]:
+        for rule in self.rules:
+            if rule.matches(method, path):
+                return rule
+        return None
+
+    def _check_limits(self, rule: RateLimitRule, scope) -> Optional[float]:
+        # 接口总量最后检查，被 IP 或账号限流拒绝的请求不会消耗其他客户端共享的令牌
+        checks = []
+        if rule.per_ip:
+            checks.append((f"ip:{rule.name}:{self._client_ip(scope)}", rule.per_ip))
+        if rule.per_user:
+            user_key = self._user_key(scope)
+            if user_key:
+                checks.append((f"user:{rule.name}:{user_key}", rule.per_user))
+        if rule.per_route:
+            checks.append((f"route:{rule.name}", rule.per_route))
+
+        for key, limit in checks:
+            allowed, retry_after = self.backend.consume(key, limit)
+            if not allowed:
+                return retry_after
+        return None
+
+    @staticmethod
+    def _client_ip(scope) -> str:
+        if TRUSTED_PROXY_COUNT > 0:
+            # 多个同名请求头按顺序合并为一个列表
+            hops = [
+                hop.strip()
+                for name, value in scope.get("headers") or []
+                if name == b"x-forwarded-for"
+                for hop in value.decode("latin-1").split(",")
+                if hop.strip()
+            ]
+            if len(hops) >= TRUSTED_PROXY_COUNT:
+                return hops[-TRUSTED_PROXY_COUNT]
+        client = scope.get("client")
+        return client[0] if client else "unknown"
+
+    @staticmethod
+    def _user_key(scope) -> Optional[str]:
+        for name, value in scope.get("headers") or []:
+            if name == b"authorization" and value.lower().startswith(b"bearer "):
+                try:
+                    return decode_token(value[7:].decode("latin-1")).get("sub")
+                except Exception:
+                    return None
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        for param in IDENTITY_PARAMS:
+            if query.get(param):
+                return query[param][0].strip().lower()
+        return None
+
+    @staticmethod
+    async def _reject(send, status_code: int, detail: str, retry_after: float) -> None:
+        body = json.dumps({"detail": detail}).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status_code,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
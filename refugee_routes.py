@@ -1,15 +1,15 @@
+import logging
 import uuid
 from fastapi import APIRouter, Body, Query, HTTPException, Depends
-from auth_token import create_access_token, verify_oauth_token
+from starlette.concurrency import run_in_threadpool
+from auth_token import create_refugee_token, verify_refugee_token
 from common import (
+    adjust_user_balance,
     get_user_balance,
-    process_task_resources,
     save_refugee_to_database,
     save_withdraw_request,
 )
 from database import (
-    get_latest_id_by_partition,
-    check_field_exists,
     get_entity_by_field,
     update_entity_fields,
     get_all_entities,
@@ -17,6 +17,7 @@ from database import (
 )
 from schemas import (
     CommonResponseBool,
+    EarningsSummaryResponse,
     LoginResponse,
     RefugeeTask,
     RegisterRefugeeTask,
@@ -33,15 +34,46 @@ from schemas import (
     PARTITION_KEYS,
     TABLE_NAMES,
     RewardRequest,
+    SyncResponse,
+    WebhookEventType,
 )
+from change_log import ChangeType, get_changes_since, record_change
+from earnings import get_earnings_summary, get_lifetime_earnings, record_reward
+from binary_format import negotiated_response, response_format
+from fast_json import model_response, parse_fields
+from microcache import BROWSE_TASKS_TAG, list_cache, task_result_tags
+from row_codec import decode_reward, decode_task, decode_withdraw
+from sorted_index import (
+    INDEX_KINDS,
+    InvalidCursor,
+    read_index_page,
+    sync_task_indexes,
+    sync_withdraw_index,
+)
+from webhooks import enqueue_task_event
 from datetime import datetime
 from typing import Optional
 from fastapi.security import OAuth2PasswordBearer
-import hashlib
+from passwords import password_hasher
+from reservations import (
+    ReservationConflict,
+    move_reservations,
+    normalize,
+    release_reservations,
+    reserve_new_owner,
+)
 
+logger = logging.getLogger(__name__)
 router = APIRouter()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# 需要唯一的用户字段及被占用时的提示
+UNIQUE_FIELD_ERRORS = {
+    "username": "Username already exists",
+    "phone": "Phone number already exists",
+    "email": "Email already exists",
+}
+
 # 账户管理
 
 router = APIRouter()
@@ -53,46 +85,54 @@ async def register_refugee(refugee: RegisterRefugeeTask):
         # 获取mock数据
         # mock_refugee_tasks = get_mock_refugee_tasks()
 
-        # 验证用户名是否已存在
-        usernameIsCheck = check_field_exists(
-            TABLE_NAMES.REFUGEE, "username", refugee.username
-        )
-        if usernameIsCheck:
-            raise HTTPException(status_code=400, detail="Username already exists")
-
-        # 验证手机号是否已存在
-        phoneIsCheck = check_field_exists(TABLE_NAMES.REFUGEE, "phone", refugee.phone)
-        if phoneIsCheck:
-            raise HTTPException(status_code=400, detail="Phone number already exists")
+        # 生成新的用户ID并占用用户名、手机号和邮箱，已被占用时立即失败
+        unique_fields = {
+            "username": refugee.username,
+            "phone": refugee.phone,
+            "email": refugee.email,
+        }
+        try:
+            new_id = await run_in_threadpool(
+                reserve_new_owner,
+                TABLE_NAMES.REFUGEE,
+                "user_id",
+                unique_fields,
+                lambda user_id: (str(user_id), str(user_id)),
+            )
+        except ReservationConflict as e:
+            raise HTTPException(
+                status_code=400, detail=UNIQUE_FIELD_ERRORS[e.field_name]
+            )
 
-        # 验证邮箱是否已存在
-        emailIsCheck = check_field_exists(
-            TABLE_NAMES.REFUGEE, "email", refugee.username
-        )
-        if emailIsCheck:
-            raise HTTPException(status_code=400, detail="Email already exists")
-
-        # 密码加密
-        hashed_password = hashlib.md5(refugee.password.encode()).hexdigest()
-
-        # 创建新用户
-
-        # 生成新的用户ID
-        new_id = get_latest_id_by_partition(TABLE_NAMES.REFUGEE, PARTITION_KEYS.PARKEY)
-        new_refugee = RefugeeTask(
-            user_id=new_id,  # 生成唯一的用户ID
-            username=refugee.username,
-            phone=refugee.phone,
-            email=refugee.email,
-            password=hashed_password,
-            status=TaskStatus.PENDING,
-            balance=0,
-            created_at=datetime.now(),
-            updated_at=datetime.now(),
-        )
+        try:
+            # 密码加密
+            hashed_password = await password_hasher.hash(refugee.password)
+
+            # 创建新用户
+            new_refugee = RefugeeTask(
+                user_id=new_id,  # 生成唯一的用户ID
+                username=refugee.username,
+                phone=refugee.phone,
+                email=refugee.email,
+                password=hashed_password,
+                status=TaskStatus.PENDING,
+                balance=0,
+                created_at=datetime.now(),
+                updated_at=datetime.now(),
+            )
 
-        # 将用户信息保存到数据库
-        save_refugee_to_database(new_refugee)
+            # 将用户信息保存到数据库
+            if not save_refugee_to_database(new_refugee):
+                raise HTTPException(status_code=500, detail="Failed to create user")
+        except Exception:
+            # 用户行没有写入，释放占用
+            await run_in_threadpool(
+                release_reservations,
+                TABLE_NAMES.REFUGEE,
+                (str(new_id), str(new_id)),
+                unique_fields,
+            )
+            raise
 
         return new_refugee
     except HTTPException as http_ex:
@@ -112,12 +152,23 @@ async def login_refugee(username: str, password: str, language: Optional[str] =
             raise HTTPException(status_code=401, detail="Invalid username or password")
 
         # 验证密码
-        hashed_password = hashlib.md5(password.encode()).hexdigest()
-        if user["password"] != hashed_password:
+        is_valid, needs_rehash = await password_hasher.verify(
+            password, user.get("password")
+        )
+        if not is_valid:
             raise HTTPException(status_code=401, detail="Invalid username or password")
 
+        # 旧的MD5哈希或旧参数的哈希在登录成功后升级
+        if needs_rehash:
+            update_entity_fields(
+                TABLE_NAMES.REFUGEE,
+                user[PARTITION_KEYS.PARKEY],
+                user[PARTITION_KEYS.ROWKEY],
+                {"password": await password_hasher.hash(password)},
+            )
+
         # 生成访问令牌
-        access_token = create_access_token(data={"sub": str(user["PartitionKey"])})
+        access_token = create_refugee_token(int(user["PartitionKey"]))
 
         # 创建登录响应
         login_data = LoginResponse(
@@ -158,7 +209,7 @@ async def forgot_password(
             raise HTTPException(status_code=404, detail="User not found")
 
         # 更新用户密码
-        hashed_password = hashlib.md5(password.encode()).hexdigest()
+        hashed_password = await password_hasher.hash(password)
         user["password"] = hashed_password
         user["updated_at"] = datetime.now()
 
@@ -179,7 +230,8 @@ async def forgot_password(
 
 @router.put("/api/refugee/update-profile", response_model=CommonResponseBool)
 async def update_refugee_profile(
-    refugee: RegisterRefugeeTask, userId: str = Depends(verify_oauth_token)
+    refugee: RegisterRefugeeTask,
+    userId: str = Depends(verify_refugee_token),
 ):
     try:
         # 获取当前用户信息
@@ -188,27 +240,27 @@ async def update_refugee_profile(
             raise HTTPException(status_code=404, detail="User not found")
 
         # 准备更新字段
-        fields_to_update = {}
-        if refugee.username:
-            if refugee.username != user["username"] and get_entity_by_field(
-                TABLE_NAMES.REFUGEE, "username", refugee.username
-            ):
-                raise HTTPException(status_code=400, detail="Username already exists")
-            fields_to_update["username"] = refugee.username
-        if refugee.phone:
-            if refugee.phone != user["phone"] and get_entity_by_field(
-                TABLE_NAMES.REFUGEE, "phone", refugee.phone
-            ):
-                raise HTTPException(
-                    status_code=400, detail="Phone number already exists"
-                )
-            fields_to_update["phone"] = refugee.phone
-        if refugee.email:
-            if refugee.email != user["email"] and get_entity_by_field(
-                TABLE_NAMES.REFUGEE, "email", refugee.email
-            ):
-                raise HTTPException(status_code=400, detail="Email already exists")
-            fields_to_update["email"] = refugee.email
+        fields_to_update = {
+            name: getattr(refugee, name)
+            for name in UNIQUE_FIELD_ERRORS
+            if getattr(refugee, name)
+        }
+        # 规范化后发生变化的字段，在占用表中原子地占用新值并释放旧值
+        changed = {
+            name: value
+            for name, value in fields_to_update.items()
+            if normalize(name, value) != normalize(name, user.get(name) or "")
+        }
+        previous = {name: user.get(name) for name in changed}
+        owner = (user[PARTITION_KEYS.PARKEY], user[PARTITION_KEYS.ROWKEY])
+        try:
+            await run_in_threadpool(
+                move_reservations, TABLE_NAMES.REFUGEE, owner, previous, changed
+            )
+        except ReservationConflict as e:
+            raise HTTPException(
+                status_code=400, detail=UNIQUE_FIELD_ERRORS[e.field_name]
+            )
 
         fields_to_update["updated_at"] = datetime.now().isoformat()
 
@@ -221,6 +273,13 @@ async def update_refugee_profile(
         )
 
         if not update_success:
+            # 恢复原来的占用；原值已被他人占用时保留新值的占用
+            try:
+                await run_in_threadpool(
+                    move_reservations, TABLE_NAMES.REFUGEE, owner, changed, previous
+                )
+            except ReservationConflict:
+                pass
             raise HTTPException(status_code=500, detail="Failed to update user profile")
 
         return CommonResponseBool(result=True)
@@ -239,7 +298,7 @@ async def update_refugee_profile(
 # 获取可用任务列表，按类型、难度、报酬等进行筛选。
 @router.get("/api/task/browse", response_model=TaskListResponse)
 async def browse_tasks(
-    userId: str = Depends(verify_oauth_token),
+    userId: str = Depends(verify_refugee_token),
     task_type: Optional[TaskType] = Query(None, description="Filter tasks by type"),
     difficulty: Optional[TaskDifficulty] = Query(
         None, description="Filter tasks by difficulty"
@@ -252,7 +311,12 @@ async def browse_tasks(
     ),
     page: int = Query(1, ge=1, description="Page number"),
     page_size: int = Query(10, ge=1, le=100, description="Number of items per page"),
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return for each item"
+    ),
+    media_type: str = Depends(response_format),
 ):
+    selected_fields = parse_fields(fields, Task)
     try:
         # 这里应该是实际的数据库查询逻辑
         search_params = {}
@@ -269,15 +333,22 @@ async def browse_tasks(
         if max_reward is not None:
             search_params["reward_per_unit__le"] = max_reward
 
-        all_tasks, total_count = get_all_entities(
-            TABLE_NAMES.TASK, page, page_size, **search_params
+        all_tasks, total_count = await list_cache.get_or_load(
+            "browse_tasks",
+            {**search_params, "page": page, "page_size": page_size},
+            lambda: get_all_entities(
+                TABLE_NAMES.TASK, page, page_size, **search_params
+            ),
+            tags=[BROWSE_TASKS_TAG],
+            result_tags=task_result_tags,
         )
         # Convert the raw entities to Task objects
-        tasks = []
-        for task in all_tasks:
-            task["resources"] = process_task_resources(task.get("resources"))
-            tasks.append(Task(**task))
-        return TaskListResponse(total_count=total_count, tasks=tasks)
+        tasks = [decode_task(task) for task in all_tasks]
+        return negotiated_response(
+            TaskListResponse.construct(total_count=float(total_count), tasks=tasks),
+            selected_fields,
+            media_type,
+        )
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -285,18 +356,17 @@ async def browse_tasks(
 
 # 获取任务详情
 @router.get("/api/task/{task_id}/details", response_model=Task)
-async def get_task_details(task_id: int, userId: str = Depends(verify_oauth_token)):
+async def get_task_details(task_id: int, userId: str = Depends(verify_refugee_token)):
     try:
         # 从数据库获取任务详情
-        task_entity = get_entity_by_field(TABLE_NAMES.TASK, "id", task_id)
+        task_entity = await run_in_threadpool(
+            get_entity_by_field, TABLE_NAMES.TASK, "id", task_id
+        )
         if not task_entity:
             raise HTTPException(status_code=404, detail="Task not found")
 
-        # 处理任务资源
-        task_entity["resources"] = process_task_resources(task_entity.get("resources"))
-
         # 将原始实体转换为Task对象
-        task = Task(**task_entity)
+        task = decode_task(task_entity)
 
         # 检查任务是否属于当前用户或者是可申请的任务
         if task.user_id != userId and task.status != TaskStatus.PENDING:
@@ -305,7 +375,7 @@ async def get_task_details(task_id: int, userId: str = Depends(verify_oauth_toke
                 detail="You don't have permission to view this task's details",
             )
 
-        return task
+        return model_response(task)
     except HTTPException as http_ex:
         raise http_ex
     except Exception as e:
@@ -317,7 +387,7 @@ async def get_task_details(task_id: int, userId: str = Depends(verify_oauth_toke
 
 # 申请参与任务，将任务加入“我的任务”列表。
 @router.post("/api/task/{task_id}/apply", response_model=CommonResponseBool)
-async def apply_for_task(task_id: int, userId: str = Depends(verify_oauth_token)):
+async def apply_for_task(task_id: int, userId: str = Depends(verify_refugee_token)):
     try:
         # 1. 检查任务是否存在
         task_entity = get_entity_by_field(TABLE_NAMES.TASK, "id", task_id)
@@ -360,6 +430,12 @@ async def apply_for_task(task_id: int, userId: str = Depends(verify_oauth_token)
         if not update_success:
             raise HTTPException(status_code=500, detail="Failed to update task")
 
+        sync_task_indexes(task_entity, fields_to_update)
+
+        enqueue_task_event(
+            WebhookEventType.TASK_CLAIMED, {**task_entity, **fields_to_update}
+        )
+
         return CommonResponseBool(result=True)
     except HTTPException as http_ex:
         raise http_ex
@@ -373,28 +449,36 @@ async def apply_for_task(task_id: int, userId: str = Depends(verify_oauth_token)
 # 获取用户已申请的任务列表及状态。
 @router.get("/api/task/mytasks", response_model=TaskListResponse)
 async def get_my_tasks(
-    userId: str = Depends(verify_oauth_token),
+    userId: str = Depends(verify_refugee_token),
     page: int = Query(1, ge=1, description="Page number"),
     page_size: int = Query(10, ge=1, le=100, description="Number of items per page"),
+    cursor: Optional[str] = Query(None, description="Cursor from the previous page"),
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return for each item"
+    ),
+    media_type: str = Depends(response_format),
 ):
+    selected_fields = parse_fields(fields, Task)
     try:
-        search_params = {"user_id": userId}
-        # 获取所有任务
-        all_tasks, total_count = get_all_entities(
-            TABLE_NAMES.TASK, page, page_size, **search_params
+        # 从用户任务索引中按更新时间倒序读取一页
+        all_tasks, total_count, next_cursor = read_index_page(
+            INDEX_KINDS.MY_TASKS, userId, page_size, cursor, page
         )
-        # print(all_tasks)
         # 将任务列表转换为Task对象列表
-        tasks = []
-        for task in all_tasks:
-            task["resources"] = process_task_resources(task.get("resources"))
-            tasks.append(Task(**task))
-
-        # 按更新时间降序排序
-        tasks.sort(key=lambda x: x.updated_at, reverse=True)
+        tasks = [decode_task(task) for task in all_tasks]
 
         # 构建响应
-        return TaskListResponse(total_count=total_count, tasks=tasks)
+        return negotiated_response(
+            TaskListResponse.construct(
+                total_count=float(total_count), tasks=tasks, next_cursor=next_cursor
+            ),
+            selected_fields,
+            media_type,
+        )
+    except HTTPException as http_ex:
+        raise http_ex
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(
             status_code=500, detail=f"An error occurred while fetching tasks: {str(e)}"
@@ -406,7 +490,7 @@ async def get_my_tasks(
 async def submit_task(
     task_id: int,
     task_commit: str = Body(..., embed=True),
-    userId: str = Depends(verify_oauth_token),
+    userId: str = Depends(verify_refugee_token),
 ):
     try:
         # 1. 检查任务是否存在
@@ -456,28 +540,23 @@ async def submit_task(
         if not update_success:
             raise HTTPException(status_code=500, detail="Failed to update task status")
 
+        sync_task_indexes(task_entity, fields_to_update)
+
+        updated_task = {**task_entity, **fields_to_update}
+        enqueue_task_event(WebhookEventType.TASK_SUBMITTED, updated_task)
+        if completed_units == total_units:
+            enqueue_task_event(WebhookEventType.TASK_COMPLETED, updated_task)
+
         if completed_units == total_units:
             # 5. 计算并更新用户的奖励
             reward_amount = task_entity.get("reward_per_unit", 0)
-            # 获取用户当前余额
-            user_entity = get_entity_by_field(
-                TABLE_NAMES.REFUGEE, PARTITION_KEYS.PARKEY, userId
-            )
-            if not user_entity:
+            # 在任务写入之后读取并条件更新余额，不会用提前读取的旧余额覆盖并发的变更
+            try:
+                new_balance = adjust_user_balance(userId, reward_amount)
+            except ValueError:
                 raise HTTPException(status_code=404, detail="User not found")
 
-            current_balance = float(user_entity.get("balance", 0))
-            new_balance = current_balance + reward_amount
-
-            # 更新用户余额
-            update_success = update_entity_fields(
-                TABLE_NAMES.REFUGEE,
-                userId,
-                userId,
-                {"balance": new_balance, "updated_at": datetime.now().isoformat()},
-            )
-
-            if not update_success:
+            if new_balance is None:
                 raise HTTPException(
                     status_code=500, detail="Failed to update user balance"
                 )
@@ -498,6 +577,7 @@ async def submit_task(
                 "user_id": reward_request.user_id,
                 "task_id": reward_request.task_id,
                 "amount": reward_request.amount,
+                "task_type": task_entity.get("type"),
                 "created_at": reward_request.created_at.isoformat(),
                 "updated_at": reward_request.updated_at.isoformat(),
             }
@@ -510,6 +590,20 @@ async def submit_task(
                     status_code=500, detail="Failed to create reward request"
                 )
 
+            # 7. 更新累计收入统计
+            record_reward(
+                userId,
+                reward_request.amount,
+                task_entity.get("type"),
+                reward_request.created_at,
+            )
+            record_change(
+                userId,
+                ChangeType.REWARD,
+                reward_request_dict["RowKey"],
+                reward_request_dict,
+            )
+
         return CommonResponseBool(result=True)
     except HTTPException as http_ex:
         raise http_ex
@@ -519,10 +613,12 @@ async def submit_task(
 
 # 查看任务是否通过审核和反馈信息。
 @router.get("/api/task/{task_id}/feedback", response_model=TaskFeedbackInfoGet)
-async def get_task_feedback(task_id: int, userId: str = Depends(verify_oauth_token)):
+async def get_task_feedback(task_id: int, userId: str = Depends(verify_refugee_token)):
     try:
         # 1. 检查任务是否存在
-        task_entity = get_entity_by_field(TABLE_NAMES.TASK, "id", task_id)
+        task_entity = await run_in_threadpool(
+            get_entity_by_field, TABLE_NAMES.TASK, "id", task_id
+        )
         if not task_entity:
             raise HTTPException(status_code=404, detail="Task not found")
 
@@ -551,39 +647,38 @@ async def get_task_feedback(task_id: int, userId: str = Depends(verify_oauth_tok
 # 查看任务收入历史和累计收入。
 @router.get("/api/reward/history", response_model=RewardHistoryResponse)
 async def get_reward_history(
-    userId: str = Depends(verify_oauth_token),
+    userId: str = Depends(verify_refugee_token),
     page: int = Query(1, ge=1, description="Page number"),
     page_size: int = Query(10, ge=1, le=100, description="Number of items per page"),
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return for each item"
+    ),
+    media_type: str = Depends(response_format),
 ):
+    selected_fields = parse_fields(fields, RewardRequest)
     try:
         # 从数据库中获取用户的任务收入历史
         search_params = {"user_id": userId}
         reward_history_entities, total_count = get_all_entities(
             TABLE_NAMES.REWARD_HISTORY, page, page_size, **search_params
         )
-        print(reward_history_entities)
-        reward_history = []
-        total_reward = 0
-
-        reward_history = [
-            RewardRequest(
-                user_id=int(entity.get("user_id")),
-                task_id=int(entity.get("task_id")),
-                amount=float(entity.get("amount")),
-                created_at=datetime.fromisoformat(entity.get("created_at")),
-                updated_at=datetime.fromisoformat(entity.get("updated_at")),
-            )
-            for entity in reward_history_entities
-        ]
+        logger.debug(
+            "Reward history page for user %s: %d of %d entries",
+            userId,
+            len(reward_history_entities),
+            total_count,
+        )
+        reward_history = [decode_reward(entity) for entity in reward_history_entities]
 
-        total_reward = sum(item.amount for item in reward_history)
+        # 累计收入取自增量维护的统计，而不是当前页之和
+        total_reward = get_lifetime_earnings(userId)
 
-        return_data = RewardHistoryResponse(
+        return_data = RewardHistoryResponse.construct(
             reward_history=reward_history,
-            total_reward=total_reward,
-            total_count=total_count,
+            total_reward=float(total_reward),
+            total_count=float(total_count),
         )
-        return return_data
+        return negotiated_response(return_data, selected_fields, media_type)
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -591,10 +686,22 @@ async def get_reward_history(
         )
 
 
+# 查看累计收入、今日/本周/本月收入及按任务类型统计
+@router.get("/api/reward/summary", response_model=EarningsSummaryResponse)
+async def get_reward_summary(userId: str = Depends(verify_refugee_token)):
+    try:
+        return get_earnings_summary(userId)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"An error occurred while fetching reward summary: {str(e)}",
+        )
+
+
 # 发起报酬体现
 @router.post("/api/reward/withdraw", response_model=CommonResponseBool)
 async def withdraw_reward(
-    amount: float, payment_method: str, user_id: str = Depends(verify_oauth_token)
+    amount: float, payment_method: str, user_id: str = Depends(verify_refugee_token)
 ):
     try:
         # 验证提现金额
@@ -650,17 +757,11 @@ async def withdraw_reward(
             raise HTTPException(
                 status_code=500, detail="Failed to update withdrawal status"
             )
+        sync_withdraw_index({**saved_request, **fields_to_update})
 
-        # 更新用户余额
-        new_balance = user_balance - amount
-        fields_to_update = {
-            "balance": new_balance,
-            "updated_at": datetime.now().isoformat(),
-        }
-        is_updated = update_entity_fields(
-            TABLE_NAMES.REFUGEE, user_id, user_id, fields_to_update
-        )
-        if not is_updated:
+        # 更新用户余额，与并发的奖励入账使用相同的条件写入
+        new_balance = adjust_user_balance(user_id, -amount)
+        if new_balance is None:
             raise HTTPException(status_code=500, detail="Failed to update user balance")
 
         return CommonResponseBool(result=True)
@@ -673,38 +774,54 @@ async def withdraw_reward(
 # 查看体现的状态和历史记录
 @router.get("/api/reward/withdraw-status", response_model=WithdrawStatusResponse)
 async def get_withdraw_status(
-    user_id: str = Depends(verify_oauth_token),
+    user_id: str = Depends(verify_refugee_token),
     page: int = Query(1, ge=1, description="Page number"),
     page_size: int = Query(10, ge=1, le=100, description="Number of items per page"),
+    cursor: Optional[str] = Query(None, description="Cursor from the previous page"),
+    fields: Optional[str] = Query(
+        None, description="Comma separated fields to return for each item"
+    ),
+    media_type: str = Depends(response_format),
 ):
+    selected_fields = parse_fields(fields, WithdrawRequest)
     try:
-        # 从数据库中获取用户的所有提现记录
-        search_params = {"user_id": user_id}
-        withdraw_history, total_count = get_all_entities(
-            TABLE_NAMES.WITHDRAW_REQUEST, page, page_size, **search_params
+        # 从提现索引中按请求日期倒序读取一页
+        withdraw_history, total_count, next_cursor = read_index_page(
+            INDEX_KINDS.WITHDRAWALS, user_id, page_size, cursor, page
         )
         # 转换提现记录为WithdrawRequest对象
-        user_withdrawals = [
-            WithdrawRequest(
-                id=w["RowKey"],
-                user_id=w["user_id"],
-                amount=float(w["amount"]),
-                payment_method=w["payment_method"],
-                request_date=datetime.fromisoformat(w["request_date"]),
-                status=WithdrawStatus(w["status"]),
-                created_at=datetime.fromisoformat(w["created_at"]),
-                updated_at=datetime.fromisoformat(w["updated_at"]),
-            )
-            for w in withdraw_history
-        ]
-
-        # 按请求日期降序排序
-        user_withdrawals.sort(key=lambda x: x.request_date, reverse=True)
+        user_withdrawals = [decode_withdraw(w) for w in withdraw_history]
 
-        result_data = WithdrawStatusResponse(
+        result_data = WithdrawStatusResponse.construct(
             withdraw_history=user_withdrawals,
-            total_count=total_count,
+            total_count=float(total_count),
+            next_cursor=next_cursor,
         )
-        return result_data
+        return negotiated_response(result_data, selected_fields, media_type)
+    except HTTPException as http_ex:
+        raise http_ex
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+
+
+# 增量同步：返回 since 版本之后变化的任务、奖励和提现记录
+@router.get("/api/refugee/sync", response_model=SyncResponse)
+async def sync_changes(
+    userId: str = Depends(verify_refugee_token),
+    since: Optional[str] = Query(
+        None, description="Version returned by the previous sync"
+    ),
+    media_type: str = Depends(response_format),
+):
+    if since is not None and not since[:20].isdigit():
+        raise HTTPException(status_code=400, detail="Invalid sync version")
+    try:
+        return negotiated_response(
+            get_changes_since(userId, since), media_type=media_type
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail=f"An error occurred while syncing: {str(e)}"
+        )
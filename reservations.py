@@ -0,0 +1,287 @@
+import hashlib
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from database import (
+    delete_entity,
+    get_entity,
+    get_entity_by_field,
+    get_latest_id_by_partition,
+    insert_entity,
+    iter_entities,
+    query_entities,
+    submit_transaction,
+    update_entity_fields,
+)
+from schemas import PARTITION_KEYS, TABLE_NAMES
+
+# 唯一字段占用表：每个用户表一个分区（PartitionKey 为用户表名），每个字段值一行，
+# RowKey 为 "字段:规范化值的哈希"。同一分区内的操作放在一个事务中提交，
+# 任一字段已被占用则整体失败，不需要扫描用户表。
+# 分区内的 "sequence" 行记录下一个可用ID，新ID同样通过创建 "id:..." 行占用。
+RESERVATION_GRACE_SECONDS = 300  # 占用后用户行仍不存在超过该时间，视为注册中断，可以回收
+ID_CLAIM_ATTEMPTS = 20
+SEQUENCE_ROW_KEY = "sequence"
+BACKFILL_ROW_KEY = "backfill"  # 该分区的补录已完成
+
+Owner = Tuple[str, str]  # 用户行的 (PartitionKey, RowKey)
+
+_backfilled: Set[str] = set()  # 已确认补录完成的表，完成后不会再变回未完成
+
+
+class ReservationConflict(Exception):
+    def __init__(self, field_name: str):
+        super().__init__(f"{field_name} is already in use")
+        self.field_name = field_name
+
+
+def normalize(field_name: str, value: Any) -> str:
+    text = str(value).strip()
+    if field_name == "phone":
+        digits = "".join(ch for ch in text if ch.isdigit())
+        return ("+" if text.startswith("+") else "") + digits
+    return text.casefold()
+
+
+def _row_key(field_name: str, value: Any) -> str:
+    digest = hashlib.sha256(normalize(field_name, value).encode("utf-8")).hexdigest()
+    return f"{field_name}:{digest}"
+
+
+def _reservation(
+    table_name: str, field_name: str, value: Any, owner: Owner
+) -> Dict[str, Any]:
+    return {
+        PARTITION_KEYS.PARKEY: table_name,
+        PARTITION_KEYS.ROWKEY: _row_key(field_name, value),
+        "field": field_name,
+        "value": normalize(field_name, value),
+        "owner_partition_key": owner[0],
+        "owner_row_key": owner[1],
+        "created_at": datetime.now().isoformat(),
+    }
+
+
+def _owner_of(row: Dict[str, Any]) -> Owner:
+    return row.get("owner_partition_key"), row.get("owner_row_key")
+
+
+def _read_reservations(table_name: str, row_keys: List[str]) -> List[Dict[str, Any]]:
+    if not row_keys:
+        return []
+    filter_query = f"PartitionKey eq '{table_name}' and (" + " or ".join(
+        f"RowKey eq '{row_key}'" for row_key in row_keys
+    ) + ")"
+    return query_entities(TABLE_NAMES.UNIQUE_RESERVATION, filter_query)
+
+
+def _is_abandoned(row: Dict[str, Any]) -> bool:
+    created_at = datetime.fromisoformat(row["created_at"])
+    if datetime.now() - created_at < timedelta(seconds=RESERVATION_GRACE_SECONDS):
+        return False
+    owner_partition_key, owner_row_key = _owner_of(row)
+    return get_entity(row[PARTITION_KEYS.PARKEY], owner_partition_key, owner_row_key) is None
+
+
+def _blocking_field(
+    table_name: str, fields: Dict[str, Any], owner: Optional[Owner]
+) -> Optional[str]:
+    """事务失败后找出被其他用户占用的字段；中断注册和本用户遗留的占用直接回收。"""
+    field_by_key = {_row_key(name, value): name for name, value in fields.items()}
+    for row in _read_reservations(table_name, list(field_by_key)):
+        if _owner_of(row) == owner or _is_abandoned(row):
+            delete_entity(
+                TABLE_NAMES.UNIQUE_RESERVATION,
+                row[PARTITION_KEYS.PARKEY],
+                row[PARTITION_KEYS.ROWKEY],
+            )
+            continue
+        return field_by_key[row[PARTITION_KEYS.ROWKEY]]
+    return None
+
+
+def _is_backfilled(table_name: str) -> bool:
+    if table_name not in _backfilled and get_entity(
+        TABLE_NAMES.UNIQUE_RESERVATION, table_name, BACKFILL_ROW_KEY
+    ):
+        _backfilled.add(table_name)
+    return table_name in _backfilled
+
+
+def _check_unreserved_users(
+    table_name: str, fields: Dict[str, Any], owner: Optional[Owner]
+) -> None:
+    """补录完成之前，之前注册的用户可能还没有占用记录，直接在用户表中检查。"""
+    if _is_backfilled(table_name):
+        return
+    for name, value in fields.items():
+        user = get_entity_by_field(table_name, name, value)
+        if user and (user[PARTITION_KEYS.PARKEY], user[PARTITION_KEYS.ROWKEY]) != owner:
+            raise ReservationConflict(name)
+
+
+def _next_id_hint(table_name: str, id_field: str) -> int:
+    row = get_entity(TABLE_NAMES.UNIQUE_RESERVATION, table_name, SEQUENCE_ROW_KEY)
+    if row:
+        return int(row["next_id"])
+    # 分区中还没有序列行时，从现有数据计算一次
+    return get_latest_id_by_partition(table_name, id_field)
+
+
+def reserve_new_owner(
+    table_name: str,
+    id_field: str,
+    fields: Dict[str, Any],
+    owner_key: Callable[[int], Owner],
+) -> int:
+    """为新用户分配ID并占用唯一字段，返回新ID；字段已被占用时抛出 ReservationConflict。"""
+    fields = {name: value for name, value in fields.items() if value}
+    _check_unreserved_users(table_name, fields, None)
+    new_id = _next_id_hint(table_name, id_field)
+    for _ in range(ID_CLAIM_ATTEMPTS):
+        owner = owner_key(new_id)
+        operations = [("create", _reservation(table_name, "id", new_id, owner))]
+        operations += [
+            ("create", _reservation(table_name, name, value, owner))
+            for name, value in fields.items()
+        ]
+        operations.append(
+            (
+                "upsert",
+                {
+                    PARTITION_KEYS.PARKEY: table_name,
+                    PARTITION_KEYS.ROWKEY: SEQUENCE_ROW_KEY,
+                    "next_id": new_id + 1,
+                },
+                {"mode": "merge"},
+            )
+        )
+        if submit_transaction(TABLE_NAMES.UNIQUE_RESERVATION, operations):
+            return new_id
+        blocking = _blocking_field(table_name, fields, None)
+        if blocking:
+            raise ReservationConflict(blocking)
+        # 字段都可用，失败的是ID，尝试下一个
+        new_id += 1
+    raise RuntimeError(f"Failed to allocate a new id for '{table_name}'")
+
+
+def release_reservations(table_name: str, owner: Owner, fields: Dict[str, Any]) -> None:
+    # 只删除确实属于该用户的占用
+    row_keys = [_row_key(name, value) for name, value in fields.items() if value]
+    for row in _read_reservations(table_name, row_keys):
+        if _owner_of(row) == owner:
+            delete_entity(
+                TABLE_NAMES.UNIQUE_RESERVATION,
+                row[PARTITION_KEYS.PARKEY],
+                row[PARTITION_KEYS.ROWKEY],
+            )
+
+
+def move_reservations(
+    table_name: str,
+    owner: Owner,
+    old_fields: Dict[str, Any],
+    new_fields: Dict[str, Any],
+) -> None:
+    """在一个事务中占用新值并释放旧值；新值已被占用时抛出 ReservationConflict。"""
+    new_fields = {name: value for name, value in new_fields.items() if value}
+    if not new_fields:
+        return
+    _check_unreserved_users(table_name, new_fields, owner)
+    # 补录之前注册的用户可能没有旧值的占用记录，只释放存在的
+    old_rows = [
+        row
+        for row in _read_reservations(
+            table_name,
+            [_row_key(name, value) for name, value in old_fields.items() if value],
+        )
+        if _owner_of(row) == owner
+    ]
+    for _ in range(2):
+        operations = [
+            ("create", _reservation(table_name, name, value, owner))
+            for name, value in new_fields.items()
+        ]
+        operations += [
+            (
+                "delete",
+                {
+                    PARTITION_KEYS.PARKEY: row[PARTITION_KEYS.PARKEY],
+                    PARTITION_KEYS.ROWKEY: row[PARTITION_KEYS.ROWKEY],
+                },
+            )
+            for row in old_rows
+        ]
+        if submit_transaction(TABLE_NAMES.UNIQUE_RESERVATION, operations):
+            return
+        blocking = _blocking_field(table_name, new_fields, owner)
+        if blocking:
+            raise ReservationConflict(blocking)
+    raise RuntimeError(f"Failed to update reservations in '{table_name}'")
+
+
+# 每个用户表需要唯一的字段，以及ID字段
+RESERVED_FIELDS = {
+    TABLE_NAMES.REFUGEE: ("user_id", ("username", "phone", "email")),
+    TABLE_NAMES.ENTERPRISE: ("id", ("email",)),
+}
+
+
+# 为引入占用表之前注册的用户补录占用记录和ID序列。启动时在后台运行一次，
+# 完成之前注册和修改资料额外检查用户表；已补录的表跳过，可以重复运行，
+# 已有的占用不会被覆盖。force 时重新补录所有表。
+def backfill_reservations(force: bool = False) -> int:
+    created = 0
+    for table_name, (id_field, field_names) in RESERVED_FIELDS.items():
+        if not force and get_entity(
+            TABLE_NAMES.UNIQUE_RESERVATION, table_name, BACKFILL_ROW_KEY
+        ):
+            continue
+        max_id = 0
+        for row in iter_entities(table_name):
+            owner = (row[PARTITION_KEYS.PARKEY], row[PARTITION_KEYS.ROWKEY])
+            if row.get(id_field) is not None:
+                max_id = max(max_id, int(row[id_field]))
+                if insert_entity(
+                    TABLE_NAMES.UNIQUE_RESERVATION,
+                    _reservation(table_name, "id", int(row[id_field]), owner),
+                ):
+                    created += 1
+            for name in field_names:
+                if not row.get(name):
+                    continue
+                # 已有重复数据时插入失败，保留先写入的占用
+                if insert_entity(
+                    TABLE_NAMES.UNIQUE_RESERVATION,
+                    _reservation(table_name, name, row[name], owner),
+                ):
+                    created += 1
+
+        sequence = {
+            PARTITION_KEYS.PARKEY: table_name,
+            PARTITION_KEYS.ROWKEY: SEQUENCE_ROW_KEY,
+            "next_id": max_id + 1,
+        }
+        existing = get_entity(TABLE_NAMES.UNIQUE_RESERVATION, table_name, SEQUENCE_ROW_KEY)
+        if existing is None:
+            insert_entity(TABLE_NAMES.UNIQUE_RESERVATION, sequence)
+        elif int(existing["next_id"]) <= max_id:
+            update_entity_fields(
+                TABLE_NAMES.UNIQUE_RESERVATION,
+                table_name,
+                SEQUENCE_ROW_KEY,
+                {"next_id": max_id + 1},
+            )
+        # 中途失败时没有完成标记，下次启动重新补录
+        marker = {
+            PARTITION_KEYS.PARKEY: table_name,
+            PARTITION_KEYS.ROWKEY: BACKFILL_ROW_KEY,
+            "completed_at": datetime.now().isoformat(),
+        }
+        if submit_transaction(TABLE_NAMES.UNIQUE_RESERVATION, [("upsert", marker)]):
+            _backfilled.add(table_name)
+    return created
+
+
+if __name__ == "__main__":
+    backfill_reservations(force=True)
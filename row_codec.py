@@ -0,0 +1,124 @@
+import json
+from datetime import date, datetime
+from enum import Enum
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Tuple, Type, TypeVar, Union
+from typing import get_args, get_origin, get_type_hints
+from pydantic import BaseModel
+from schemas import RewardRequest, Task, WithdrawRequest
+
+# 存储行由本服务写入，读取时跳过 pydantic 校验，直接按字段类型转换后构造模型。
+# 每个模型的字段转换表只在第一次使用时计算一次。
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+RESOURCE_CACHE_SIZE = 4096  # 缓存已解析的 resources 字符串数量
+
+_MISSING = object()
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+def _to_datetime(value: Any) -> Any:
+    if isinstance(value, datetime) or not isinstance(value, str):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        # Python 3.9 的 fromisoformat 不支持 "Z" 结尾等格式
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _to_date(value: Any) -> Any:
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    return value
+
+
+@lru_cache(maxsize=RESOURCE_CACHE_SIZE)
+def _parse_resources_str(resources: str) -> Tuple[str, ...]:
+    if resources.startswith("[") and resources.endswith("]"):
+        try:
+            return tuple(json.loads(resources))
+        except json.JSONDecodeError:
+            return (resources,)
+    return (resources,)
+
+
+def parse_resources(resources: Any) -> List[str]:
+    """与 common.process_task_resources 结果一致，但相同的字符串只解析一次。"""
+    if isinstance(resources, str):
+        return list(_parse_resources_str(resources))
+    if resources is None:
+        return []
+    return list(resources)
+
+
+def _to_list(value: Any) -> Any:
+    if isinstance(value, str):
+        try:
+            parsed = json.loads(value)
+        except json.JSONDecodeError:
+            return [value]
+        return parsed if isinstance(parsed, list) else [parsed]
+    return value
+
+
+def _scalar_converter(tp: Any) -> Callable[[Any], Any]:
+    if tp is datetime:
+        return _to_datetime
+    if tp is date:
+        return _to_date
+    if isinstance(tp, type) and issubclass(tp, Enum):
+        return tp
+    if tp in (int, float):
+        return tp
+    if tp is str:
+        return lambda value: value if isinstance(value, str) else str(value)
+    return _identity
+
+
+def _field_converter(name: str, tp: Any) -> Callable[[Any], Any]:
+    if get_origin(tp) is Union:
+        args = [arg for arg in get_args(tp) if arg is not type(None)]
+        if len(args) == 1:
+            return _field_converter(name, args[0])
+        return _identity
+    if get_origin(tp) in (list, List):
+        return parse_resources if name == "resources" else _to_list
+    return _scalar_converter(tp)
+
+
+@lru_cache(maxsize=None)
+def _field_map(model: Type[BaseModel]) -> Tuple[Tuple[str, Callable[[Any], Any]], ...]:
+    hints = get_type_hints(model)
+    return tuple(
+        (name, _field_converter(name, tp))
+        for name, tp in hints.items()
+        if not name.startswith("_") and name not in ("Config", "model_config")
+    )
+
+
+def decode_row(model: Type[ModelT], entity: Dict[str, Any]) -> ModelT:
+    """把存储行转换为模型实例，不进行校验；缺失的字段使用模型默认值。"""
+    values = {}
+    for name, convert in _field_map(model):
+        value = entity.get(name, _MISSING)
+        if value is _MISSING:
+            continue
+        values[name] = None if value is None else convert(value)
+    return model.construct(**values)
+
+
+def decode_task(entity: Dict[str, Any]) -> Task:
+    return decode_row(Task, entity)
+
+
+def decode_reward(entity: Dict[str, Any]) -> RewardRequest:
+    return decode_row(RewardRequest, entity)
+
+
+def decode_withdraw(entity: Dict[str, Any]) -> WithdrawRequest:
+    return decode_row(WithdrawRequest, entity)
+
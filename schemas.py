@@ -1,7 +1,7 @@
 from pydantic import BaseModel, Field, HttpUrl
 from enum import Enum
 from datetime import datetime
-from typing import Optional, Union
+from typing import Dict, Optional, Union
 from typing import Optional, List
 
 
@@ -11,6 +11,16 @@ class TABLE_NAMES:
     TASK = "Task"
     REWARD_HISTORY = "RewardHistory"
     WITHDRAW_REQUEST = "WithdrawRequest"
+    WEBHOOK_ENDPOINT = "WebhookEndpoint"
+    WEBHOOK_OUTBOX = "WebhookOutbox"
+    WEBHOOK_DEAD_LETTER = "WebhookDeadLetter"
+    SORTED_INDEX = "SortedIndex"
+    EARNINGS_AGGREGATE = "EarningsAggregate"
+    IDEMPOTENCY_KEY = "IdempotencyKey"
+    EMAIL_OUTBOX = "EmailOutbox"
+    CHANGE_LOG = "ChangeLog"
+    UNIQUE_RESERVATION = "UniqueReservation"
+    BLOOM_WATERMARK = "BloomWatermark"
 
 
 class PARTITION_KEYS:
@@ -18,6 +28,19 @@ class PARTITION_KEYS:
     ROWKEY = "RowKey"
 
 
+class UserRole(str, Enum):
+    ENTERPRISE = "enterprise"  # 企业用户
+    REFUGEE = "refugee"  # 难民用户
+
+
+class Principal(BaseModel):
+    subject: str  # 令牌中的 sub，即路由中使用的用户ID
+    role: UserRole
+    enterprise_id: Optional[int] = None
+    refugee_id: Optional[int] = None
+    token_version: int
+
+
 class TaskStatus(str, Enum):
     PENDING = "pending"  # 待处理
     IN_PROGRESS = "in_progress"  # 进行中
@@ -80,6 +103,7 @@ class Task(TaskBase):
 class TaskListResponse(BaseModel):
     total_count: float
     tasks: List[Task]
+    next_cursor: Optional[str] = None  # 下一页游标，为空表示没有更多数据
 
 
 class TaskCreateResponse(BaseModel):
@@ -151,6 +175,32 @@ class TaskProgress(BaseModel):
     status: TaskStatus
 
 
+class TaskBatchPayRequest(BaseModel):
+    task_ids: List[int] = Field(..., min_items=1, max_items=500)
+
+
+class TaskReviewItem(BaseModel):
+    task_id: int
+    is_accepted: bool
+
+
+class TaskBatchReviewRequest(BaseModel):
+    reviews: List[TaskReviewItem] = Field(..., min_items=1, max_items=500)
+
+
+class BatchItemResult(BaseModel):
+    task_id: int
+    success: bool
+    status_code: int  # 与单个接口一致的HTTP状态码
+    detail: Optional[str] = None
+
+
+class BatchOperationResponse(BaseModel):
+    results: List[BatchItemResult]
+    succeeded: int
+    failed: int
+
+
 class TaskFeedbackResponse(BaseModel):
     task_id: int
     feedback: TaskFeedbackInfo
@@ -178,6 +228,7 @@ class WithdrawRequest(BaseModel):
 class WithdrawStatusResponse(BaseModel):
     withdraw_history: List[WithdrawRequest]
     total_count: float
+    next_cursor: Optional[str] = None  # 下一页游标，为空表示没有更多数据
 
 
 class RewardRequest(BaseModel):
@@ -199,6 +250,25 @@ class RewardHistoryResponse(BaseModel):
     total_count: float
 
 
+class SyncResponse(BaseModel):
+    version: str  # 下次同步时作为 since 传入
+    reset: bool = False  # 为 True 时客户端需要重新拉取完整列表
+    has_more: bool = False  # 为 True 时使用新的 version 继续同步
+    tasks: List[Task] = []  # 新分配或状态变化的任务
+    removed_task_ids: List[int] = []  # 已不再属于该用户的任务
+    rewards: List[RewardRequest] = []  # 新增的奖励记录
+    withdrawals: List[WithdrawRequest] = []  # 新增或状态变化的提现记录
+
+
+class EarningsSummaryResponse(BaseModel):
+    lifetime_earnings: float  # 累计收入
+    today_earnings: float  # 今日收入
+    week_earnings: float  # 本周收入
+    month_earnings: float  # 本月收入
+    reward_count: int  # 奖励记录数
+    earnings_by_task_type: Dict[str, float] = {}  # 按任务类型统计的收入
+
+
 class EnterpriseRegistration(BaseModel):
     name: str  # 企业名称
     email: str  # 企业邮箱
@@ -240,3 +310,34 @@ class EnterpriseResponse(BaseModel):
 class LoginEnterpriseResponse(BaseModel):
     access_token: str
     token_type: str
+
+
+class WebhookEventType(str, Enum):
+    TASK_CLAIMED = "task.claimed"  # 任务被领取
+    TASK_SUBMITTED = "task.submitted"  # 任务单元提交
+    TASK_COMPLETED = "task.completed"  # 任务全部完成
+    TASK_REVIEWED = "task.reviewed"  # 任务已审核
+    TASK_PAID = "task.paid"  # 任务已支付
+
+
+class WebhookEndpointCreate(BaseModel):
+    url: HttpUrl  # 接收通知的地址
+    events: List[WebhookEventType] = list(WebhookEventType)  # 订阅的事件类型
+    description: Optional[str] = None
+
+
+class WebhookEndpoint(BaseModel):
+    id: str
+    enterprise_id: int
+    url: str
+    events: List[WebhookEventType]
+    description: Optional[str] = None
+    secret: Optional[str] = None  # 签名密钥，仅在注册时返回
+    is_active: bool = True
+    created_at: datetime
+    updated_at: datetime
+
+
+class WebhookEndpointListResponse(BaseModel):
+    endpoints: List[WebhookEndpoint]
+    total_count: int
@@ -0,0 +1,117 @@
+import functools
+import threading
+from typing import Any, Callable, Dict, Hashable
+
+# 合并并发的相同读请求：同一时间相同的表和过滤条件只向存储发出一次请求，
+# 其余调用等待并共享结果。只用于读操作，写操作不能合并。
+# 每次写入后表的版本号加一，写入完成后发起的读取不会复用写入前已开始的请求。
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: BaseException = None
+
+
+def _copy_result(result: Any) -> Any:
+    # 实体字典会被调用方修改，每个等待者拿到独立的副本
+    if isinstance(result, dict):
+        return dict(result)
+    if isinstance(result, list):
+        return [_copy_result(item) for item in result]
+    if isinstance(result, tuple):
+        return tuple(_copy_result(item) for item in result)
+    return result
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self._generations: Dict[str, int] = {}
+        self._executed = 0
+        self._collapsed = 0
+
+    def do(self, key: Hashable, func: Callable[..., Any], *args, **kwargs) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._executed += 1
+            else:
+                self._collapsed += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return _copy_result(call.result)
+
+        try:
+            call.result = func(*args, **kwargs)
+            return _copy_result(call.result)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def generation(self, table_name: str) -> int:
+        return self._generations.get(table_name, 0)
+
+    def invalidate(self, table_name: str) -> None:
+        with self._lock:
+            self._generations[table_name] = self._generations.get(table_name, 0) + 1
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self._executed + self._collapsed
+            return {
+                "in_flight": len(self._calls),
+                "executed": self._executed,
+                "collapsed": self._collapsed,
+                "collapse_ratio": self._collapsed / total if total else 0.0,
+            }
+
+
+read_flight = SingleFlight()
+
+
+def coalesce(method: Callable[..., Any]) -> Callable[..., Any]:
+    """装饰 AzureTableStorage 的读方法，按方法名和参数合并并发调用。"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            table_name = args[0] if args else kwargs.get("table_name")
+            key = (
+                method.__name__,
+                read_flight.generation(table_name),
+                args,
+                tuple(sorted(kwargs.items())),
+            )
+            hash(key)
+        except TypeError:
+            return method(self, *args, **kwargs)
+        return read_flight.do(key, method, self, *args, **kwargs)
+
+    return wrapper
+
+
+def invalidates(method: Callable[..., Any]) -> Callable[..., Any]:
+    """装饰写方法，写入完成后使该表正在进行的读请求不再被新的调用复用。"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            read_flight.invalidate(args[0] if args else kwargs.get("table_name"))
+
+    return wrapper
@@ -0,0 +1,259 @@
+import re
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from conditional import invalidate_resource
+from microcache import invalidate_task_lists
+from change_log import ChangeType, record_change, record_task_change
+from database import (
+    OPTIMISTIC_ATTEMPTS,
+    ConcurrentModification,
+    get_entity,
+    if_not_modified,
+    iter_entities,
+    query_entities_page,
+    query_entities_with_etag,
+    submit_conditional_transaction,
+)
+from schemas import PARTITION_KEYS, TABLE_NAMES, PaymentStatus
+
+# 倒序时间戳索引：RowKey 以 (最大值 - 微秒时间戳) 开头，存储按 RowKey 升序返回即为最新在前
+INVERTED_TIMESTAMP_MAX = 10**17 - 1
+INVERTED_TIMESTAMP_WIDTH = 17
+COUNTER_ROW_KEY = "~count"  # "~" 排在数字之后，不会出现在分页结果中
+# 游标即上一页最后一条的 RowKey：倒序时间戳 + "_" + 源记录 RowKey
+_CURSOR_PATTERN = re.compile(
+    rf"^\d{{{INVERTED_TIMESTAMP_WIDTH}}}_[A-Za-z0-9._:-]{{1,255}}$"
+)
+
+
+class InvalidCursor(ValueError):
+    def __init__(self):
+        super().__init__("Invalid cursor")
+
+
+class INDEX_KINDS:
+    MY_TASKS = "mytasks"  # 难民用户已申请的任务，按 updated_at 排序
+    WITHDRAWALS = "withdraw"  # 难民用户的提现记录，按 request_date 排序
+    PAID_TASKS = "paid"  # 企业已支付的任务，按 updated_at 排序
+
+
+def _to_datetime(value: Any) -> datetime:
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    return datetime.fromisoformat(str(value))
+
+
+def index_partition_key(kind: str, owner_id: Any) -> str:
+    return f"{kind}:{owner_id}"
+
+
+def inverted_row_key(sort_value: Any, source_row_key: str) -> str:
+    micros = int(_to_datetime(sort_value).timestamp() * 1_000_000)
+    inverted = INVERTED_TIMESTAMP_MAX - micros
+    return f"{inverted:0{INVERTED_TIMESTAMP_WIDTH}d}_{source_row_key}"
+
+
+def _counter_operation(partition_key: str, delta: int) -> Tuple[Any, ...]:
+    # 计数行带 ETag 条件写入，并发的更新不会互相覆盖；冲突时整个事务失败并重试
+    rows = query_entities_with_etag(
+        TABLE_NAMES.SORTED_INDEX,
+        f"PartitionKey eq '{partition_key}' and RowKey eq '{COUNTER_ROW_KEY}'",
+    )
+    if not rows:
+        counter = {
+            PARTITION_KEYS.PARKEY: partition_key,
+            PARTITION_KEYS.ROWKEY: COUNTER_ROW_KEY,
+            "count": max(delta, 0),
+        }
+        return ("create", counter)
+    counter, etag = rows[0]
+    counter["count"] = max(int(counter.get("count", 0)) + delta, 0)
+    return ("update", counter, if_not_modified(etag, mode="replace"))
+
+
+def _submit_with_retry(build: Callable[[], List[Tuple[Any, ...]]]) -> bool:
+    """build() 读取当前状态并返回事务操作，条件冲突时重新读取后重试。"""
+    for _ in range(OPTIMISTIC_ATTEMPTS):
+        operations = build()
+        if not operations:
+            return True
+        try:
+            return submit_conditional_transaction(TABLE_NAMES.SORTED_INDEX, operations)
+        except ConcurrentModification:
+            continue
+    return False
+
+
+def move_index_entry(
+    kind: str,
+    owner_id: Any,
+    source_entity: Dict[str, Any],
+    sort_field: str,
+    previous_sort_value: Any = None,
+) -> bool:
+    """写入或移动一条索引记录，索引行保存源实体的完整副本，读取时不需要回表。"""
+    partition_key = index_partition_key(kind, owner_id)
+    source_row_key = source_entity[PARTITION_KEYS.ROWKEY]
+    new_row_key = inverted_row_key(source_entity[sort_field], source_row_key)
+    old_row_key = (
+        inverted_row_key(previous_sort_value, source_row_key)
+        if previous_sort_value is not None
+        else new_row_key
+    )
+
+    index_entity = {
+        key: value
+        for key, value in source_entity.items()
+        if key not in (PARTITION_KEYS.PARKEY, PARTITION_KEYS.ROWKEY)
+    }
+    index_entity.update(
+        {
+            PARTITION_KEYS.PARKEY: partition_key,
+            PARTITION_KEYS.ROWKEY: new_row_key,
+            "source_partition_key": source_entity[PARTITION_KEYS.PARKEY],
+            "source_row_key": source_row_key,
+        }
+    )
+
+    def build() -> List[Tuple[Any, ...]]:
+        existing = get_entity(TABLE_NAMES.SORTED_INDEX, partition_key, old_row_key)
+        if not existing:
+            # 新记录用 create，并发写入同一条记录时只有一个会计数
+            return [("create", index_entity), _counter_operation(partition_key, 1)]
+        operations: List[Tuple[Any, ...]] = []
+        if old_row_key != new_row_key:
+            operations.append(("delete", existing))
+        operations.append(("upsert", index_entity, {"mode": "replace"}))
+        return operations
+
+    return _submit_with_retry(build)
+
+
+def remove_index_entry(
+    kind: str, owner_id: Any, source_row_key: str, sort_value: Any
+) -> bool:
+    """删除一条索引记录并减少计数，例如任务被重新分配后原用户的记录。"""
+    partition_key = index_partition_key(kind, owner_id)
+    row_key = inverted_row_key(sort_value, source_row_key)
+
+    def build() -> List[Tuple[Any, ...]]:
+        rows = query_entities_with_etag(
+            TABLE_NAMES.SORTED_INDEX,
+            f"PartitionKey eq '{partition_key}' and RowKey eq '{row_key}'",
+        )
+        if not rows:
+            return []
+        existing, etag = rows[0]
+        return [
+            ("delete", existing, if_not_modified(etag)),
+            _counter_operation(partition_key, -1),
+        ]
+
+    return _submit_with_retry(build)
+
+
+def read_index_page(
+    kind: str,
+    owner_id: Any,
+    page_size: int,
+    cursor: Optional[str] = None,
+    page: int = 1,
+) -> Tuple[List[Dict[str, Any]], int, Optional[str]]:
+    """
+    按最新在前读取一页索引记录，返回 (记录, 总数, 下一页游标)。
+    游标来自客户端，格式不符合索引 RowKey 时抛出 InvalidCursor。
+    """
+    if cursor and not _CURSOR_PATTERN.match(cursor):
+        raise InvalidCursor()
+    partition_key = index_partition_key(kind, owner_id)
+    filter_query = (
+        f"PartitionKey eq '{partition_key}' and RowKey lt '{COUNTER_ROW_KEY}'"
+    )
+    if cursor:
+        escaped = cursor.replace("'", "''")
+        filter_query += f" and RowKey gt '{escaped}'"
+        rows = query_entities_page(TABLE_NAMES.SORTED_INDEX, filter_query, page_size)
+    else:
+        # 兼容页码分页：只读取到目标页为止，而不是整个集合
+        rows = query_entities_page(
+            TABLE_NAMES.SORTED_INDEX, filter_query, page * page_size
+        )[(page - 1) * page_size :]
+
+    next_cursor = rows[-1][PARTITION_KEYS.ROWKEY] if len(rows) == page_size else None
+    counter = get_entity(TABLE_NAMES.SORTED_INDEX, partition_key, COUNTER_ROW_KEY)
+    total_count = int(counter.get("count", 0)) if counter else len(rows)
+    return rows, total_count, next_cursor
+
+
+# 任务更新后同步相关索引，并为分配到的用户记录变更供增量同步使用
+def sync_task_indexes(
+    task_entity: Dict[str, Any],
+    fields_to_update: Dict[str, Any],
+    record_changes: bool = True,
+) -> None:
+    updated_task = {**task_entity, **fields_to_update}
+    invalidate_resource(f"task:{updated_task.get('id')}")
+    invalidate_task_lists(task_entity, fields_to_update)
+    if record_changes:
+        record_task_change(task_entity, fields_to_update)
+    previous_updated_at = task_entity.get("updated_at")
+    source_row_key = task_entity[PARTITION_KEYS.ROWKEY]
+
+    user_id = updated_task.get("user_id")
+    previous_user_id = task_entity.get("user_id")
+    has_user = bool(user_id) and str(user_id) != "0"
+    had_user = bool(previous_user_id) and str(previous_user_id) != "0"
+    same_user = had_user and str(previous_user_id) == str(user_id)
+    if had_user and not same_user and previous_updated_at is not None:
+        # 任务被重新分配或取消分配，从原用户的列表中移除
+        remove_index_entry(
+            INDEX_KINDS.MY_TASKS, previous_user_id, source_row_key, previous_updated_at
+        )
+    if has_user:
+        move_index_entry(
+            INDEX_KINDS.MY_TASKS,
+            user_id,
+            updated_task,
+            "updated_at",
+            previous_updated_at if same_user else None,
+        )
+
+    if updated_task.get("payment_status") == PaymentStatus.PAID.value:
+        was_paid = task_entity.get("payment_status") == PaymentStatus.PAID.value
+        move_index_entry(
+            INDEX_KINDS.PAID_TASKS,
+            updated_task.get("enterprise_id"),
+            updated_task,
+            "updated_at",
+            previous_updated_at if was_paid else None,
+        )
+
+
+def sync_withdraw_index(
+    withdraw_entity: Dict[str, Any], record_changes: bool = True
+) -> None:
+    if record_changes:
+        record_change(
+            withdraw_entity["user_id"],
+            ChangeType.WITHDRAW,
+            withdraw_entity[PARTITION_KEYS.ROWKEY],
+            withdraw_entity,
+        )
+    move_index_entry(
+        INDEX_KINDS.WITHDRAWALS,
+        withdraw_entity["user_id"],
+        withdraw_entity,
+        "request_date",
+    )
+
+
+# 根据源表重建全部索引，用于首次上线或数据修复
+def rebuild_sorted_indexes() -> None:
+    for task in iter_entities(TABLE_NAMES.TASK):
+        sync_task_indexes(task, {}, record_changes=False)
+    for withdraw in iter_entities(TABLE_NAMES.WITHDRAW_REQUEST):
+        sync_withdraw_index(withdraw, record_changes=False)
+
+
+if __name__ == "__main__":
+    rebuild_sorted_indexes()
@@ -0,0 +1,416 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import re
+import time
+import types
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional
+from metrics import route_label, row_count
+
+logger = logging.getLogger(__name__)
+
+# 请求级的追踪：每个请求一个根 span，存储调用、缓存查找、鉴权和序列化各一个子 span，
+# 当前 span 通过 contextvars 传递（run_in_threadpool 和 create_task 都会复制上下文）。
+# 尾部采样：请求结束后才决定是否导出，只导出慢请求和 5xx，其余直接丢弃。
+# 导出格式为 OTLP/JSON，每行一个 ExportTraceServiceRequest，
+# 可由 OpenTelemetry Collector 的 otlpjsonfile receiver 读取。
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "0.5"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "traces.otlp.jsonl")
+TRACE_EXPORT_INTERVAL = 1.0  # 批量写文件的间隔（秒）
+TRACE_EXPORT_QUEUE = 1000  # 等待写入的 trace 上限，超出时丢弃
+TRACE_MAX_SPANS = 1000  # 单个 trace 最多记录的 span 数
+SERVICE_NAME = "homework_backend"
+
+# OTLP 的 span kind
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+STATUS_CODE_ERROR = 2
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b(eq|ne|gt|ge|lt|le)\s+-?\d+(\.\d+)?\b")
+
+
+class Trace:
+    __slots__ = ("trace_id", "spans", "dropped_spans", "finished")
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List["Span"] = []
+        self.dropped_spans = 0
+        self.finished = False
+
+
+class Span:
+    __slots__ = (
+        "trace",
+        "name",
+        "kind",
+        "span_id",
+        "parent_id",
+        "start_ns",
+        "end_ns",
+        "attributes",
+        "error",
+    )
+
+    def __init__(
+        self,
+        trace: Trace,
+        name: str,
+        parent_id: Optional[str],
+        kind: int = SPAN_KIND_INTERNAL,
+    ):
+        self.trace = trace
+        self.name = name
+        self.kind = kind
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        trace = self.trace
+        # 请求结束后才完成的后台工作（例如微缓存的后台刷新）不再计入该请求
+        if trace.finished:
+            return
+        if len(trace.spans) < TRACE_MAX_SPANS:
+            trace.spans.append(self)
+        else:
+            trace.dropped_spans += 1
+
+
+class _NoopSpan:
+    """没有进行中的 trace 时使用，调用方不需要判断。"""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        pass
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def current_span():
+    current = _current_span.get()
+    return current if current is not None else NOOP_SPAN
+
+
+def current_trace_id() -> Optional[str]:
+    current = _current_span.get()
+    return current.trace.trace_id if current is not None else None
+
+
+def start_span(name: str, kind: int = SPAN_KIND_INTERNAL):
+    """创建当前 span 的子 span，但不设为当前 span；需要调用 end()。"""
+    parent = _current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent.span_id, kind)
+
+
+class span:
+    """with span("name") as s: ... 期间 s 是当前 span，嵌套的 span 都是它的子 span。"""
+
+    __slots__ = ("_name", "_kind", "_span", "_token")
+
+    def __init__(self, name: str, kind: int = SPAN_KIND_INTERNAL):
+        self._name = name
+        self._kind = kind
+
+    def __enter__(self):
+        self._span = start_span(self._name, self._kind)
+        self._token = (
+            _current_span.set(self._span) if self._span is not NOOP_SPAN else None
+        )
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if self._token is not None:
+            _current_span.reset(self._token)
+        self._span.end(exc)
+
+
+def traced(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def redact_filter(filter_query: Optional[str]) -> Optional[str]:
+    # 过滤条件中的值可能是邮箱、手机号等，只保留字段和运算符
+    if not filter_query:
+        return None
+    redacted = _STRING_LITERAL.sub("'?'", filter_query)
+    return _NUMBER_LITERAL.sub(lambda match: f"{match.group(1)} ?", redacted)
+
+
+def _entity_bytes(entity: Any) -> int:
+    # 按属性名和值的文本长度估算，Table SDK 不提供响应的实际大小
+    if not isinstance(entity, dict):
+        return 0
+    return sum(len(str(key)) + len(str(value)) for key, value in entity.items())
+
+
+def _result_bytes(result: Any) -> int:
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        result = result[0]
+    if isinstance(result, list):
+        return sum(_entity_bytes(entity) for entity in result)
+    return _entity_bytes(result)
+
+
+def _traced_rows(rows: Any, storage_span: Span):
+    count = size = 0
+    error = None
+    try:
+        for row in rows:
+            count += 1
+            size += _entity_bytes(row)
+            yield row
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        storage_span.set_attribute("db.rows", count)
+        storage_span.set_attribute("db.bytes", size)
+        storage_span.end(error)
+
+
+def traced_storage(method: Callable[..., Any]) -> Callable[..., Any]:
+    """装饰 AzureTableStorage 的方法，记录表名、返回行数和估算的字节数。"""
+    method_name = method.__name__
+    span_name = f"storage.{method_name}"
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        storage_span = start_span(span_name, SPAN_KIND_CLIENT)
+        if storage_span is NOOP_SPAN:
+            return method(self, *args, **kwargs)
+        storage_span.set_attribute("db.system", "azure_table")
+        storage_span.set_attribute(
+            "db.table", str(args[0] if args else kwargs.get("table_name"))
+        )
+        storage_span.set_attribute("db.operation", method_name)
+        # 调用期间设为当前 span，内层的装饰器（query_budget）可以补充属性
+        token = _current_span.set(storage_span)
+        try:
+            result = method(self, *args, **kwargs)
+        except BaseException as e:
+            storage_span.end(e)
+            raise
+        finally:
+            _current_span.reset(token)
+        if isinstance(result, types.GeneratorType):
+            # 流式遍历在迭代结束时结束 span
+            return _traced_rows(result, storage_span)
+        storage_span.set_attribute("db.rows", row_count(result))
+        storage_span.set_attribute("db.bytes", _result_bytes(result))
+        storage_span.end()
+        return result
+
+    return wrapper
+
+
+def _attribute_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [
+        {"key": key, "value": _attribute_value(value)}
+        for key, value in attributes.items()
+    ]
+
+
+def _otlp_span(trace: Trace, item: Span) -> Dict[str, Any]:
+    result = {
+        "traceId": trace.trace_id,
+        "spanId": item.span_id,
+        "name": item.name,
+        "kind": item.kind,
+        "startTimeUnixNano": str(item.start_ns),
+        "endTimeUnixNano": str(item.end_ns),
+        "attributes": _otlp_attributes(item.attributes),
+    }
+    if item.parent_id:
+        result["parentSpanId"] = item.parent_id
+    if item.error:
+        result["status"] = {"code": STATUS_CODE_ERROR, "message": item.error}
+    return result
+
+
+def to_otlp_json(traces: List[Trace]) -> Dict[str, Any]:
+    return {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": _otlp_attributes({"service.name": SERVICE_NAME})
+                },
+                "scopeSpans": [
+                    {
+                        "scope": {"name": __name__},
+                        "spans": [
+                            _otlp_span(trace, item)
+                            for trace in traces
+                            for item in trace.spans
+                        ],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+class TraceExporter:
+    """收集采样的 trace，定期在线程池中追加写入 OTLP/JSON 文件。"""
+
+    def __init__(self, path: str = TRACE_EXPORT_PATH):
+        self.path = path
+        self._pending: List[Trace] = []
+        self._task: Optional[asyncio.Task] = None
+        self.exported = 0
+        self.dropped = 0
+
+    def submit(self, trace: Trace) -> None:
+        if len(self._pending) >= TRACE_EXPORT_QUEUE:
+            self.dropped += 1
+            return
+        self._pending.append(trace)
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        traces, self._pending = self._pending, []
+        if not traces:
+            return
+        line = json.dumps(to_otlp_json(traces), separators=(",", ":"))
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, line)
+        except Exception:
+            self.dropped += len(traces)
+            logger.exception("Failed to export traces to %s", self.path)
+            return
+        self.exported += len(traces)
+
+    def _write(self, line: str) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+            await self.flush()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "queue_depth": len(self._pending),
+            "exported": self.exported,
+            "dropped": self.dropped,
+        }
+
+
+trace_exporter = TraceExporter()
+
+
+def _should_export(duration: float, status: int) -> bool:
+    return duration >= TRACE_SLOW_SECONDS or status >= 500
+
+
+class TracingMiddleware:
+    """为每个请求创建根 span，沿用请求头 traceparent 中的 trace id，并在响应头返回。"""
+
+    def __init__(self, app, exporter: Optional[TraceExporter] = None):
+        self.app = app
+        self.exporter = exporter or trace_exporter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        parent_id = None
+        trace_id = None
+        for key, value in scope.get("headers") or []:
+            if key == b"traceparent":
+                match = _TRACEPARENT.match(value.decode("latin-1").strip())
+                if match:
+                    trace_id, parent_id = match.groups()
+                break
+        trace = Trace(trace_id or f"{random.getrandbits(128):032x}")
+        root = Span(trace, "HTTP " + scope["method"], parent_id, SPAN_KIND_SERVER)
+        root.set_attribute("http.method", scope["method"])
+        root.set_attribute("http.target", scope["path"])
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append(
+                    (
+                        b"traceparent",
+                        f"00-{trace.trace_id}-{root.span_id}-01".encode("latin-1"),
+                    )
+                )
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = _current_span.set(root)
+        error = None
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            _current_span.reset(token)
+            route = route_label(scope)
+            root.name = f"{scope['method']} {route}"
+            root.set_attribute("http.route", route)
+            root.set_attribute("http.status_code", status)
+            root.end(error)
+            trace.finished = True
+            if trace.dropped_spans:
+                root.set_attribute("trace.dropped_spans", trace.dropped_spans)
+            if _should_export((root.end_ns - root.start_ns) / 1e9, status):
+                self.exporter.submit(trace)
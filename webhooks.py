@@ -0,0 +1,536 @@
+import asyncio
+import hashlib
+import hmac
+import http.client
+import ipaddress
+import json
+import logging
+import os
+import random
+import secrets
+import socket
+import ssl
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set, Tuple
+from urllib.parse import urlsplit
+from database import (
+    MAX_TRANSACTION_OPERATIONS,
+    delete_entity,
+    get_entity,
+    insert_entity,
+    query_entities,
+    query_entities_with_etag,
+    submit_transaction,
+    update_entity_fields,
+    update_entity_if_match,
+)
+from schemas import (
+    PARTITION_KEYS,
+    TABLE_NAMES,
+    WebhookEndpoint,
+    WebhookEndpointCreate,
+    WebhookEventType,
+)
+
+logger = logging.getLogger(__name__)
+
+# Webhook 投递配置
+WEBHOOK_WORKERS = 4  # 投递协程数量
+WEBHOOK_ENDPOINT_CONCURRENCY = 1  # 单个接收端同时进行中的请求数，大于1时不再保证顺序
+WEBHOOK_BATCH_SIZE = 50  # 单次请求中最多合并的事件数
+WEBHOOK_MAX_ATTEMPTS = 8  # 超过该次数后转入死信表
+WEBHOOK_RETRY_BASE_SECONDS = 5  # 指数退避的基数
+WEBHOOK_RETRY_MAX_SECONDS = 3600  # 单次退避的上限
+WEBHOOK_POLL_INTERVAL_SECONDS = 5  # 没有新事件时扫描发件箱的间隔
+WEBHOOK_REQUEST_TIMEOUT_SECONDS = 10
+# 认领事件后的租约时长，多个实例不会同时投递同一事件；需要大于一次投递的耗时
+WEBHOOK_LEASE_SECONDS = 120
+SIGNATURE_HEADER = "X-Webhook-Signature"
+TIMESTAMP_HEADER = "X-Webhook-Timestamp"
+# 接收端地址只允许 https 和公网地址，注册时和每次投递前都会解析检查，不跟随重定向。
+# 本地联调（例如本机启动的接收端）时设置为 1，允许 http 和内网、回环地址
+WEBHOOK_ALLOW_PRIVATE_TARGETS = os.getenv("WEBHOOK_ALLOW_PRIVATE_TARGETS") == "1"
+
+
+class OutboxStatus:
+    PENDING = "pending"
+    DEAD = "dead"
+
+
+def sign_payload(secret: str, timestamp: str, body: bytes) -> str:
+    # 签名内容为 "<timestamp>.<body>"，接收方用同样的方式校验
+    message = timestamp.encode() + b"." + body
+    digest = hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+def retry_delay(attempts: int) -> float:
+    # 指数退避加随机抖动，避免大量失败事件同时重试
+    delay = min(WEBHOOK_RETRY_BASE_SECONDS * (2 ** (attempts - 1)), WEBHOOK_RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+
+class WebhookTargetError(ValueError):
+    """接收端地址不允许访问。"""
+
+
+def _is_public(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def resolve_webhook_target(url: str) -> Tuple[str, str, int, str]:
+    """检查并解析接收端地址，返回 (scheme, host, port, IP)；投递时直接连接该 IP。"""
+    parts = urlsplit(url)
+    allowed_schemes = ("https", "http") if WEBHOOK_ALLOW_PRIVATE_TARGETS else ("https",)
+    if parts.scheme not in allowed_schemes:
+        raise WebhookTargetError("Webhook URL must use https")
+    if not parts.hostname:
+        raise WebhookTargetError("Webhook URL must include a host")
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    try:
+        addresses = {
+            info[4][0]
+            for info in socket.getaddrinfo(
+                parts.hostname, port, type=socket.SOCK_STREAM
+            )
+        }
+    except socket.gaierror:
+        raise WebhookTargetError("Webhook host cannot be resolved") from None
+    # 任一地址不是公网地址都拒绝，避免 DNS 轮换到内网地址
+    if not WEBHOOK_ALLOW_PRIVATE_TARGETS and not all(map(_is_public, addresses)):
+        raise WebhookTargetError("Webhook host must resolve to a public address")
+    return parts.scheme, parts.hostname, port, sorted(addresses)[0]
+
+
+class _PinnedHTTPConnection(http.client.HTTPConnection):
+    # 连接检查过的 IP，Host 头仍为原主机名
+    def __init__(self, host: str, port: int, address: str, **kwargs: Any):
+        super().__init__(host, port, **kwargs)
+        self.address = address
+
+    def connect(self) -> None:
+        self.sock = socket.create_connection((self.address, self.port), self.timeout)
+
+
+class _PinnedHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, host: str, port: int, address: str, **kwargs: Any):
+        super().__init__(host, port, context=ssl.create_default_context(), **kwargs)
+        self.address = address
+
+    def connect(self) -> None:
+        sock = socket.create_connection((self.address, self.port), self.timeout)
+        # 证书按原主机名校验
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def post_webhook(
+    url: str, body: bytes, headers: Dict[str, str], timeout: float
+) -> int:
+    # 不跟随重定向，3xx 按失败处理
+    scheme, host, port, address = resolve_webhook_target(url)
+    parts = urlsplit(url)
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    connection_class = (
+        _PinnedHTTPSConnection if scheme == "https" else _PinnedHTTPConnection
+    )
+    connection = connection_class(host, port, address, timeout=timeout)
+    try:
+        connection.request("POST", path, body=body, headers=headers)
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+def _entity_to_endpoint(entity: Dict[str, Any], with_secret: bool = False) -> WebhookEndpoint:
+    return WebhookEndpoint(
+        id=entity[PARTITION_KEYS.ROWKEY],
+        enterprise_id=int(entity["enterprise_id"]),
+        url=entity["url"],
+        events=json.loads(entity.get("events") or "[]"),
+        description=entity.get("description"),
+        secret=entity.get("secret") if with_secret else None,
+        is_active=bool(entity.get("is_active", True)),
+        created_at=datetime.fromisoformat(entity["created_at"]),
+        updated_at=datetime.fromisoformat(entity["updated_at"]),
+    )
+
+
+# 注册Webhook接收端，地址不允许访问时抛出 WebhookTargetError
+def register_webhook_endpoint(
+    enterprise_id: str, endpoint: WebhookEndpointCreate
+) -> Optional[WebhookEndpoint]:
+    resolve_webhook_target(str(endpoint.url))
+    now = datetime.now().isoformat()
+    entity = {
+        PARTITION_KEYS.PARKEY: str(enterprise_id),
+        PARTITION_KEYS.ROWKEY: str(uuid.uuid4()),
+        "enterprise_id": int(enterprise_id),
+        "url": str(endpoint.url),
+        "events": json.dumps([event.value for event in endpoint.events]),
+        "description": endpoint.description or "",
+        "secret": secrets.token_hex(32),
+        "is_active": True,
+        "created_at": now,
+        "updated_at": now,
+    }
+    if not insert_entity(TABLE_NAMES.WEBHOOK_ENDPOINT, entity):
+        return None
+    return _entity_to_endpoint(entity, with_secret=True)
+
+
+def list_webhook_endpoints(enterprise_id: str) -> List[WebhookEndpoint]:
+    entities = query_entities(
+        TABLE_NAMES.WEBHOOK_ENDPOINT, f"PartitionKey eq '{enterprise_id}'"
+    )
+    return [_entity_to_endpoint(entity) for entity in entities]
+
+
+def deactivate_webhook_endpoint(enterprise_id: str, endpoint_id: str) -> bool:
+    if not get_entity(TABLE_NAMES.WEBHOOK_ENDPOINT, str(enterprise_id), endpoint_id):
+        return False
+    return update_entity_fields(
+        TABLE_NAMES.WEBHOOK_ENDPOINT,
+        str(enterprise_id),
+        endpoint_id,
+        {"is_active": False, "updated_at": datetime.now().isoformat()},
+    )
+
+
+def _task_snapshot(task_entity: Dict[str, Any]) -> Dict[str, Any]:
+    fields = [
+        "id",
+        "enterprise_id",
+        "user_id",
+        "title",
+        "status",
+        "payment_status",
+        "completed_units",
+        "total_units",
+        "reward_per_unit",
+        "updated_at",
+    ]
+    snapshot = {field: task_entity.get(field) for field in fields}
+    if isinstance(snapshot["updated_at"], datetime):
+        snapshot["updated_at"] = snapshot["updated_at"].isoformat()
+    return snapshot
+
+
+def _outbox_row_key() -> str:
+    # RowKey 以纳秒时间戳开头，同一接收端内的事件按发生顺序投递；
+    # 投递失败的事件在退避之后重试，可能晚于之后的事件送达
+    return f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+
+
+# 将任务状态变化写入发件箱，由后台投递
+def enqueue_task_event(
+    event_type: WebhookEventType, task_entity: Dict[str, Any], **extra: Any
+) -> int:
+    return enqueue_task_events(event_type, [task_entity], **extra)
+
+
+# 批量写入发件箱：每个企业只查询一次接收端，同一接收端的事件用一个事务写入
+def enqueue_task_events(
+    event_type: WebhookEventType, task_entities: List[Dict[str, Any]], **extra: Any
+) -> int:
+    try:
+        by_enterprise: Dict[str, List[Dict[str, Any]]] = {}
+        for task_entity in task_entities:
+            enterprise_id = task_entity.get("enterprise_id")
+            if enterprise_id:
+                by_enterprise.setdefault(str(enterprise_id), []).append(task_entity)
+
+        queued = 0
+        for enterprise_id, enterprise_tasks in by_enterprise.items():
+            endpoints = query_entities(
+                TABLE_NAMES.WEBHOOK_ENDPOINT, f"PartitionKey eq '{enterprise_id}'"
+            )
+            now = datetime.now().isoformat()
+            for endpoint in endpoints:
+                if not endpoint.get("is_active", True):
+                    continue
+                if event_type.value not in json.loads(endpoint.get("events") or "[]"):
+                    continue
+                operations = [
+                    (
+                        "create",
+                        {
+                            PARTITION_KEYS.PARKEY: endpoint[PARTITION_KEYS.ROWKEY],
+                            PARTITION_KEYS.ROWKEY: _outbox_row_key(),
+                            "enterprise_id": int(enterprise_id),
+                            "event_type": event_type.value,
+                            "task_id": task_entity.get("id"),
+                            "payload": json.dumps(
+                                {**_task_snapshot(task_entity), **extra}, default=str
+                            ),
+                            "status": OutboxStatus.PENDING,
+                            "attempts": 0,
+                            "next_attempt_at": now,
+                            "locked_until": "",
+                            "last_error": "",
+                            "created_at": now,
+                        },
+                    )
+                    for task_entity in enterprise_tasks
+                ]
+                for i in range(0, len(operations), MAX_TRANSACTION_OPERATIONS):
+                    chunk = operations[i : i + MAX_TRANSACTION_OPERATIONS]
+                    if submit_transaction(TABLE_NAMES.WEBHOOK_OUTBOX, chunk):
+                        queued += len(chunk)
+        if queued:
+            webhook_dispatcher.notify()
+        return queued
+    except Exception as e:
+        # Webhook 失败不能影响业务接口
+        logger.error(f"Failed to enqueue webhook event {event_type.value}: {str(e)}")
+        return 0
+
+
+class WebhookDispatcher:
+    """从发件箱表读取待投递事件，按接收端合并批次并发投递。"""
+
+    def __init__(
+        self,
+        workers: int = WEBHOOK_WORKERS,
+        endpoint_concurrency: int = WEBHOOK_ENDPOINT_CONCURRENCY,
+        batch_size: int = WEBHOOK_BATCH_SIZE,
+        max_attempts: int = WEBHOOK_MAX_ATTEMPTS,
+        poll_interval: float = WEBHOOK_POLL_INTERVAL_SECONDS,
+    ):
+        self.workers = workers
+        self.endpoint_concurrency = endpoint_concurrency
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tasks: List[asyncio.Task] = []
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._inflight: set = set()
+
+    def notify(self) -> None:
+        # 可能在线程池中被调用，需要切回事件循环线程设置事件
+        if self._wakeup is not None and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self._tasks.append(asyncio.create_task(self._poll_loop()))
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker_loop()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._inflight.clear()
+
+    def _semaphore(self, endpoint_id: str) -> asyncio.Semaphore:
+        if endpoint_id not in self._semaphores:
+            self._semaphores[endpoint_id] = asyncio.Semaphore(
+                self.endpoint_concurrency
+            )
+        return self._semaphores[endpoint_id]
+
+    def _due_batches(
+        self, inflight_endpoints: Set[str]
+    ) -> List[Tuple[str, List[Dict[str, Any]]]]:
+        # 在线程池中执行：查询到期事件，并用 ETag 条件写入 locked_until 认领，
+        # 只投递认领成功的事件，其他实例已认领的事件会被跳过
+        now = datetime.now()
+        rows = query_entities_with_etag(
+            TABLE_NAMES.WEBHOOK_OUTBOX,
+            f"status eq '{OutboxStatus.PENDING}' "
+            f"and next_attempt_at le '{now.isoformat()}'",
+        )
+        locked_until = (now + timedelta(seconds=WEBHOOK_LEASE_SECONDS)).isoformat()
+        grouped: Dict[str, List[Dict[str, Any]]] = {}
+        for row, etag in sorted(rows, key=lambda r: r[0][PARTITION_KEYS.ROWKEY]):
+            endpoint_id = row[PARTITION_KEYS.PARKEY]
+            # 接收端还有投递中的事件时整体跳过，之后的事件不会先于它们送达
+            if endpoint_id in inflight_endpoints:
+                continue
+            if (row.get("locked_until") or "") > now.isoformat():
+                continue
+            claimed = update_entity_if_match(
+                TABLE_NAMES.WEBHOOK_OUTBOX,
+                {
+                    PARTITION_KEYS.PARKEY: endpoint_id,
+                    PARTITION_KEYS.ROWKEY: row[PARTITION_KEYS.ROWKEY],
+                    "locked_until": locked_until,
+                },
+                etag,
+            )
+            if not claimed:
+                # 之后的事件也不再认领，避免越过被其他实例持有的事件
+                inflight_endpoints.add(endpoint_id)
+                continue
+            grouped.setdefault(endpoint_id, []).append(row)
+
+        batches = []
+        for endpoint_id, endpoint_rows in grouped.items():
+            for i in range(0, len(endpoint_rows), self.batch_size):
+                batches.append((endpoint_id, endpoint_rows[i : i + self.batch_size]))
+        return batches
+
+    async def _poll_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self._wakeup.clear()
+                inflight_endpoints = {endpoint_id for endpoint_id, _ in self._inflight}
+                batches = await loop.run_in_executor(
+                    None, self._due_batches, inflight_endpoints
+                )
+                for endpoint_id, rows in batches:
+                    for row in rows:
+                        self._inflight.add(
+                            (row[PARTITION_KEYS.PARKEY], row[PARTITION_KEYS.ROWKEY])
+                        )
+                    await self._queue.put((endpoint_id, rows))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error scanning webhook outbox: {str(e)}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker_loop(self) -> None:
+        while True:
+            endpoint_id, rows = await self._queue.get()
+            try:
+                async with self._semaphore(endpoint_id):
+                    await self.deliver_batch(endpoint_id, rows)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error delivering webhooks to {endpoint_id}: {str(e)}")
+            finally:
+                for row in rows:
+                    self._inflight.discard(
+                        (row[PARTITION_KEYS.PARKEY], row[PARTITION_KEYS.ROWKEY])
+                    )
+                self._queue.task_done()
+
+    async def deliver_batch(self, endpoint_id: str, rows: List[Dict[str, Any]]) -> bool:
+        # 存储操作都是同步调用，放到线程池中执行，不阻塞事件循环
+        loop = asyncio.get_running_loop()
+        enterprise_id = str(rows[0]["enterprise_id"])
+        endpoint = await loop.run_in_executor(
+            None, get_entity, TABLE_NAMES.WEBHOOK_ENDPOINT, enterprise_id, endpoint_id
+        )
+        if not endpoint or not endpoint.get("is_active", True):
+            # 接收端已被删除或停用，剩余事件直接进入死信表
+            await loop.run_in_executor(
+                None, self._dead_letter, rows, "Endpoint not found or inactive"
+            )
+            return False
+
+        body = json.dumps(
+            {
+                "endpoint_id": endpoint_id,
+                "delivery_id": str(uuid.uuid4()),
+                "events": [
+                    {
+                        "id": row[PARTITION_KEYS.ROWKEY],
+                        "type": row["event_type"],
+                        "task_id": row.get("task_id"),
+                        "occurred_at": row["created_at"],
+                        "data": json.loads(row["payload"]),
+                    }
+                    for row in rows
+                ],
+            }
+        ).encode()
+        timestamp = str(int(time.time()))
+        headers = {
+            "Content-Type": "application/json",
+            TIMESTAMP_HEADER: timestamp,
+            SIGNATURE_HEADER: sign_payload(endpoint["secret"], timestamp, body),
+        }
+
+        error = ""
+        try:
+            status_code = await loop.run_in_executor(
+                None,
+                post_webhook,
+                endpoint["url"],
+                body,
+                headers,
+                WEBHOOK_REQUEST_TIMEOUT_SECONDS,
+            )
+            if 200 <= status_code < 300:
+                await loop.run_in_executor(None, self._delete_rows, rows)
+                return True
+            error = f"HTTP {status_code}"
+        except Exception as e:
+            error = str(e)
+
+        await loop.run_in_executor(None, self._schedule_retry, rows, error)
+        return False
+
+    def _delete_rows(self, rows: List[Dict[str, Any]]) -> None:
+        for row in rows:
+            delete_entity(
+                TABLE_NAMES.WEBHOOK_OUTBOX,
+                row[PARTITION_KEYS.PARKEY],
+                row[PARTITION_KEYS.ROWKEY],
+            )
+
+    def _schedule_retry(self, rows: List[Dict[str, Any]], error: str) -> None:
+        retry_rows = []
+        dead_rows = []
+        for row in rows:
+            attempts = int(row.get("attempts", 0)) + 1
+            row["attempts"] = attempts
+            if attempts >= self.max_attempts:
+                dead_rows.append(row)
+            else:
+                retry_rows.append(row)
+
+        for row in retry_rows:
+            next_attempt = datetime.now() + timedelta(seconds=retry_delay(row["attempts"]))
+            update_entity_fields(
+                TABLE_NAMES.WEBHOOK_OUTBOX,
+                row[PARTITION_KEYS.PARKEY],
+                row[PARTITION_KEYS.ROWKEY],
+                {
+                    "attempts": row["attempts"],
+                    "next_attempt_at": next_attempt.isoformat(),
+                    "locked_until": "",
+                    "last_error": error[:1024],
+                },
+            )
+        if dead_rows:
+            self._dead_letter(dead_rows, error)
+
+    def _dead_letter(self, rows: List[Dict[str, Any]], error: str) -> None:
+        for row in rows:
+            dead_entity = {
+                **row,
+                "status": OutboxStatus.DEAD,
+                "last_error": error[:1024],
+                "dead_at": datetime.now().isoformat(),
+            }
+            if insert_entity(TABLE_NAMES.WEBHOOK_DEAD_LETTER, dead_entity):
+                delete_entity(
+                    TABLE_NAMES.WEBHOOK_OUTBOX,
+                    row[PARTITION_KEYS.PARKEY],
+                    row[PARTITION_KEYS.ROWKEY],
+                )
+        logger.warning(f"{len(rows)} webhook events moved to dead letter: {error}")
+
+
+webhook_dispatcher = WebhookDispatcher()